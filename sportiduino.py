@@ -18,22 +18,24 @@
 sportiduino.py - Classes to work with Sportiduino v1.2.0 and above.
 """
 
-from six import int2byte, byte2int, iterbytes, print_, PY3
-from serial import Serial
-from serial.serialutil import SerialException
-from datetime import datetime
+from sportiduino_compat import int2byte, byte2int, print_, string_types, checksum, to_int, to_bytes
+from collections import deque, OrderedDict
+from datetime import datetime, timedelta
 import time
 #from binascii import hexlify
 import os
-import platform
-import re
+import struct
+import threading
 
-if PY3:
-    def byte2int(x):
-        try:
-            return x[0]
-        except TypeError:
-            return x
+try:
+    from termios import error as _TermiosError
+except ImportError:
+    # Windows
+    _TermiosError = EnvironmentError
+
+# Errors of a failed port. pyserial raises termios.error, e.g. from
+# tcflush() after the device is unplugged.
+_PORT_ERRORS = (EnvironmentError, _TermiosError)
 
 
 class Sportiduino(object):
@@ -46,6 +48,29 @@ class Sportiduino(object):
 
     MAX_DATA_LEN   = 28
 
+    # Version request interval while master station starts up, seconds
+    PROBE_INTERVAL = 0.25
+
+    # Master station serial receive buffer size. Pipelined commands waiting
+    # for response must fit into it.
+    RX_BUFFER_LEN  = 64
+
+    # Supervised mode: delays between reconnection attempts, seconds, and
+    # number of bad frames in a row treated as broken link
+    RECONNECT_DELAY     = 0.5
+    RECONNECT_MAX_DELAY = 10
+    MAX_BAD_FRAMES      = 5
+
+    # Pause of reading threads after error, so a broken port does not spin
+    # them, seconds
+    ERROR_DELAY = 0.1
+
+    # Line speed of the original firmware
+    DEFAULT_BAUDRATE = 9600
+
+    # Line speeds tried with baudrate='auto', fastest first
+    BAUDRATES = (115200, 57600, 38400, 19200, 9600)
+
     START_STATION  = 240
     FINISH_STATION = 245
 
@@ -96,50 +121,110 @@ class Sportiduino(object):
             """
             return 'v%d.%d.x' % (self.major, self.minor)
 
-    def __init__(self, port=None, debug=False, logger=None):
+    def __init__(self, port=None, debug=False, logger=None, connect_timeout=5, capture=None,
+                 metrics=None, supervised=False, journal=None, dedup=None,
+                 baudrate=DEFAULT_BAUDRATE, timeout=5, write_timeout=None):
         """Initializes communication with master station at port.
-        @param port: Serial device for the connection. If port is None it
-                     scans all available ports and connects to the first
-                     reader found.
+        @param port:            Serial device for the connection. If port is
+                                None it probes all available ports at once
+                                and connects to the first reader found.
+        @param logger:          Logger for info and debug messages, e.g.
+                                logging.Logger. Debug messages are formatted
+                                only if its DEBUG level is enabled.
+        @param connect_timeout: Time in seconds to wait for master station
+                                startup after the port is opened.
+        @param capture:         WireCapture object to record raw traffic.
+        @param metrics:         Metrics object (default new one).
+        @param supervised:      Reconnect automatically when the port fails
+                                or only garbage is received (see _recover()).
+        @param journal:         Object with append(payload) method, e.g.
+                                sportiduino_journal.ReadoutJournal. Every
+                                card data payload is appended to it before
+                                decoding.
+        @param dedup:           ReadoutCache object to suppress repeated
+                                readouts of a card left on the station in
+                                poll_card() and wait_card().
+        @param baudrate:        Line speed, sequence of speeds to try in
+                                order or 'auto' to try BAUDRATES. A speed
+                                is used if master station answers version
+                                request at it, so firmware supporting a
+                                faster line is detected and older firmware
+                                falls back to 9600.
+        @param timeout:         Default timeout for reading response.
+        @param write_timeout:   Timeout for writing command (default block).
         """
         self._serial = None
+        self.metrics = metrics if metrics is not None else Metrics()
+        self._decoder = FrameDecoder(self.metrics)
+        self.version = None
+        self.capture = capture
+        self.journal = journal
+        self.dedup = dedup
+
+        self.supervised = supervised
+        # Give up recovery after this many seconds (default never)
+        self.recovery_timeout = None
+        self.last_recovery_time = None
+        self._connect_timeout = connect_timeout
+        self._baudrate = baudrate
+        self._timeout = timeout
+        self._write_timeout = write_timeout
+        self._debug = debug
+        self._logger = logger
+        self._continuous = False
+        self._bad_frames = 0
+        self._recovering = False
+        # Payloads of cards received while no card was expected: pushed in
+        # continuous mode during a command or received before port failure
+        self._pending_cards = deque()
 
         self._log_info = print_
         self._log_debug = lambda s: None
+        self._debug_enabled = lambda: debug
         if debug:
             self._log_debug = print_
 
         if logger is not None:
             if callable(logger.debug):
                 self._log_debug = logger.debug
+                self._debug_enabled = lambda: True
+                if callable(getattr(logger, 'isEnabledFor', None)):
+                    import logging
+                    self._debug_enabled = lambda: logger.isEnabledFor(logging.DEBUG)
             if callable(logger.info):
                 self._log_info = logger.info
 
-        errors = ''
         if port is not None:
-            self._connect_master_station(port)
+            self._connect_master_station(port, connect_timeout)
             return
-        else:
-            if platform.system() == 'Linux':
-                scan_ports = [os.path.join('/dev', f) for f in os.listdir('/dev') if
-                              re.match('ttyUSB.*', f)]
-            elif platform.system() == 'Windows':
-                scan_ports = ['COM' + str(i) for i in range(32)]
-            else:
-                raise SportiduinoException('Unsupported platform: %s' % platform.system())
-
-            if len(scan_ports) == 0:
-                errors = 'no serial ports found'
 
-            for port in scan_ports:
-                try:
-                    self._connect_master_station(port)
-                    return
-                except SportiduinoException as msg:
-                    errors += 'port %s: %s\n' % (port, msg)
+        stations, errors = Sportiduino._probe_ports(Sportiduino._scan_ports(), connect_timeout,
+                                                    first=True, debug=debug, logger=logger,
+                                                    baudrate=baudrate, timeout=timeout,
+                                                    write_timeout=write_timeout)
+        if stations:
+            self._take_over(stations[0])
+            return
 
         raise SportiduinoException('No Sportiduino master station found. Possible reasons: %s' % errors)
 
+
+    @staticmethod
+    def find_stations(ports=None, connect_timeout=5, debug=False, logger=None,
+                      baudrate=DEFAULT_BAUDRATE):
+        """Probe serial ports concurrently and connect to all master stations found.
+        @param ports:           Serial devices to probe (default all
+                                available ports).
+        @param connect_timeout: Time in seconds to wait for all stations.
+        @param baudrate:        Line speed or speeds to try (see __init__).
+        @return:                List of connected Sportiduino objects.
+        """
+        if ports is None:
+            ports = Sportiduino._scan_ports()
+        stations, errors = Sportiduino._probe_ports(ports, connect_timeout, debug=debug,
+                                                    logger=logger, baudrate=baudrate)
+        return stations
+
     def beep_ok(self):
         """One long beep and blink master station."""
         self._send_command(Sportiduino.CMD_BEEP_OK, wait_response=False)
@@ -158,14 +243,16 @@ class Sportiduino(object):
     def reconnect(self):
         """Close the serial port and reopen again."""
         self.disconnect()
-        self._connect_master_station(self._serial.port)
+        self.metrics.inc('reconnects')
+        self._connect_master_station(self._serial.port, self._connect_timeout)
 
 
-    def read_version(self):
+    def read_version(self, timeout=None):
         """Read master station firmware version.
-        @return: Version object.
+        @param timeout: Timeout for reading response (see pyserial doc).
+        @return:        Version object.
         """
-        code, data = self._send_command(Sportiduino.CMD_READ_VERS)
+        code, data = self._send_command(Sportiduino.CMD_READ_VERS, timeout=timeout)
         if code == Sportiduino.RESP_VERS:
             return Sportiduino.Version(byte2int(data))
         return None
@@ -178,17 +265,41 @@ class Sportiduino(object):
         """
         code, data = self._send_command(Sportiduino.CMD_READ_CARD, timeout=timeout)
         if code == Sportiduino.RESP_CARD_DATA:
-            return self._parse_card_data(data)
+            record = CardRecord(data)
+            self._journal_card(data)
+            return record.to_dict()
+        else:
+            raise SportiduinoException("Read card failed.")
+
+
+    def read_card_record(self, timeout=None):
+        """Reads out the card currently inserted into the station.
+        Unlike read_card() card data is not decoded until accessed.
+        @param timeout: Timeout for reading response (see pyserial doc).
+        @return:        CardRecord object.
+        """
+        code, data = self._send_command(Sportiduino.CMD_READ_CARD, timeout=timeout)
+        if code == Sportiduino.RESP_CARD_DATA:
+            record = CardRecord(data)
+            self._journal_card(data)
+            return record
         else:
             raise SportiduinoException("Read card failed.")
 
 
     def poll_card(self):
         """Poll card inserted into the station.
-        If card readed update self.card_data and return True.
+        If card readed update self.card_data and return True. Repeated
+        readouts of the same card are ignored if dedup is set.
         @return: Read card status."""
         try:
-            self.card_data = self.read_card(timeout=0.5)
+            code, data = self._send_command(Sportiduino.CMD_READ_CARD, timeout=0.5)
+            if code != Sportiduino.RESP_CARD_DATA:
+                raise SportiduinoException("Read card failed.")
+            record = CardRecord(data)
+            if not self._accept_card(data):
+                return False
+            self.card_data = record.to_dict()
             return True
         except SportiduinoTimeout:
             pass
@@ -197,6 +308,93 @@ class Sportiduino(object):
         return False
 
 
+    def wait_card(self, timeout=None):
+        """Wait for card pushed by the station in continuous read mode.
+        No command is sent to the station.
+        @param timeout: Timeout for reading response (see pyserial doc).
+        Repeated readouts of the same card are skipped if dedup is set.
+        @return:        Card data in dictionary or None if timeout expired.
+        """
+        record = self.wait_card_record(timeout)
+        if record is None:
+            return None
+        self.card_data = record.to_dict()
+        return self.card_data
+
+
+    def wait_card_record(self, timeout=None):
+        """Wait for card pushed by the station in continuous read mode.
+        Unlike wait_card() card data is not decoded until accessed.
+        @param timeout: Timeout for reading response (see pyserial doc).
+        @return:        CardRecord object or None if timeout expired.
+        """
+        while True:
+            if self._pending_cards:
+                return CardRecord(self._pending_cards.popleft())
+            try:
+                code, data = self._read_response(timeout=timeout)
+            except SportiduinoTimeout:
+                return None
+            except SportiduinoPortError:
+                if not self.supervised or self._recovering:
+                    raise
+                self._recover()
+                continue
+
+            if code == Sportiduino.RESP_CARD_DATA:
+                record = CardRecord(data)
+                if not self._accept_card(data):
+                    continue
+                return record
+            # Skip other responses, e.g. mode confirmation
+            Sportiduino._preprocess_response(code, data, self._log_debug)
+
+
+    def iter_cards(self, timeout=None):
+        """Enable continuous card read and yield cards pushed by the station.
+        No commands are sent while waiting for cards. Commands may be sent
+        between cards, cards pushed meanwhile are yielded later. Continuous
+        read is disabled again when the generator is closed.
+        @param timeout: Stop iteration after this many seconds without
+                        a card (default wait forever).
+        @return:        Generator of card data dictionaries.
+        @raise SportiduinoPortError: Port failed and was not recovered.
+        """
+        self.enable_continuous_read()
+        try:
+            last_card = time.time()
+            while True:
+                try:
+                    card_data = self.wait_card(timeout=timeout)
+                except SportiduinoPortError:
+                    raise
+                except SportiduinoException as msg:
+                    # Corrupted frame, keep waiting
+                    self._log_debug("Warning: %s" % msg)
+                    card_data = None
+
+                if card_data is not None:
+                    yield card_data
+                    last_card = time.time()
+                elif timeout is not None and time.time() - last_card >= timeout:
+                    return
+        finally:
+            try:
+                self.disable_continuous_read()
+            except SportiduinoException:
+                pass
+
+
+    def listen(self, callback, timeout=None):
+        """Read cards in continuous mode and pass each one to callback.
+        @param callback: Function called with card data dictionary.
+        @param timeout:  Return after this many seconds without a card
+                         (default listen forever).
+        """
+        for card_data in self.iter_cards(timeout=timeout):
+            callback(card_data)
+
+
     def read_card_raw(self):
         """Reads out the RAW data from card currently inserted into the station.
         @return: RAW card data in dictionary.
@@ -219,27 +417,116 @@ class Sportiduino(object):
             raise SportiduinoException("Read backup failed.")
 
 
+    def read_backup_raw(self):
+        """Read backup from backupreader card without decoding.
+        @return: Backup payload byte string (see sportiduino_backup).
+        """
+        code, data = self._send_command(Sportiduino.CMD_READ_BACKUPREADER)
+        if code == Sportiduino.RESP_BACKUP:
+            return data
+        else:
+            raise SportiduinoException("Read backup failed.")
+
+
     def init_card(self, card_number, page6=None, page7=None):
         """Initialize card. Set card number, init time and additional pages.
         @param card_number: Card number (eg participant bib).
         @param page6:       Additional page.
         @param page7:       Additional page.
         """
-        #TODO: check page6 and page7 length
-        if page6 is None:
-            page6 = b'\x00\x00\x00\x00'
-        if page7 is None:
-            page7 = b'\x00\x00\x00\x00'
-
-        params = b''
-        params += Sportiduino._to_str(card_number, 2)
-        t = int(time.time())
-        params += Sportiduino._to_str(t, 4)
-        params += page6[:5]
-        params += page7[:5]
+        params = Sportiduino._init_card_params(card_number, page6, page7)
         self._send_command(Sportiduino.CMD_INIT_CARD, params, wait_response=False)
 
 
+    def bulk_init_cards(self, card_numbers, page6=None, page7=None, retries=3, verify=False,
+                        card_timeout=None, timeout=None):
+        """Initialize cards one by one as they are presented to the station.
+        Each write waits for RESP_OK. Card write errors are retried, then the
+        card is checked with read_card() if verify is set. The next number is
+        written after the card is removed.
+        @param card_numbers: Card numbers to write.
+        @param page6:        Additional page for all cards.
+        @param page7:        Additional page for all cards.
+        @param retries:      Number of retries on card write error or
+                             timeout.
+        @param verify:       Read card back and check its number and pages.
+        @param card_timeout: Time in seconds to wait for each card (default
+                             wait forever). Number is reported as failed
+                             when it expires.
+        @param timeout:      Timeout for reading response (see pyserial doc).
+        @return:             Generator of progress dictionaries with keys
+                             'card_number', 'ok', 'attempts', 'error',
+                             'done', 'failed' and 'cards_per_minute'.
+        """
+        started = time.time()
+        done = 0
+        failed = 0
+        for card_number in card_numbers:
+            deadline = time.time() + card_timeout if card_timeout is not None else None
+            attempts = 0
+            error = None
+            while True:
+                if deadline is not None and time.time() > deadline:
+                    error = 'No card'
+                    break
+
+                self._send_command(Sportiduino.CMD_INIT_CARD,
+                                   Sportiduino._init_card_params(card_number, page6, page7),
+                                   wait_response=False)
+                try:
+                    code, data = self._read_reply(Sportiduino.CMD_INIT_CARD, timeout)
+                except SportiduinoTimeout:
+                    # Silent station, do not flood the link
+                    attempts += 1
+                    error = 'No response'
+                    if attempts > retries:
+                        break
+                    time.sleep(Sportiduino.PROBE_INTERVAL)
+                    continue
+                except SportiduinoException as msg:
+                    code, data = Sportiduino.RESP_ERROR, Sportiduino.ERR_COM
+                    self._log_debug("Warning: %s" % msg)
+
+                attempts += 1
+                if code == Sportiduino.RESP_OK:
+                    error = None
+                    if verify:
+                        error = self._verify_card(card_number, page6, page7, timeout)
+                    if error is None:
+                        break
+                elif code == Sportiduino.RESP_ERROR and data == Sportiduino.ERR_READ_CARD:
+                    # Card is not presented yet
+                    attempts -= 1
+                    time.sleep(Sportiduino.PROBE_INTERVAL)
+                    continue
+                else:
+                    try:
+                        Sportiduino._preprocess_response(code, data, self._log_debug)
+                        error = "Unexpected response '%s'" % hex(byte2int(code))
+                    except SportiduinoException as msg:
+                        error = str(msg)
+
+                if attempts > retries:
+                    break
+
+            if error is None:
+                done += 1
+                self._wait_card_removed(card_number, deadline)
+            else:
+                failed += 1
+
+            elapsed = time.time() - started
+            yield {
+                'card_number': card_number,
+                'ok': error is None,
+                'attempts': attempts,
+                'error': error,
+                'done': done,
+                'failed': failed,
+                'cards_per_minute': done*60.0/elapsed if elapsed > 0 else 0.0,
+            }
+
+
     def init_backupreader(self):
         """Initialize backupreader card."""
         self._send_command(Sportiduino.CMD_INIT_BACKUPREADER, wait_response=False)
@@ -258,17 +545,13 @@ class Sportiduino(object):
         self._send_command(Sportiduino.CMD_INIT_CP_NUM_CARD, params, wait_response=False)
 
 
-    def init_time_card(self, time=datetime.today()):
+    def init_time_card(self, time=None):
         """Initialize card for writing time to base station.
         @param time: Time for base station (default current time).
         """
-        params = b''
-        params += int2byte(time.year - 2000)
-        params += int2byte(time.month)
-        params += int2byte(time.day)
-        params += int2byte(time.hour)
-        params += int2byte(time.minute)
-        params += int2byte(time.second)
+        if time is None:
+            time = datetime.today()
+        params = Sportiduino._time_card_params(time)
         self._send_command(Sportiduino.CMD_INIT_TIMECARD, params, wait_response=False)
 
 
@@ -278,21 +561,32 @@ class Sportiduino(object):
         @param new_passwd: New password (default 0x000000).
         @param flags:      Flags byte (default 0x00).
         """
-        params = b''
-        params += Sportiduino._to_str(new_passwd, 3)
-        params += Sportiduino._to_str(old_passwd, 3)
-        params += Sportiduino._to_str(flags, 1)
+        params = Sportiduino._passwd_card_params(old_passwd, new_passwd, flags)
         self._send_command(Sportiduino.CMD_INIT_PASSWDCARD, params, wait_response=False)
 
 
     def write_pages6_7(self, page6, page7):
         """Write additional pages."""
-        params = b''
-        params += page6[:5]
-        params += page7[:5]
+        params = Sportiduino._pages6_7_params(page6, page7)
         self._send_command(Sportiduino.CMD_WRITE_PAGES6_7, params, wait_response=False)
 
 
+    def batch(self, timeout=None):
+        """Start batch of pipelined commands.
+        Commands are queued by methods of the returned CommandBatch and sent
+        when the with block exits:
+
+            with sportiduino.batch() as batch:
+                version = batch.read_version()
+                batch.beep_ok()
+            print(version.result())
+
+        @param timeout: Timeout for reading each response (see pyserial doc).
+        @return:        CommandBatch object.
+        """
+        return CommandBatch(self, timeout)
+
+
     def enable_continuous_read(self):
         """Enable continuous card read."""
         self._set_mode(b'\x01')
@@ -305,101 +599,429 @@ class Sportiduino(object):
 
     def _set_mode(self, mode):
         """Set master station read mode."""
+        # Input is not flushed while continuous mode is on, so cards pushed
+        # before the mode is disabled are kept
         self._send_command(Sportiduino.CMD_SET_READ_MODE, mode, wait_response=False)
+        # Remember mode to restore it after reconnection
+        self._continuous = mode == b'\x01'
+
 
+    def _journal_card(self, data):
+        """Save card data payload to journal if it is set."""
+        if self.journal is not None:
+            self.journal.append(data)
 
-    def _connect_master_station(self, port):
+
+    def _queue_card(self, data):
+        """Keep card received while waiting for other response for wait_card()."""
         try:
-            self._serial = Serial(port, baudrate=9600, timeout=5)
-            # Master station reset on serial open.
-            # Wait little time for it startup
-            time.sleep(2)
-        except (SerialException, OSError):
-            raise SportiduinoException("Could not open port '%s'" % port)
+            CardRecord(data)
+        except SportiduinoException as msg:
+            self._log_debug("Warning: %s" % msg)
+            return
+        if self._accept_card(data):
+            self._pending_cards.append(bytes(data))
+
+
+    def _take_decoded_cards(self):
+        """Queue cards from frames already decoded, drop other frames."""
+        while True:
+            try:
+                frame = self._decoder.next_frame()
+            except SportiduinoException:
+                continue
+            if frame is None:
+                return
+            code, data = frame
+            if code == Sportiduino.RESP_CARD_DATA:
+                self._queue_card(data)
+            elif self._debug_enabled():
+                self._log_debug("Dropped response '%s'" % hex(byte2int(code)))
+
+
+    def _accept_card(self, data):
+        """Filter card pushed or polled from the station through dedup cache.
+        @return: False if card data is a repeated readout.
+        """
+        if self.dedup is not None and not self.dedup.check(data):
+            return False
+        self._journal_card(data)
+        return True
+
+
+    def _verify_card(self, card_number, page6, page7, timeout=None):
+        """Read card back after initialization.
+        @return: Error string or None if card is written correctly.
+        """
+        try:
+            card_data = self.read_card(timeout=timeout)
+        except SportiduinoException as msg:
+            return 'Verify failed: %s' % msg
+        if card_data['card_number'] != card_number:
+            return 'Verify failed: card number %d' % card_data['card_number']
+        if page6 is not None and card_data['page6'] != page6[:4]:
+            return 'Verify failed: page6'
+        if page7 is not None and card_data['page7'] != page7[:4]:
+            return 'Verify failed: page7'
+        return None
+
+
+    def _wait_card_removed(self, card_number, deadline=None):
+        """Wait until card with card_number is taken from the station."""
+        while deadline is None or time.time() < deadline:
+            try:
+                card_data = self.read_card(timeout=Sportiduino.PROBE_INTERVAL)
+            except SportiduinoException:
+                return
+            if card_data['card_number'] != card_number:
+                return
+            time.sleep(Sportiduino.PROBE_INTERVAL)
+
+
+    def _connect_master_station(self, port, timeout=5):
+        """Connect at the first line speed master station answers at.
+        The port is opened once, as opening resets master station, and
+        the speeds are tried in turn on it until timeout expires.
+        """
+        baudrates = self._baudrate
+        if baudrates == 'auto':
+            baudrates = Sportiduino.BAUDRATES
+        elif not isinstance(baudrates, (tuple, list)):
+            baudrates = (baudrates,)
+
+        deadline = time.time() + timeout
+        self._open(port, baudrates[0])
+
+        # Master station reset on serial open.
+        # Repeat version request until it startup.
+        self.version = None
+        attempt = 0
+        while self.version is None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self._serial.close()
+                raise SportiduinoTimeout("No response from port '%s'" % port)
+            baudrate = baudrates[attempt % len(baudrates)]
+            attempt += 1
+            received = self.metrics.counters['bytes_received']
+            try:
+                if self._serial.baudrate != baudrate:
+                    self._serial.baudrate = baudrate
+                self.version = self.read_version(timeout=min(Sportiduino.PROBE_INTERVAL, remaining))
+            except _PORT_ERRORS as msg:
+                self._log_debug("Warning: %s" % msg)
+            except SportiduinoException:
+                pass
+            if self.version is None and self.metrics.counters['bytes_received'] > received:
+                self._log_debug("Warning: line speed mismatch at %d baud" % baudrate)
+
+        self.baudrate = self._serial.baudrate
+        self._log_info("Master station %s on port '%s' connected" % (self.version, port))
+
+
+    def _open(self, port, baudrate):
+        """Open port."""
+        # pyserial is needed for connection only, protocol functions work
+        # without it
+        from serial import Serial
 
         try:
-            self._serial.reset_input_buffer()
-        except (SerialException, OSError):
-            raise SportiduinoException("Could not flush port '%s'" % port)
+            self._serial = Serial(port, baudrate=baudrate, timeout=self._timeout,
+                                  write_timeout=self._write_timeout)
+        except _PORT_ERRORS:
+            raise SportiduinoException("Could not open port '%s'" % port)
 
         self.port = port
         self.baudrate = self._serial.baudrate
-        version = self.read_version()
-        if version is not None:
-            self._log_info("Master station %s on port '%s' connected" % (version, port))
+        self._decoder.reset()
+
+
+    def _take_over(self, station):
+        """Take over connection of other Sportiduino object."""
+        self._serial, station._serial = station._serial, None
+        self._decoder.feed(station._decoder._buffer)
+        self.metrics.merge(station.metrics)
+        self.port = station.port
+        self.baudrate = station.baudrate
+        self.version = station.version
+
+
+    def _recover(self):
+        """Reconnect after port failure.
+        The port is reopened with growing delay between attempts. If the
+        device has disappeared, e.g. it is enumerated under another name
+        after USB reset, all ports are probed. Cards received completely
+        before the failure are kept for wait_card() and continuous read
+        mode is restored. Recovery time is saved in last_recovery_time and
+        metrics.
+        @raise SportiduinoPortError: Not recovered in recovery_timeout.
+        """
+        started = time.time()
+        self._log_info("Master station on port '%s' lost, reconnecting" % self.port)
+
+        # Save cards from bytes received before the failure
+        self._take_decoded_cards()
+
+        try:
+            self._serial.close()
+        except _PORT_ERRORS:
+            pass
+
+        self._recovering = True
+        try:
+            delay = Sportiduino.RECONNECT_DELAY
+            while not self._reopen():
+                if self.recovery_timeout is not None and time.time() + delay - started > self.recovery_timeout:
+                    raise SportiduinoPortError("Master station on port '%s' is not recovered" % self.port)
+                time.sleep(delay)
+                delay = min(delay*2, Sportiduino.RECONNECT_MAX_DELAY)
+
+            self._bad_frames = 0
+            if self._continuous:
+                self._set_mode(b'\x01')
+        finally:
+            self._recovering = False
+
+        self.last_recovery_time = time.time() - started
+        self.metrics.inc('reconnects')
+        self.metrics.observe_recovery(self.last_recovery_time)
+        self._log_info("Master station on port '%s' recovered in %.2f s" % (self.port, self.last_recovery_time))
+
+
+    def _reopen(self):
+        """Try to connect once to the same or re-enumerated station.
+        @return: True if connected.
+        """
+        import platform
+        if platform.system() == 'Windows' or os.path.exists(self.port):
+            try:
+                self._connect_master_station(self.port, self._connect_timeout)
+                return True
+            except SportiduinoException as msg:
+                self._log_debug("Warning: %s" % msg)
+                return False
+
+        stations, errors = Sportiduino._probe_ports(Sportiduino._scan_ports(), self._connect_timeout,
+                                                    first=True, debug=self._debug, logger=self._logger,
+                                                    baudrate=self._baudrate, timeout=self._timeout,
+                                                    write_timeout=self._write_timeout)
+        if stations:
+            self._take_over(stations[0])
+            return True
+        return False
+
+
+    def _check_open(self):
+        # pyserial fails with TypeError on a port closed after failed recovery
+        if not self._serial.is_open:
+            raise SportiduinoPortError("Port '%s' is closed" % self.port)
+
+
+    def _flush_input(self):
+        """Drop stale input before a command.
+        In continuous read mode input is not dropped, cards pushed by the
+        station are queued for wait_card().
+        """
+        self._check_open()
+        try:
+            if not self._continuous:
+                self._serial.flushInput()
+                self._decoder.reset()
+                return
+            waiting = self._serial.in_waiting
+            chunk = self._serial.read(waiting) if waiting else b''
+        except _PORT_ERRORS as msg:
+            raise SportiduinoPortError('Error flushing port: %s' % msg)
+        if chunk:
+            self._received(chunk)
+        self._take_decoded_cards()
 
 
     def _send_command(self, code, parameters=None, wait_response=True, timeout=None):
-        if parameters is None:
-            parameters = b''
-        data_len = len(parameters)
-        if data_len > Sportiduino.MAX_DATA_LEN:
-            raise SportiduinoException("Command too long: %d" % data_len)
-        cmd_string = code + int2byte(data_len) + parameters
+        try:
+            return self._send_command_once(code, parameters, wait_response, timeout)
+        except SportiduinoPortError:
+            if not self.supervised or self._recovering:
+                raise
+            self._recover()
+            return self._send_command_once(code, parameters, wait_response, timeout)
 
-        cs = self._checsum(cmd_string)
-        cmd = Sportiduino.START_BYTE + cmd_string + cs
 
-        self._log_debug("=> %s" % ' '.join(hex(byte2int(c)) for c in cmd))
+    def _send_command_once(self, code, parameters=None, wait_response=True, timeout=None):
+        cmd = Sportiduino._make_command(code, parameters)
 
-        self._serial.flushInput()
-        self._serial.write(cmd)
+        self._flush_input()
+        sent = time.time()
+        self._write(cmd)
 
         if wait_response:
-            resp_code, data = self._read_response(timeout)
+            resp_code, data = self._read_reply(code, timeout)
+            self.metrics.observe(code, time.time() - sent)
+            if resp_code == Sportiduino.RESP_ERROR:
+                self.metrics.inc('error_responses')
             return Sportiduino._preprocess_response(resp_code, data, self._log_debug)
 
         return None
 
 
-    def _read_response(self, timeout=None, wait_fragment=None):
+    def _send_batch(self, commands, timeout=None):
+        """Send commands without waiting for each response.
+        Consecutive commands are merged into one write while responses
+        expected for them fit into master station receive buffer.
+        @param commands: List of (command frame, expected response code or
+                         None for fire-and-forget, BatchResult) tuples.
+        """
+        self._flush_input()
+
+        # Commands waiting for response:
+        # (frame length, command code, send time, expected response, result)
+        in_flight = deque()
+        in_flight_len = 0
+        i = 0
+        while i < len(commands) or in_flight:
+            out = b''
+            frames = 0
+            while i < len(commands):
+                cmd, response, result = commands[i]
+                if (in_flight or out) and in_flight_len + len(out) + len(cmd) > Sportiduino.RX_BUFFER_LEN:
+                    break
+                out += cmd
+                frames += 1
+                i += 1
+                if response is None:
+                    result._set_response(None, b'')
+                else:
+                    in_flight.append((len(cmd), cmd[1:2], time.time(), response, result))
+                    in_flight_len += len(cmd)
+
+            if out:
+                self._write(out, frames)
+
+            if not in_flight:
+                continue
+
+            try:
+                code, data = self._read_response(timeout)
+            except SportiduinoTimeout as msg:
+                # Station is silent, none of the sent commands is answered
+                self.metrics.inc('timeouts')
+                for _, _, _, _, result in in_flight:
+                    result._set_error(msg)
+                in_flight.clear()
+                in_flight_len = 0
+                continue
+            except SportiduinoException as msg:
+                cmd_len, _, _, _, result = in_flight.popleft()
+                in_flight_len -= cmd_len
+                result._set_error(msg)
+                continue
+
+            # Station answers commands in order, so the response belongs to
+            # the oldest command waiting for this code. Error belongs to the
+            # oldest command at all.
+            for index, (_, _, _, response, _) in enumerate(in_flight):
+                if code == response or code == Sportiduino.RESP_ERROR:
+                    break
+            else:
+                if code == Sportiduino.RESP_CARD_DATA and self._continuous:
+                    self._queue_card(data)
+                elif self._debug_enabled():
+                    self._log_debug("Unexpected response '%s'" % hex(byte2int(code)))
+                continue
+
+            for _ in range(index):
+                cmd_len, _, _, _, result = in_flight.popleft()
+                in_flight_len -= cmd_len
+                result._set_error(SportiduinoException('No response'))
+            cmd_len, cmd_code, sent, _, result = in_flight.popleft()
+            in_flight_len -= cmd_len
+            self.metrics.observe(cmd_code, time.time() - sent)
+            if code == Sportiduino.RESP_ERROR:
+                self.metrics.inc('error_responses')
+            result._set_response(code, data)
+
+
+    def _write(self, data, frames=1):
+        self.metrics.inc('frames_sent', frames)
+        self.metrics.inc('bytes_sent', len(data))
+        if self._debug_enabled():
+            self._log_debug("=> %s" % Sportiduino._hex(data))
+        if self.capture is not None:
+            self.capture.write(WireCapture.TX, data)
+        self._check_open()
+        try:
+            self._serial.write(data)
+        except _PORT_ERRORS as msg:
+            raise SportiduinoPortError('Error writing command: %s' % msg)
+
+
+    def _read_reply(self, code, timeout=None):
+        """Read response to command. Cards pushed in continuous read mode
+        meanwhile are queued for wait_card().
+        @param code: Command code.
+        """
+        while True:
+            try:
+                resp_code, data = self._read_response(timeout)
+            except SportiduinoTimeout:
+                # Counted here, so idle waits for pushed cards are not
+                # timeouts
+                self.metrics.inc('timeouts')
+                raise
+            if (resp_code != Sportiduino.RESP_CARD_DATA or not self._continuous
+                    or code == Sportiduino.CMD_READ_CARD):
+                return resp_code, data
+            self._queue_card(data)
+
+
+    def _received(self, chunk):
+        self.metrics.inc('bytes_received', len(chunk))
+        if self.capture is not None:
+            self.capture.write(WireCapture.RX, chunk)
+        self._decoder.feed(chunk)
+
+
+    def _read_response(self, timeout=None):
+        self._check_open()
+        restore_timeout = False
         try:
             if timeout is not None:
                 old_timeout = self._serial.timeout
                 self._serial.timeout = timeout
+                restore_timeout = True
 
-            # Skip any bytes before START_BYTE
             while True:
-                byte = self._serial.read()
-                if byte == b'':
-                    raise SportiduinoTimeout('No response')
-                elif byte == Sportiduino.START_BYTE:
+                try:
+                    frame = self._decoder.next_frame()
+                except SportiduinoException:
+                    # Too much garbage means broken link or wrong device
+                    self._bad_frames += 1
+                    if self.supervised and self._bad_frames >= Sportiduino.MAX_BAD_FRAMES:
+                        raise SportiduinoPortError('Too many bad frames')
+                    raise
+                if frame is not None:
+                    self._bad_frames = 0
                     break
-
-            if timeout is not None:
-                self._serial.timeout = old_timeout 
-
-            code = self._serial.read()
-            length_byte = self._serial.read()
-            length = byte2int(length_byte)
-
-            more_fragments = False
-            if length >= Sportiduino.OFFSET:
-                more_fragments = True
-                fragment_num = length - Sportiduino.OFFSET
-                if fragment_num > 0 and (wait_fragment is not None):
-                    if fragment_num != wait_fragment:
-                        raise SportiduinoException('Waiting fragment %d, receive %d' % (wait_fragment, fragment_num))
-                length = Sportiduino.MAX_DATA_LEN
-            data = self._serial.read(length)
-            checksum = self._serial.read()
-            self._log_debug("<= code '%s', len %i, data %s, cs %s" % (hex(byte2int(code)),
-                                                                      length,
-                                                                      ' '.join(hex(byte2int(c)) for c in data),
-                                                                      hex(byte2int(checksum))
-                                                                     ))
-
-            if not Sportiduino._cs_check(code + length_byte + data, checksum):
-                raise SportiduinoException('Checksum mismatch')
-
-        except (SerialException, OSError) as msg:
-            raise SportiduinoException('Error reading response: %s' % msg)
-
-        if more_fragments:
-            next_code, next_data = self._read_response(timeout, fragment_num + 1)
-            if next_code == code:
-                data += next_data
-
+                # Take everything the port already has in one read, or block
+                # for the first byte of the response
+                chunk = self._serial.read(self._serial.in_waiting or 1)
+                if not chunk:
+                    raise SportiduinoTimeout('No response')
+                self._received(chunk)
+        except _PORT_ERRORS as msg:
+            raise SportiduinoPortError('Error reading response: %s' % msg)
+        finally:
+            if restore_timeout:
+                try:
+                    self._serial.timeout = old_timeout
+                except _PORT_ERRORS:
+                    pass
+
+        code, data = frame
+        if self._debug_enabled():
+            self._log_debug("<= code '%s', len %i, data %s" % (hex(byte2int(code)),
+                                                               len(data),
+                                                               Sportiduino._hex(data)))
         return code, data
 
 
@@ -408,13 +1030,100 @@ class Sportiduino(object):
             self._serial.close()
 
 
+    @staticmethod
+    def _scan_ports():
+        """List serial devices where master station can be connected."""
+        # Imported here to keep module import fast
+        import platform
+        import re
+
+        if platform.system() == 'Linux':
+            ports = []
+            devices = set()
+            by_id = '/dev/serial/by-id'
+            # Prefer persistent names, skip devices they link to
+            if os.path.isdir(by_id):
+                for f in sorted(os.listdir(by_id)):
+                    port = os.path.join(by_id, f)
+                    ports.append(port)
+                    devices.add(os.path.realpath(port))
+            for f in sorted(os.listdir('/dev')):
+                port = os.path.join('/dev', f)
+                if re.match('tty(USB|ACM).*', f) and port not in devices:
+                    ports.append(port)
+            return ports
+        elif platform.system() == 'Windows':
+            return ['COM' + str(i) for i in range(32)]
+        else:
+            raise SportiduinoException('Unsupported platform: %s' % platform.system())
+
+
+    @staticmethod
+    def _probe_ports(ports, connect_timeout, first=False, **options):
+        """Connect to master stations on all ports in parallel threads.
+        @param ports:           Serial devices.
+        @param connect_timeout: Time in seconds to wait for stations.
+        @param first:           Return as soon as first station is
+                                connected. Other stations found later are
+                                disconnected.
+        @param options:         Other Sportiduino arguments, e.g. debug and
+                                logger.
+        @return:                Tuple (list of Sportiduino objects, errors
+                                string).
+        """
+        if len(ports) == 0:
+            return [], 'no serial ports found'
+
+        lock = threading.Lock()
+        done = threading.Event()
+        stations = []
+        errors = []
+        pending = [len(ports)]
+        # Set when result is returned, stations connected later are dropped
+        closed = []
+
+        def probe(port):
+            try:
+                station = Sportiduino(port, connect_timeout=connect_timeout, **options)
+                with lock:
+                    if closed or (first and stations):
+                        station.disconnect()
+                        return
+                    stations.append(station)
+                    if first:
+                        done.set()
+            except SportiduinoException as msg:
+                with lock:
+                    errors.append('port %s: %s\n' % (port, msg))
+            finally:
+                with lock:
+                    pending[0] -= 1
+                    if pending[0] == 0:
+                        done.set()
+
+        for port in ports:
+            thread = threading.Thread(target=probe, args=(port,))
+            thread.daemon = True
+            thread.start()
+
+        # Wait for first station or for all probes
+        done.wait(connect_timeout)
+
+        with lock:
+            closed.append(True)
+            return list(stations), ''.join(errors)
+
+
+    @staticmethod
+    def _hex(data):
+        """Format bytes for debug messages."""
+        return ' '.join(hex(c) for c in bytearray(data))
+
+
     @staticmethod
     def _to_int(s):
         """Compute the integer value of a raw byte string (big endianes)."""
-        value = 0
-        for offset, c in enumerate(iterbytes(s[::-1])):
-            value += c << offset*8
-        return value
+        return to_int(s)
 
 
     @staticmethod
@@ -424,14 +1133,63 @@ class Sportiduino(object):
         @param len: Length of the return value. If i does not fit OverflowError is raised.
         @return:    string representation of i (MSB first)
         """
-        if PY3:
-            return i.to_bytes(len, 'big')
-        if i >> len*8 != 0:
-            raise OverflowError('%i too big to convert to %i bytes' % (i, len))
-        string = b''
-        for offset in range(len-1, -1, -1):
-            string += int2byte((i >> offset*8) & 0xff)
-        return string
+        return to_bytes(i, len)
+
+
+    @staticmethod
+    def _make_command(code, parameters=None):
+        """Build command frame.
+        @param code:       Command code.
+        @param parameters: Command parameters byte string.
+        @return:           Frame with start byte, length and checksum.
+        """
+        if parameters is None:
+            parameters = b''
+        data_len = len(parameters)
+        if data_len > Sportiduino.MAX_DATA_LEN:
+            raise SportiduinoException("Command too long: %d" % data_len)
+        cmd_string = code + int2byte(data_len) + parameters
+        return Sportiduino.START_BYTE + cmd_string + int2byte(checksum(cmd_string))
+
+
+    @staticmethod
+    def _init_card_params(card_number, page6=None, page7=None):
+        #TODO: check page6 and page7 length
+        if page6 is None:
+            page6 = b'\x00\x00\x00\x00'
+        if page7 is None:
+            page7 = b'\x00\x00\x00\x00'
+
+        params = b''
+        params += Sportiduino._to_str(card_number, 2)
+        t = int(time.time())
+        params += Sportiduino._to_str(t, 4)
+        params += page6[:5]
+        params += page7[:5]
+        return params
+
+
+    @staticmethod
+    def _time_card_params(time):
+        return struct.pack('>6B', time.year - 2000, time.month, time.day,
+                           time.hour, time.minute, time.second)
+
+
+    @staticmethod
+    def _passwd_card_params(old_passwd, new_passwd, flags):
+        params = b''
+        params += Sportiduino._to_str(new_passwd, 3)
+        params += Sportiduino._to_str(old_passwd, 3)
+        params += Sportiduino._to_str(flags, 1)
+        return params
+
+
+    @staticmethod
+    def _pages6_7_params(page6, page7):
+        params = b''
+        params += page6[:5]
+        params += page7[:5]
+        return params
 
 
     @staticmethod
@@ -457,61 +1215,825 @@ class Sportiduino(object):
         """Compute checksum of value.
         @param s: byte string
         """
-        sum = 0
-        for c in s:
-            sum += byte2int(c)
-        sum &= 0xff
-        return int2byte(sum)
+        return int2byte(checksum(s))
 
 
     @staticmethod
-    def _cs_check(s, checksum):
-        return Sportiduino._checsum(s) == checksum
+    def _cs_check(s, cs):
+        return checksum(s) == byte2int(cs)
 
  
     @staticmethod
     def _parse_card_data(data):
-        # TODO check data length
-        ret = {}
-        ret['card_number'] = Sportiduino._to_int(data[0:2])
-        ret['page6'] = data[2:6]
-        ret['page7'] = data[6:10]
-        ret['punches'] = []
-        for i in range(10, len(data), 5):
-            cp = byte2int(data[i])
-            time = datetime.fromtimestamp(Sportiduino._to_int(data[i + 1:i + 5]))
-            if cp == Sportiduino.START_STATION:
-                ret['start'] = time
-            elif cp == Sportiduino.FINISH_STATION:
-                ret['finish'] = time
-            else:
-                ret['punches'].append((cp, time))
-
-        return ret
+        return CardRecord(data).to_dict()
 
 
     @staticmethod
     def _parse_card_raw_data(data):
         ret = {}
         for i in range(0, len(data), 5):
-            page_num = byte2int(data[i])
-            ret[page_num] = data[i + 1:i + 5]
-
+            ret[byte2int(data[i:i + 1])] = data[i + 1:i + 5]
         return ret
 
 
     @staticmethod
     def _parse_backup(data):
+        words = struct.unpack_from('>%dH' % (len(data) // 2), data)
         ret = {}
-        cp = Sportiduino._to_int(data[0:2])
-        ret['cp'] = cp
-        ret['cards'] = []
-        for i in range(2, len(data), 2):
-            ret['cards'].append(Sportiduino._to_int(data[i:i + 2]))
-        
+        ret['cp'] = words[0] if words else 0
+        ret['cards'] = list(words[1:])
         return ret
 
 
+class Metrics(object):
+    """Counters and latency histograms of master station communication.
+
+    Counters are listed in COUNTERS. Latency from command write to its
+    response is collected per command in histograms with BUCKETS upper
+    bounds in seconds. Optional hook is called with (name, value) on every
+    counter increment and with ('latency', (command name, seconds)) on every
+    response, e.g. to forward values to another metrics system.
+    """
+
+    COUNTERS = (
+        ('frames_sent', 'Command frames written'),
+        ('bytes_sent', 'Bytes written'),
+        ('frames_received', 'Response frames received including fragments'),
+        ('fragments_received', 'Fragments of long responses received'),
+        ('bytes_received', 'Bytes read'),
+        ('checksum_errors', 'Response frames with checksum mismatch'),
+        ('resyncs', 'Times garbage was skipped before START_BYTE'),
+        ('bytes_skipped', 'Bytes skipped before START_BYTE'),
+        ('timeouts', 'Response timeouts'),
+        ('error_responses', 'RESP_ERROR responses'),
+        ('reconnects', 'Port reconnections'),
+    )
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    # Command code -> name, filled on first use
+    _command_names = None
+
+    def __init__(self, hook=None):
+        """Initializes zero metrics.
+        @param hook: Function called with (name, value) on every update.
+        """
+        self.hook = hook
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Set all metrics to zero."""
+        with self._lock:
+            self.counters = dict((name, 0) for name, _ in Metrics.COUNTERS)
+            # Command name -> [count per bucket..., count above buckets, sum]
+            self.latency = {}
+            # Recovery count, total and maximum time
+            self.recovery = [0, 0.0, 0.0]
+
+    def inc(self, name, value=1):
+        """Increment counter.
+        @param name:  Counter name from COUNTERS.
+        @param value: Increment.
+        """
+        with self._lock:
+            self.counters[name] += value
+        if self.hook is not None:
+            self.hook(name, value)
+
+    def observe(self, command, seconds):
+        """Add command latency to histogram.
+        @param command: Command code byte or command name.
+        @param seconds: Time from command write to response.
+        """
+        name = Metrics._command_name(command)
+        with self._lock:
+            histogram = self.latency.get(name)
+            if histogram is None:
+                histogram = self.latency[name] = [0]*(len(Metrics.BUCKETS) + 2)
+            index = 0
+            while index < len(Metrics.BUCKETS) and seconds > Metrics.BUCKETS[index]:
+                index += 1
+            histogram[index] += 1
+            histogram[-1] += seconds
+        if self.hook is not None:
+            self.hook('latency', (name, seconds))
+
+    def observe_recovery(self, seconds):
+        """Add time of automatic reconnection.
+        @param seconds: Time from port failure to restored connection.
+        """
+        with self._lock:
+            self.recovery[0] += 1
+            self.recovery[1] += seconds
+            self.recovery[2] = max(self.recovery[2], seconds)
+        if self.hook is not None:
+            self.hook('recovery', seconds)
+
+    def merge(self, other):
+        """Add values of other Metrics object."""
+        with self._lock:
+            self.recovery[0] += other.recovery[0]
+            self.recovery[1] += other.recovery[1]
+            self.recovery[2] = max(self.recovery[2], other.recovery[2])
+            for name, value in other.counters.items():
+                self.counters[name] += value
+            for name, histogram in other.latency.items():
+                own = self.latency.setdefault(name, [0]*len(histogram))
+                for i, value in enumerate(histogram):
+                    own[i] += value
+
+    def snapshot(self):
+        """Copy of current values.
+        @return: Dictionary with 'counters' (name -> value), 'latency'
+                 (command name -> dictionary with 'count', 'sum' and
+                 'buckets' list of (upper bound, cumulative count)) and
+                 'recovery' (dictionary with 'count', 'sum' and 'max').
+        """
+        with self._lock:
+            latency = {}
+            for name, histogram in self.latency.items():
+                buckets = []
+                total = 0
+                for bound, count in zip(Metrics.BUCKETS + (float('inf'),), histogram[:-1]):
+                    total += count
+                    buckets.append((bound, total))
+                latency[name] = {'count': total, 'sum': histogram[-1], 'buckets': buckets}
+            recovery = dict(zip(('count', 'sum', 'max'), self.recovery))
+            return {'counters': dict(self.counters), 'latency': latency, 'recovery': recovery}
+
+    def to_prometheus(self, labels=None, prefix='sportiduino'):
+        """Export in Prometheus text format.
+        @param labels: Dictionary of labels added to all samples, e.g.
+                       {'port': '/dev/ttyUSB0'}.
+        @param prefix: Metric names prefix.
+        @return:       Text of exposition format.
+        """
+        return Metrics.prometheus([(self, labels)], prefix)
+
+    @staticmethod
+    def prometheus(items, prefix='sportiduino'):
+        """Export several Metrics objects, e.g. of all stations of a pool.
+        @param items:  List of (Metrics object, labels dictionary) tuples.
+        @param prefix: Metric names prefix.
+        @return:       Text of exposition format.
+        """
+        snapshots = [(metrics.snapshot(), labels or {}) for metrics, labels in items]
+        lines = []
+        for name, description in Metrics.COUNTERS:
+            metric = '%s_%s_total' % (prefix, name)
+            lines.append('# HELP %s %s' % (metric, description))
+            lines.append('# TYPE %s counter' % metric)
+            for snapshot, labels in snapshots:
+                lines.append('%s%s %d' % (metric, Metrics._labels(labels), snapshot['counters'][name]))
+
+        metric = '%s_command_duration_seconds' % prefix
+        lines.append('# HELP %s Time from command write to response' % metric)
+        lines.append('# TYPE %s histogram' % metric)
+        for snapshot, labels in snapshots:
+            for command, histogram in sorted(snapshot['latency'].items()):
+                command_labels = dict(labels, command=command)
+                for bound, count in histogram['buckets']:
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s_bucket%s %d' % (metric, Metrics._labels(dict(command_labels, le=le)), count))
+                lines.append('%s_sum%s %r' % (metric, Metrics._labels(command_labels), histogram['sum']))
+                lines.append('%s_count%s %d' % (metric, Metrics._labels(command_labels), histogram['count']))
+
+        metric = '%s_recovery_seconds' % prefix
+        lines.append('# HELP %s Time to restore connection after port failure' % metric)
+        lines.append('# TYPE %s summary' % metric)
+        for snapshot, labels in snapshots:
+            lines.append('%s_sum%s %r' % (metric, Metrics._labels(labels), snapshot['recovery']['sum']))
+            lines.append('%s_count%s %d' % (metric, Metrics._labels(labels), snapshot['recovery']['count']))
+        lines.append('# HELP %s_max Longest recovery' % metric)
+        lines.append('# TYPE %s_max gauge' % metric)
+        for snapshot, labels in snapshots:
+            lines.append('%s_max%s %r' % (metric, Metrics._labels(labels), snapshot['recovery']['max']))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                 for k, v in sorted(labels.items()))
+
+    @staticmethod
+    def _command_name(command):
+        if Metrics._command_names is None:
+            Metrics._command_names = dict((getattr(Sportiduino, attr), attr[4:].lower())
+                                          for attr in dir(Sportiduino) if attr.startswith('CMD_'))
+        name = Metrics._command_names.get(command)
+        if name is not None:
+            return name
+        if isinstance(command, bytes) and len(command) == 1:
+            return hex(byte2int(command))
+        return command
+
+
+class CommandBatch(object):
+    """Commands queued to be sent to master station in one go.
+
+    Methods have the same names and parameters as in Sportiduino but return
+    BatchResult objects. Commands are sent by send() or when the with block
+    exits. Fire-and-forget commands (beeps, read mode) are merged into one
+    write with neighbour commands, commands waiting for response are
+    pipelined and responses are matched to them by code and order. Card
+    writing commands wait for RESP_OK.
+    """
+
+    def __init__(self, sportiduino, timeout=None):
+        """Initializes empty batch.
+        @param sportiduino: Sportiduino object to send commands with.
+        @param timeout:     Timeout for reading each response.
+        """
+        self._sportiduino = sportiduino
+        self._timeout = timeout
+        self._commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.send()
+
+    def __len__(self):
+        return len(self._commands)
+
+    def command(self, code, parameters=None, response=None, parse=None):
+        """Queue command.
+        @param code:       Command code.
+        @param parameters: Command parameters byte string.
+        @param response:   Expected response code or None if no response
+                           is expected.
+        @param parse:      Function to convert response data to result.
+        @return:           BatchResult object.
+        """
+        result = BatchResult(parse)
+        self._commands.append((Sportiduino._make_command(code, parameters), response, result))
+        return result
+
+    def send(self):
+        """Send queued commands and wait for all responses."""
+        commands, self._commands = self._commands, []
+        if commands:
+            self._sportiduino._send_batch(commands, self._timeout)
+
+    def beep_ok(self):
+        return self.command(Sportiduino.CMD_BEEP_OK)
+
+    def beep_error(self):
+        return self.command(Sportiduino.CMD_BEEP_ERROR)
+
+    def read_version(self):
+        return self.command(Sportiduino.CMD_READ_VERS, response=Sportiduino.RESP_VERS,
+                            parse=lambda data: Sportiduino.Version(byte2int(data)))
+
+    def read_card(self):
+        return self.command(Sportiduino.CMD_READ_CARD, response=Sportiduino.RESP_CARD_DATA,
+                            parse=Sportiduino._parse_card_data)
+
+    def read_card_raw(self):
+        return self.command(Sportiduino.CMD_READ_RAW, response=Sportiduino.RESP_CARD_RAW,
+                            parse=Sportiduino._parse_card_raw_data)
+
+    def read_backup(self):
+        return self.command(Sportiduino.CMD_READ_BACKUPREADER, response=Sportiduino.RESP_BACKUP,
+                            parse=Sportiduino._parse_backup)
+
+    def init_card(self, card_number, page6=None, page7=None):
+        params = Sportiduino._init_card_params(card_number, page6, page7)
+        return self.command(Sportiduino.CMD_INIT_CARD, params, response=Sportiduino.RESP_OK)
+
+    def init_backupreader(self):
+        return self.command(Sportiduino.CMD_INIT_BACKUPREADER, response=Sportiduino.RESP_OK)
+
+    def init_sleepcard(self):
+        return self.command(Sportiduino.CMD_INIT_SLEEPCARD, response=Sportiduino.RESP_OK)
+
+    def init_cp_number_card(self, cp_number):
+        return self.command(Sportiduino.CMD_INIT_CP_NUM_CARD, int2byte(cp_number), response=Sportiduino.RESP_OK)
+
+    def init_time_card(self, time=None):
+        if time is None:
+            time = datetime.today()
+        params = Sportiduino._time_card_params(time)
+        return self.command(Sportiduino.CMD_INIT_TIMECARD, params, response=Sportiduino.RESP_OK)
+
+    def init_passwd_card(self, old_passwd=0, new_passwd=0, flags=0):
+        params = Sportiduino._passwd_card_params(old_passwd, new_passwd, flags)
+        return self.command(Sportiduino.CMD_INIT_PASSWDCARD, params, response=Sportiduino.RESP_OK)
+
+    def write_pages6_7(self, page6, page7):
+        params = Sportiduino._pages6_7_params(page6, page7)
+        return self.command(Sportiduino.CMD_WRITE_PAGES6_7, params, response=Sportiduino.RESP_OK)
+
+    def enable_continuous_read(self):
+        return self.command(Sportiduino.CMD_SET_READ_MODE, b'\x01')
+
+    def disable_continuous_read(self):
+        return self.command(Sportiduino.CMD_SET_READ_MODE, b'\x00')
+
+
+class BatchResult(object):
+    """Result of a command sent in CommandBatch."""
+
+    def __init__(self, parse=None):
+        self._parse = parse
+        self._done = False
+        self._value = None
+        self._error = None
+
+    def done(self):
+        """Return True if command is sent and its response is handled."""
+        return self._done
+
+    def result(self):
+        """Command result, e.g. Version object for read_version().
+        @raise SportiduinoException: Command failed or is not sent yet.
+        """
+        if not self._done:
+            raise SportiduinoException('Command is not sent')
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def _set_response(self, code, data):
+        try:
+            if code is not None:
+                Sportiduino._preprocess_response(code, data, lambda s: None)
+            if self._parse is not None:
+                self._value = self._parse(data)
+        except SportiduinoException as msg:
+            self._error = msg
+        self._done = True
+
+    def _set_error(self, error):
+        self._error = error
+        self._done = True
+
+
+class WireCapture(object):
+    """Binary record of raw bytes sent to and received from master station.
+
+    File starts with MAGIC. Each record is a header (time as double,
+    direction byte and data length as unsigned int, big endian) followed by
+    the data. Writes are buffered by the file object, so capturing does not
+    slow down card readout.
+    """
+
+    MAGIC = b'SDCAP\x01'
+
+    TX = 0
+    RX = 1
+
+    _HEADER = struct.Struct('>dBI')
+
+    def __init__(self, file):
+        """Initializes capture.
+        @param file: File name (appended if exists) or binary file object
+                     opened for writing.
+        """
+        self._own_file = isinstance(file, string_types)
+        self._file = open(file, 'ab') if self._own_file else file
+        try:
+            empty = self._file.tell() == 0
+        except (IOError, OSError):
+            empty = True
+        if empty:
+            self._file.write(WireCapture.MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def write(self, direction, data, timestamp=None):
+        """Append record.
+        @param direction: WireCapture.TX or WireCapture.RX.
+        @param data:      Raw bytes.
+        @param timestamp: Record time (default current time).
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        self._file.write(WireCapture._HEADER.pack(timestamp, direction, len(data)))
+        self._file.write(bytes(data))
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        """Flush records and close file if it was opened by capture."""
+        if self._own_file:
+            self._file.close()
+        else:
+            self._file.flush()
+
+    @staticmethod
+    def read(file):
+        """Read records from capture.
+        @param file: File name or binary file object.
+        @return:     Generator of (timestamp, direction, data) tuples.
+        """
+        own_file = isinstance(file, string_types)
+        f = open(file, 'rb') if own_file else file
+        try:
+            if f.read(len(WireCapture.MAGIC)) != WireCapture.MAGIC:
+                raise SportiduinoException('Not a wire capture file')
+            for record in WireCapture.read_records(f):
+                yield record
+        finally:
+            if own_file:
+                f.close()
+
+    @staticmethod
+    def read_records(f):
+        """Read records from capture file positioned after MAGIC.
+        @param f: Binary file object.
+        @return:  Generator of (timestamp, direction, data) tuples.
+        """
+        header_len = WireCapture._HEADER.size
+        while True:
+            header = f.read(header_len)
+            if len(header) < header_len:
+                return
+            timestamp, direction, length = WireCapture._HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield timestamp, direction, data
+
+
+class FrameDecoder(object):
+    """Incremental decoder of master station response frames.
+
+    Bytes are pushed with feed() in chunks of any size, e.g. as they come
+    from the serial port or from a captured byte stream. next_frame() skips
+    garbage before START_BYTE, checks checksums and joins fragmented
+    responses.
+    """
+
+    def __init__(self, metrics=None, byte_resync=False):
+        """Initializes decoder.
+        @param metrics:     Metrics object to count frames, skipped bytes and
+                            checksum errors.
+        @param byte_resync: After checksum mismatch skip START_BYTE only and
+                            search next frame inside the bad one. It finds
+                            frames preceded by garbage with START_BYTE, but
+                            reports more bad frames on corrupted data.
+        """
+        self.metrics = metrics
+        self.byte_resync = byte_resync
+        self._buffer = bytearray()
+        self._code = None
+        self._data = bytearray()
+        self._next_fragment = None
+
+    def reset(self):
+        """Drop buffered bytes and partially received response."""
+        del self._buffer[:]
+        self._clear_fragments()
+
+    def feed(self, data):
+        """Append received bytes to the buffer.
+        @param data: Byte string.
+        """
+        self._buffer += data
+
+    def next_frame(self):
+        """Decode next complete response from buffered bytes.
+        @return: Tuple (code, data) or None if more bytes are needed.
+        @raise SportiduinoException: Checksum mismatch or unexpected fragment.
+                                     Bad frame is dropped, so decoding can
+                                     be continued.
+        """
+        while True:
+            frame = self._parse_frame()
+            if frame is None:
+                return None
+            code, length, data, size = frame
+
+            if self._code is not None and code != self._code:
+                # Fragmented response was interrupted by another one.
+                # Return what was joined, the frame stays in the buffer.
+                return self._join_fragments()
+
+            del self._buffer[:size]
+
+            if self.metrics is not None:
+                self.metrics.inc('frames_received')
+                if length >= Sportiduino.OFFSET:
+                    self.metrics.inc('fragments_received')
+
+            if length >= Sportiduino.OFFSET:
+                fragment_num = length - Sportiduino.OFFSET
+                if fragment_num > 0 and self._next_fragment is not None:
+                    if fragment_num != self._next_fragment:
+                        wait_fragment = self._next_fragment
+                        self._clear_fragments()
+                        raise SportiduinoException('Waiting fragment %d, receive %d' % (wait_fragment, fragment_num))
+                self._code = code
+                self._data += data
+                self._next_fragment = fragment_num + 1
+                continue
+
+            if self._code is None:
+                return code, data
+            self._data += data
+            return self._join_fragments()
+
+    def _parse_frame(self):
+        """Find first complete frame in the buffer without removing it.
+        @return: Tuple (code, length byte value, data, frame size) or None.
+        """
+        start = self._buffer.find(Sportiduino.START_BYTE)
+        if start < 0:
+            self._count_skipped(len(self._buffer))
+            del self._buffer[:]
+            return None
+        if start > 0:
+            # Skip any bytes before START_BYTE
+            self._count_skipped(start)
+            del self._buffer[:start]
+
+        if len(self._buffer) < 3:
+            return None
+        length = self._buffer[2]
+        data_len = Sportiduino.MAX_DATA_LEN if length >= Sportiduino.OFFSET else length
+        size = 3 + data_len + 1
+        if len(self._buffer) < size:
+            return None
+
+        frame = bytes(self._buffer[:size])
+        if not Sportiduino._cs_check(frame[1:-1], frame[-1:]):
+            del self._buffer[:1 if self.byte_resync else size]
+            self._clear_fragments()
+            if self.metrics is not None:
+                self.metrics.inc('checksum_errors')
+            raise SportiduinoException('Checksum mismatch')
+
+        return frame[1:2], length, frame[3:-1], size
+
+    def _count_skipped(self, count):
+        if self.metrics is not None and count > 0:
+            self.metrics.inc('resyncs')
+            self.metrics.inc('bytes_skipped', count)
+
+    def _join_fragments(self):
+        code, data = self._code, bytes(self._data)
+        self._clear_fragments()
+        return code, data
+
+    def _clear_fragments(self):
+        self._code = None
+        self._data = bytearray()
+        self._next_fragment = None
+
+
+class CardRecord(object):
+    """Card data decoded on access from RESP_CARD_DATA payload.
+
+    Payload layout: card number (2 bytes), page6 (4 bytes), page7 (4 bytes)
+    and punch records of check point number (1 byte) and Unix time
+    (4 bytes). Times are available as raw epoch seconds and as datetime.
+    """
+
+    __slots__ = ('_data',)
+
+    HEADER_LEN = 10
+    PUNCH_LEN  = 5
+
+    def __init__(self, data):
+        """Initializes record by response payload without copying it.
+        @param data: Bytes-like card data from master station.
+        @raise SportiduinoException: Payload is shorter than card number
+                                     and pages.
+        """
+        self._data = memoryview(data)
+        if len(self._data) < CardRecord.HEADER_LEN:
+            raise SportiduinoException('Card data too short: %d bytes' % len(self._data))
+
+    def __repr__(self):
+        return 'CardRecord(card_number=%d, punches=%d)' % (self.card_number, len(self))
+
+    def __len__(self):
+        """Number of punch records including start and finish."""
+        return (len(self._data) - CardRecord.HEADER_LEN) // CardRecord.PUNCH_LEN
+
+    @property
+    def card_number(self):
+        return struct.unpack_from('>H', self._data, 0)[0]
+
+    @property
+    def page6(self):
+        return self._data[2:6].tobytes()
+
+    @property
+    def page7(self):
+        return self._data[6:10].tobytes()
+
+    def tobytes(self):
+        """Raw payload as received from master station."""
+        return self._data.tobytes()
+
+    def iter_raw(self):
+        """Iterate over all punch records.
+        @return: Generator of (cp, epoch seconds) tuples.
+        """
+        data = self._data
+        for i in range(len(self)):
+            yield struct.unpack_from('>BI', data, CardRecord.HEADER_LEN + i*CardRecord.PUNCH_LEN)
+
+    @property
+    def start_epoch(self):
+        """Start time in epoch seconds or None."""
+        return self._find_epoch(Sportiduino.START_STATION)
+
+    @property
+    def finish_epoch(self):
+        """Finish time in epoch seconds or None."""
+        return self._find_epoch(Sportiduino.FINISH_STATION)
+
+    @property
+    def start(self):
+        return CardRecord._to_datetime(self.start_epoch)
+
+    @property
+    def finish(self):
+        return CardRecord._to_datetime(self.finish_epoch)
+
+    @property
+    def punches_epoch(self):
+        """Check point punches without start and finish.
+        @return: List of (cp, epoch seconds) tuples.
+        """
+        return [(cp, t) for cp, t in self.iter_raw()
+                if cp != Sportiduino.START_STATION and cp != Sportiduino.FINISH_STATION]
+
+    @property
+    def punches(self):
+        """Check point punches without start and finish.
+        @return: List of (cp, datetime) tuples.
+        """
+        return [(cp, local_datetime(t)) for cp, t in self.punches_epoch]
+
+    def to_dict(self):
+        """Card data in the dictionary returned by Sportiduino.read_card()."""
+        ret = {}
+        ret['card_number'] = self.card_number
+        ret['page6'] = self.page6
+        ret['page7'] = self.page7
+        ret['punches'] = []
+        for cp, t in self.iter_raw():
+            time = local_datetime(t)
+            if cp == Sportiduino.START_STATION:
+                ret['start'] = time
+            elif cp == Sportiduino.FINISH_STATION:
+                ret['finish'] = time
+            else:
+                ret['punches'].append((cp, time))
+
+        return ret
+
+    def _find_epoch(self, station):
+        ret = None
+        for cp, t in self.iter_raw():
+            if cp == station:
+                ret = t
+        return ret
+
+    @staticmethod
+    def _to_datetime(epoch):
+        if epoch is None:
+            return None
+        return local_datetime(epoch)
+
+
+class LocalTimeCache(object):
+    """Conversion of epoch seconds to naive local datetime.
+
+    Same as datetime.fromtimestamp() for integer times, but the local time
+    of every BUCKET seconds is looked up once and punches in the bucket are
+    offsets from it. Buckets with a UTC offset change (daylight saving
+    transition) or in the repeated hour after it, where datetime needs
+    fold=1, are converted by fromtimestamp(). Call clear() after changing
+    the time zone with time.tzset().
+    """
+
+    BUCKET = 900
+    MAX_SIZE = 4096
+
+    _DELTAS = [timedelta(seconds=i) for i in range(BUCKET)]
+
+    def __init__(self):
+        self._bases = {}
+
+    def __call__(self, epoch):
+        bucket, rest = divmod(epoch, LocalTimeCache.BUCKET)
+        base = self._bases.get(bucket)
+        if base is None:
+            base = self._base(bucket)
+        if base is False or rest.__class__ is not int:
+            return datetime.fromtimestamp(epoch)
+        return base + LocalTimeCache._DELTAS[rest]
+
+    def clear(self):
+        self._bases.clear()
+
+    def _base(self, bucket):
+        if len(self._bases) >= LocalTimeCache.MAX_SIZE:
+            self._bases.clear()
+        start = bucket*LocalTimeCache.BUCKET
+        base = datetime.fromtimestamp(start)
+        last = LocalTimeCache.BUCKET - 1
+        end = datetime.fromtimestamp(start + last)
+        # Adding timedelta clears fold
+        if (end != base + LocalTimeCache._DELTAS[last]
+                or getattr(base, 'fold', 0) or getattr(end, 'fold', 0)):
+            base = False
+        self._bases[bucket] = base
+        return base
+
+
+# Shared cache used by CardRecord
+local_datetime = LocalTimeCache()
+
+
+class ReadoutCache(object):
+    """Suppresses repeated readouts of the same card.
+
+    A card left on the station is read again and again in continuous mode
+    or by poll_card() loop. The cache keeps hash of the last card data per
+    card number, so only a readout with changed content is a new event.
+    Entries expire ttl seconds after the card was last seen, the least
+    recently seen entries are evicted above max_size.
+    """
+
+    def __init__(self, ttl=60, max_size=1024, on_present=None):
+        """
+        @param ttl:        Seconds after the last readout when the same card
+                           data is a new event again (None - never).
+        @param max_size:   Maximum number of cards kept.
+        @param on_present: Function called with card number for every
+                           suppressed readout ("card still present").
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.on_present = on_present
+        # Card number -> (hash of card data, last seen time), oldest first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, card_number):
+        return card_number in self._entries
+
+    def check(self, data, now=None):
+        """Register card readout.
+        @param data: RESP_CARD_DATA payload.
+        @param now:  Readout time (default current time).
+        @return:     True if card data is new or changed, False for
+                     repeated readout.
+        """
+        data = bytes(data)
+        if len(data) < 2:
+            return True
+        card_number = struct.unpack_from('>H', data)[0]
+        digest = hash(data)
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            entry = self._entries.pop(card_number, None)
+            self._entries[card_number] = (digest, now)
+            self._expire(now)
+        if entry is not None and entry[0] == digest and (self.ttl is None or now - entry[1] <= self.ttl):
+            if self.on_present is not None:
+                self.on_present(card_number)
+            return False
+        return True
+
+    def forget(self, card_number):
+        """Make next readout of card a new event."""
+        with self._lock:
+            self._entries.pop(card_number, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _expire(self, now):
+        entries = self._entries
+        while entries:
+            card_number, (digest, seen) = next(iter(entries.items()))
+            if len(entries) <= self.max_size and (self.ttl is None or now - seen <= self.ttl):
+                break
+            entries.popitem(last=False)
+
 
 class SportiduinoException(Exception):
     pass
@@ -520,3 +2042,7 @@ class SportiduinoException(Exception):
 class SportiduinoTimeout(SportiduinoException):
     pass
 
+
+class SportiduinoPortError(SportiduinoException):
+    pass
+
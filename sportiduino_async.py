@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sportiduino_async.py - asyncio client for Sportiduino master station (Python 3, POSIX).
+"""
+
+import asyncio
+import logging
+import os
+from datetime import datetime
+
+from serial import Serial
+from serial.serialutil import SerialException
+
+from sportiduino import (Sportiduino, CardRecord, FrameDecoder, WireCapture,
+                         SportiduinoException, SportiduinoTimeout)
+
+
+class _StationProtocol(asyncio.Protocol):
+    """Decodes bytes from the serial transport into response frames.
+    In continuous read mode cards pushed by the station go to a separate
+    queue, unless a read card command waits for its response.
+    """
+
+    def __init__(self, log_debug, capture=None):
+        self._log_debug = log_debug
+        self._capture = capture
+        self._decoder = FrameDecoder()
+        self.frames = asyncio.Queue()
+        self.cards = asyncio.Queue()
+        self.continuous = False
+        self.card_reply = False
+        self.closed = False
+
+    def data_received(self, data):
+        if self._capture is not None:
+            self._capture.write(WireCapture.RX, data)
+        self._decoder.feed(data)
+        while True:
+            try:
+                frame = self._decoder.next_frame()
+            except SportiduinoException as msg:
+                self._log_debug("Warning: %s" % msg)
+                continue
+            if frame is None:
+                break
+            if (self.continuous and not self.card_reply
+                    and frame[0] == Sportiduino.RESP_CARD_DATA):
+                self.cards.put_nowait(frame)
+            else:
+                self.frames.put_nowait(frame)
+
+    def connection_lost(self, exc):
+        self.closed = True
+        # Wake up readers waiting for response or card
+        self.frames.put_nowait(None)
+        self.cards.put_nowait(None)
+
+    def flush(self):
+        """Drop received responses. In continuous read mode bytes of a
+        card being received are kept."""
+        if not self.continuous:
+            self._decoder.reset()
+        while not self.frames.empty():
+            self.frames.get_nowait()
+
+
+class AsyncSportiduino(object):
+    """asyncio client for Sportiduino master station.
+
+    Commands are the same as in Sportiduino but are coroutines. The serial
+    port is read by the event loop, so many stations can be served by one
+    thread. Usage:
+
+        async with AsyncSportiduino('/dev/ttyUSB0') as sportiduino:
+            card_data = await sportiduino.read_card()
+    """
+
+
+    def __init__(self, port, debug=False, logger=None, timeout=5, connect_timeout=5, capture=None,
+                 baudrate=Sportiduino.DEFAULT_BAUDRATE):
+        """Initializes client. Connection is opened by connect().
+        @param port:            Serial device for the connection.
+        @param timeout:         Default timeout for reading response in seconds.
+        @param connect_timeout: Time in seconds to wait for master station
+                                startup after the port is opened.
+        @param capture:         WireCapture object to record raw traffic.
+        @param baudrate:        Line speed.
+        """
+        self.port = port
+        self.baudrate = baudrate
+        self.capture = capture
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.version = None
+        self._serial = None
+        self._read_transport = None
+        self._write_transport = None
+        self._protocol = None
+        self._lock = None
+
+        self._log_info = print
+        self._log_debug = lambda s: None
+        self._debug_enabled = lambda: debug
+        if debug:
+            self._log_debug = print
+
+        if logger is not None:
+            if callable(logger.debug):
+                self._log_debug = logger.debug
+                self._debug_enabled = lambda: True
+                if callable(getattr(logger, 'isEnabledFor', None)):
+                    self._debug_enabled = lambda: logger.isEnabledFor(logging.DEBUG)
+            if callable(logger.info):
+                self._log_info = logger.info
+
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.disconnect()
+
+
+    async def connect(self):
+        """Open serial port and read master station version."""
+        loop = asyncio.get_event_loop()
+        try:
+            self._serial = Serial(self.port, baudrate=self.baudrate, timeout=0)
+        except (SerialException, OSError):
+            raise SportiduinoException("Could not open port '%s'" % self.port)
+
+        # Transports own their file descriptors, the Serial object keeps
+        # the port settings and is closed last
+        fd = self._serial.fileno()
+        self._protocol = _StationProtocol(self._log_debug, self.capture)
+        self._read_transport, _ = await loop.connect_read_pipe(
+            lambda: self._protocol, os.fdopen(os.dup(fd), 'rb', buffering=0))
+        self._write_transport, _ = await loop.connect_write_pipe(
+            asyncio.Protocol, os.fdopen(os.dup(fd), 'wb', buffering=0))
+        self._lock = asyncio.Lock()
+
+        # Master station reset on serial open.
+        # Repeat version request until it startup.
+        deadline = loop.time() + self.connect_timeout
+        self.version = None
+        while self.version is None:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                self.disconnect()
+                raise SportiduinoTimeout("No response from port '%s'" % self.port)
+            try:
+                self.version = await self.read_version(timeout=min(Sportiduino.PROBE_INTERVAL, remaining))
+            except SportiduinoException:
+                pass
+
+        self._log_info("Master station %s on port '%s' connected" % (self.version, self.port))
+
+
+    def disconnect(self):
+        """Close the serial port an disconnect from the station."""
+        for transport in (self._read_transport, self._write_transport):
+            if transport is not None:
+                transport.close()
+        self._read_transport = self._write_transport = None
+        if self._serial is not None:
+            self._serial.close()
+            self._serial = None
+
+
+    async def reconnect(self):
+        """Close the serial port and reopen again."""
+        self.disconnect()
+        await self.connect()
+
+
+    async def beep_ok(self):
+        """One long beep and blink master station."""
+        await self._send_command(Sportiduino.CMD_BEEP_OK, wait_response=False)
+
+
+    async def beep_error(self):
+        """Three short beep and blink master station."""
+        await self._send_command(Sportiduino.CMD_BEEP_ERROR, wait_response=False)
+
+
+    async def read_version(self, timeout=None):
+        """Read master station firmware version.
+        @param timeout: Timeout for reading response in seconds.
+        @return:        Version object.
+        """
+        code, data = await self._send_command(Sportiduino.CMD_READ_VERS, timeout=timeout)
+        if code == Sportiduino.RESP_VERS:
+            return Sportiduino.Version(data[0])
+        return None
+
+
+    async def read_card(self, timeout=None):
+        """Reads out the card currently inserted into the station.
+        @param timeout: Timeout for reading response in seconds.
+        @return:        Card data in dictionary.
+        """
+        code, data = await self._send_command(Sportiduino.CMD_READ_CARD, timeout=timeout)
+        if code == Sportiduino.RESP_CARD_DATA:
+            return Sportiduino._parse_card_data(data)
+        else:
+            raise SportiduinoException("Read card failed.")
+
+
+    async def read_card_record(self, timeout=None):
+        """Reads out the card currently inserted into the station.
+        Unlike read_card() card data is not decoded until accessed.
+        @param timeout: Timeout for reading response in seconds.
+        @return:        CardRecord object.
+        """
+        code, data = await self._send_command(Sportiduino.CMD_READ_CARD, timeout=timeout)
+        if code == Sportiduino.RESP_CARD_DATA:
+            return CardRecord(data)
+        else:
+            raise SportiduinoException("Read card failed.")
+
+
+    async def poll_card(self):
+        """Poll card inserted into the station.
+        If card readed update self.card_data and return True.
+        @return: Read card status."""
+        try:
+            self.card_data = await self.read_card(timeout=0.5)
+            return True
+        except SportiduinoTimeout:
+            pass
+        except SportiduinoException as msg:
+            self._log_debug("Warning: %s" % msg)
+        return False
+
+
+    async def iter_cards(self, timeout=None):
+        """Enable continuous card read and yield cards pushed by the station.
+        @param timeout: Stop iteration after this many seconds without
+                        a card (default wait forever).
+        @return:        Asynchronous generator of card data dictionaries.
+        """
+        await self.enable_continuous_read()
+        try:
+            while True:
+                try:
+                    code, data = await self._read_response(timeout, self._protocol.cards)
+                except SportiduinoTimeout:
+                    if timeout is not None:
+                        return
+                    continue
+                try:
+                    self.card_data = Sportiduino._parse_card_data(data)
+                except SportiduinoException as msg:
+                    self._log_debug("Warning: %s" % msg)
+                    continue
+                yield self.card_data
+        finally:
+            if self._write_transport is not None and not self._protocol.closed:
+                await self.disable_continuous_read()
+
+
+    async def read_card_raw(self):
+        """Reads out the RAW data from card currently inserted into the station.
+        @return: RAW card data in dictionary.
+        """
+        code, data = await self._send_command(Sportiduino.CMD_READ_RAW)
+        if code == Sportiduino.RESP_CARD_RAW:
+            return Sportiduino._parse_card_raw_data(data)
+        else:
+            raise SportiduinoException("Read raw data failed.")
+
+
+    async def read_backup(self):
+        """Read backup from backupreader card.
+        @return: Backup data in dictionary.
+        """
+        code, data = await self._send_command(Sportiduino.CMD_READ_BACKUPREADER)
+        if code == Sportiduino.RESP_BACKUP:
+            return Sportiduino._parse_backup(data)
+        else:
+            raise SportiduinoException("Read backup failed.")
+
+
+    async def read_backup_raw(self):
+        """Read backup from backupreader card without decoding.
+        @return: Backup payload byte string (see sportiduino_backup).
+        """
+        code, data = await self._send_command(Sportiduino.CMD_READ_BACKUPREADER)
+        if code == Sportiduino.RESP_BACKUP:
+            return data
+        else:
+            raise SportiduinoException("Read backup failed.")
+
+
+    async def init_card(self, card_number, page6=None, page7=None):
+        """Initialize card. Set card number, init time and additional pages.
+        @param card_number: Card number (eg participant bib).
+        @param page6:       Additional page.
+        @param page7:       Additional page.
+        """
+        params = Sportiduino._init_card_params(card_number, page6, page7)
+        await self._send_command(Sportiduino.CMD_INIT_CARD, params, wait_response=False)
+
+
+    async def init_backupreader(self):
+        """Initialize backupreader card."""
+        await self._send_command(Sportiduino.CMD_INIT_BACKUPREADER, wait_response=False)
+
+
+    async def init_sleepcard(self):
+        """Initialize sleep card."""
+        await self._send_command(Sportiduino.CMD_INIT_SLEEPCARD, wait_response=False)
+
+
+    async def init_cp_number_card(self, cp_number):
+        """Initialize card for writing check point number to base station.
+        @param cp_number: Check point number.
+        """
+        await self._send_command(Sportiduino.CMD_INIT_CP_NUM_CARD, bytes([cp_number]), wait_response=False)
+
+
+    async def init_time_card(self, time=None):
+        """Initialize card for writing time to base station.
+        @param time: Time for base station (default current time).
+        """
+        if time is None:
+            time = datetime.today()
+        params = Sportiduino._time_card_params(time)
+        await self._send_command(Sportiduino.CMD_INIT_TIMECARD, params, wait_response=False)
+
+
+    async def init_passwd_card(self, old_passwd=0, new_passwd=0, flags=0):
+        """Initialize card for writing new password to base station.
+        @param old_passwd: Old password (default 0x000000).
+        @param new_passwd: New password (default 0x000000).
+        @param flags:      Flags byte (default 0x00).
+        """
+        params = Sportiduino._passwd_card_params(old_passwd, new_passwd, flags)
+        await self._send_command(Sportiduino.CMD_INIT_PASSWDCARD, params, wait_response=False)
+
+
+    async def write_pages6_7(self, page6, page7):
+        """Write additional pages."""
+        params = Sportiduino._pages6_7_params(page6, page7)
+        await self._send_command(Sportiduino.CMD_WRITE_PAGES6_7, params, wait_response=False)
+
+
+    async def enable_continuous_read(self):
+        """Enable continuous card read."""
+        await self._send_command(Sportiduino.CMD_SET_READ_MODE, b'\x01', wait_response=False)
+        self._protocol.continuous = True
+
+
+    async def disable_continuous_read(self):
+        """Disable continuous card read.
+        Cards received before are still returned by iter_cards()."""
+        await self._send_command(Sportiduino.CMD_SET_READ_MODE, b'\x00', wait_response=False)
+        self._protocol.continuous = False
+
+
+    async def _send_command(self, code, parameters=None, wait_response=True, timeout=None):
+        if self._write_transport is None:
+            raise SportiduinoException("Not connected")
+        cmd = Sportiduino._make_command(code, parameters)
+
+        # Only one command at a time can wait for its response
+        async with self._lock:
+            if self._debug_enabled():
+                self._log_debug("=> %s" % Sportiduino._hex(cmd))
+            if self.capture is not None:
+                self.capture.write(WireCapture.TX, cmd)
+
+            self._protocol.flush()
+            self._write_transport.write(cmd)
+
+            if wait_response:
+                # Pushed card is as good as the response to read card
+                self._protocol.card_reply = code == Sportiduino.CMD_READ_CARD
+                try:
+                    resp_code, data = await self._read_response(timeout)
+                finally:
+                    self._protocol.card_reply = False
+                return Sportiduino._preprocess_response(resp_code, data, self._log_debug)
+
+        return None
+
+
+    async def _read_response(self, timeout=None, queue=None):
+        if timeout is None:
+            timeout = self.timeout
+        if queue is None:
+            queue = self._protocol.frames
+        try:
+            frame = await asyncio.wait_for(queue.get(), timeout)
+        except asyncio.TimeoutError:
+            raise SportiduinoTimeout('No response')
+        if frame is None:
+            raise SportiduinoException('Error reading response: port closed')
+
+        code, data = frame
+        if self._debug_enabled():
+            self._log_debug("<= code '%s', len %i, data %s" % (hex(code[0]),
+                                                               len(data),
+                                                               Sportiduino._hex(data)))
+        return code, data
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sportiduino_backup.py - Batch decoding of backupreader dumps (requires NumPy).
+"""
+
+import numpy as np
+
+
+class BackupBatch(object):
+    """Backups of many check points decoded into arrays.
+
+    Every visit is stored as a pair of equal indexes in cps and cards
+    uint16 arrays. Usage:
+
+        batch = BackupBatch.from_payloads(payloads)
+        batch.cards_at(31)
+        batch.missing_punches([31, 32, 33])
+    """
+
+    def __init__(self, cps, cards):
+        """Initializes batch by visit arrays.
+        @param cps:   Check point number of every visit.
+        @param cards: Card number of every visit.
+        """
+        self.cps = np.asarray(cps, dtype=np.uint16)
+        self.cards = np.asarray(cards, dtype=np.uint16)
+        if self.cps.shape != self.cards.shape:
+            raise ValueError('cps and cards must have the same length')
+
+    def __len__(self):
+        return len(self.cards)
+
+    @classmethod
+    def from_payloads(cls, payloads):
+        """Decode raw backup payloads at once.
+        @param payloads: RESP_BACKUP payloads (see Sportiduino.read_backup_raw()),
+                         check point number (2 bytes) followed by card
+                         numbers (2 bytes each, big endian).
+        @return:         BackupBatch object.
+        """
+        payloads = [p for p in payloads if len(p) >= 2]
+        lengths = [len(p) // 2 for p in payloads]
+        if not payloads:
+            return cls([], [])
+
+        words = np.frombuffer(b''.join(bytes(p[:n*2]) for p, n in zip(payloads, lengths)),
+                              dtype='>u2').astype(np.uint16)
+        lengths = np.array(lengths)
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        is_card = np.ones(len(words), dtype=bool)
+        is_card[starts] = False
+        return cls(np.repeat(words[starts], lengths - 1), words[is_card])
+
+    @classmethod
+    def from_backups(cls, backups):
+        """Build batch from dictionaries returned by Sportiduino.read_backup().
+        @param backups: Backup data dictionaries.
+        @return:        BackupBatch object.
+        """
+        cps = []
+        cards = []
+        for backup in backups:
+            cps.extend([backup['cp']]*len(backup['cards']))
+            cards.extend(backup['cards'])
+        return cls(cps, cards)
+
+    def merge(self, other):
+        """Join visits of two batches.
+        @return: New BackupBatch object.
+        """
+        return BackupBatch(np.concatenate((self.cps, other.cps)),
+                           np.concatenate((self.cards, other.cards)))
+
+    def check_points(self):
+        """Sorted array of check point numbers in the batch."""
+        return np.unique(self.cps)
+
+    def card_numbers(self):
+        """Sorted array of card numbers in the batch."""
+        return np.unique(self.cards)
+
+    def cards_at(self, cp):
+        """Cards which visited check point.
+        @param cp: Check point number.
+        @return:   Sorted array of card numbers.
+        """
+        return np.unique(self.cards[self.cps == cp])
+
+    def cps_of(self, card_number):
+        """Check points visited by card.
+        @param card_number: Card number.
+        @return:            Sorted array of check point numbers.
+        """
+        return np.unique(self.cps[self.cards == card_number])
+
+    def visits(self, course, cards=None):
+        """Matrix of visits of course check points.
+        @param course: Check point numbers.
+        @param cards:  Card numbers (default all cards in the batch).
+        @return:       Tuple (cards array, bool array of shape
+                       (len(cards), len(course))).
+        """
+        course = np.asarray(course, dtype=np.uint32)
+        if cards is None:
+            cards = self.card_numbers()
+        cards = np.asarray(cards, dtype=np.uint32)
+        visited = np.unique(self.cps.astype(np.uint32) << 16 | self.cards)
+        keys = course[np.newaxis, :] << 16 | cards[:, np.newaxis]
+        return cards, np.isin(keys, visited)
+
+    def missing_punches(self, course, cards=None):
+        """Course check points not visited by cards.
+        @param course: Check point numbers.
+        @param cards:  Card numbers (default all cards in the batch).
+        @return:       Dictionary card number -> list of missing check
+                       points. Cards without missing punches are omitted.
+        """
+        course = np.asarray(course)
+        cards, visited = self.visits(course, cards)
+        ret = {}
+        for row in np.flatnonzero(~visited.all(axis=1)):
+            ret[int(cards[row])] = course[~visited[row]].tolist()
+        return ret
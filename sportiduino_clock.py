@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sportiduino_clock.py - Correction of base station clock drift.
+
+Punch times on cards come from base station clocks, which drift after the
+stations were set by a time card. Raw times are kept, corrected times are
+computed from per check point clock models:
+
+    correction = ClockCorrection()
+    correction.time_set(31, set_time)                # time card written
+    correction.add_sync(31, station_time, true_time) # e.g. test punch
+    correction.correct(31, punch_time)
+"""
+
+from collections import namedtuple
+
+from sportiduino import Sportiduino, CardRecord, local_datetime
+
+
+class ClockModel(namedtuple('ClockModel', 'offset drift reference')):
+    """Linear clock error of a base station.
+
+    Station time minus true time is offset + drift*(station time -
+    reference), in seconds. drift is in seconds per second, e.g. 2e-5 for
+    a clock gaining 1.7 s a day.
+    """
+
+    __slots__ = ()
+
+    def error(self, station_time):
+        return self.offset + self.drift*(station_time - self.reference)
+
+    def correct(self, station_time):
+        """True time of station time, rounded to seconds."""
+        return station_time - int(round(self.error(station_time)))
+
+    @classmethod
+    def fit(cls, points):
+        """Least squares model of sync points.
+        @param points: (station time, true time) pairs. One point gives
+                       offset only.
+        @return:       ClockModel.
+        """
+        points = list(points)
+        if not points:
+            return NO_CORRECTION
+        n = float(len(points))
+        reference = sum(s for s, _ in points)/n
+        mean_error = sum(s - t for s, t in points)/n
+        spread = sum((s - reference)**2 for s, _ in points)
+        drift = 0.0
+        if spread > 0:
+            drift = sum((s - reference)*(s - t - mean_error) for s, t in points)/spread
+        return cls(mean_error, drift, reference)
+
+
+NO_CORRECTION = ClockModel(0.0, 0.0, 0)
+
+
+class ClockCorrection(object):
+    """Clock models of base stations by check point number.
+
+    A model is set directly or fitted from sync events: time_set() when a
+    time card set the station clock, add_sync() when the station time was
+    compared with true time (a punch at known time or a clock readout).
+    Check points without sync events are not corrected. version is
+    increased on every change, so cached corrected times can be checked.
+    """
+
+    def __init__(self, models=None):
+        """
+        @param models: Dictionary check point -> ClockModel.
+        """
+        self._models = dict(models or {})
+        self._points = {}
+        self.version = 0
+
+    def model(self, cp):
+        return self._models.get(cp, NO_CORRECTION)
+
+    def set_model(self, cp, model):
+        """Set clock model of check point, its sync points are dropped."""
+        self._points.pop(cp, None)
+        self._models[cp] = model
+        self.version += 1
+
+    def time_set(self, cp, epoch):
+        """Station clock was set by time card.
+        Previous sync points no longer apply and are dropped.
+        @param cp:    Check point number.
+        @param epoch: Time written to the station, Unix time as in
+                      punches.
+        """
+        self._points[cp] = []
+        self.add_sync(cp, epoch, epoch)
+
+    def add_sync(self, cp, station_time, true_time):
+        """Add station and true time pair and refit the model.
+        @param cp:           Check point number.
+        @param station_time: Station clock, Unix time.
+        @param true_time:    True time, Unix time.
+        """
+        points = self._points.setdefault(cp, [])
+        points.append((station_time, true_time))
+        self._models[cp] = ClockModel.fit(points)
+        self.version += 1
+
+    def correct(self, cp, epoch):
+        """Corrected Unix time of punch."""
+        model = self._models.get(cp)
+        if model is None:
+            return epoch
+        return model.correct(epoch)
+
+    def correct_many(self, cps, epochs):
+        """Correct many punches in one vectorized pass (requires NumPy).
+        @param cps:    Check point numbers, array-like.
+        @param epochs: Raw punch times, array-like.
+        @return:       NumPy int64 array of corrected times.
+        """
+        import numpy as np
+
+        cps = np.asarray(cps, dtype=np.intp)
+        epochs = np.asarray(epochs, dtype=np.int64)
+        size = max(256, max(self._models) + 1 if self._models else 0)
+        offset = np.zeros(size)
+        drift = np.zeros(size)
+        reference = np.zeros(size)
+        for cp, model in self._models.items():
+            offset[cp], drift[cp], reference[cp] = model
+        error = offset[cps] + drift[cps]*(epochs - reference[cps])
+        return epochs - np.rint(error).astype(np.int64)
+
+    def correct_card(self, card):
+        """Card data with corrected times.
+        @param card: CardRecord or RESP_CARD_DATA payload.
+        @return:     Dictionary as returned by Sportiduino.read_card(),
+                     raw times are in 'raw_punches' as (cp, epoch)
+                     tuples including start and finish.
+        """
+        if not isinstance(card, CardRecord):
+            card = CardRecord(card)
+        ret = {
+            'card_number': card.card_number,
+            'page6': card.page6,
+            'page7': card.page7,
+            'punches': [],
+            'raw_punches': [],
+        }
+        for cp, t in card.iter_raw():
+            ret['raw_punches'].append((cp, t))
+            time = local_datetime(self.correct(cp, t))
+            if cp == Sportiduino.START_STATION:
+                ret['start'] = time
+            elif cp == Sportiduino.FINISH_STATION:
+                ret['finish'] = time
+            else:
+                ret['punches'].append((cp, time))
+        return ret
+
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sportiduino_compat.py - Byte helpers for Python 3 with Python 2 fallback.
+
+Python 3 uses built-in operations on bytes. Python 2 implementations are
+kept here, so the other modules need no six.
+"""
+
+from __future__ import print_function
+
+import struct
+import sys
+
+PY3 = sys.version_info[0] >= 3
+
+print_ = print
+
+int2byte = struct.Struct('>B').pack
+
+if PY3:
+    import queue
+
+    string_types = (str,)
+
+    def byte2int(x):
+        """Integer value of byte, x is bytes or already int."""
+        return x if isinstance(x, int) else x[0]
+
+    def checksum(data):
+        """Sum of bytes modulo 256.
+        @param data: Bytes-like object.
+        """
+        return sum(data) & 0xff
+
+    def to_int(data):
+        """Integer value of big endian bytes."""
+        return int.from_bytes(data, 'big')
+
+    def to_bytes(value, length):
+        """Big endian bytes of integer.
+        @raise OverflowError: value does not fit into length bytes.
+        """
+        return value.to_bytes(length, 'big')
+
+else:
+    import Queue as queue
+
+    string_types = (basestring,)
+
+    def byte2int(x):
+        return x if isinstance(x, (int, long)) else ord(x[0])
+
+    def checksum(data):
+        return sum(bytearray(data)) & 0xff
+
+    def to_int(data):
+        value = 0
+        for c in bytearray(data):
+            value = value << 8 | c
+        return value
+
+    def to_bytes(value, length):
+        if value >> length*8 != 0:
+            raise OverflowError('%i too big to convert to %i bytes' % (value, length))
+        return bytes(bytearray((value >> offset*8) & 0xff for offset in range(length - 1, -1, -1)))
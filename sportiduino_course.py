@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sportiduino_course.py - Check card punches against courses.
+"""
+
+from collections import namedtuple
+import multiprocessing
+
+from sportiduino_compat import int2byte
+from sportiduino import Sportiduino, CardRecord
+
+
+class CourseResult(namedtuple('CourseResult', 'status missing score')):
+    """Result of course check.
+
+    status is Course.OK or Course.MISSING_PUNCH, missing is a tuple of
+    missing controls in course order, score is points of a score course
+    after time penalty (None for line courses).
+    """
+
+    __slots__ = ()
+
+
+class Course(object):
+    """Course compiled for fast checks.
+
+    A line course requires its controls in order, other punches between
+    them are allowed. A score course counts points of distinct controls
+    punched in any order with optional penalty for exceeding time limit.
+    """
+
+    OK = 'OK'
+    MISSING_PUNCH = 'MP'
+
+    def __init__(self, name, controls=None, points=None, time_limit=None, penalty=0):
+        """
+        @param name:       Course name.
+        @param controls:   Control numbers of a line course in order.
+        @param points:     Dictionary control -> points of a score course.
+        @param time_limit: Score course time limit in seconds.
+        @param penalty:    Points subtracted per started minute over
+                           time_limit.
+        """
+        if (controls is None) == (points is None):
+            raise ValueError('Either controls or points must be given')
+        self.name = name
+        self.controls = tuple(controls) if controls is not None else None
+        self.points = dict(points) if points is not None else None
+        self.time_limit = time_limit
+        self.penalty = penalty
+        if self.controls is not None:
+            # Single byte patterns for bytes.find()
+            self._needles = [int2byte(cp) for cp in self.controls]
+            self._control_set = frozenset(self.controls)
+
+    @property
+    def is_score(self):
+        return self.points is not None
+
+    def check(self, cps, time=None):
+        """Check punches.
+        @param cps:  Punched control numbers in punch order, as bytes (see
+                     card_cps()) or sequence of integers.
+        @param time: Running time in seconds for score course penalty.
+        @return:     CourseResult.
+        """
+        if not isinstance(cps, bytes):
+            cps = bytes(bytearray(cps))
+        if self.points is not None:
+            return self._check_score(cps, time)
+        return self._check_line(cps)
+
+    def _check_line(self, cps):
+        # Fast path: first occurrence of every control after the previous one
+        pos = 0
+        for needle in self._needles:
+            pos = cps.find(needle, pos)
+            if pos < 0:
+                break
+            pos += 1
+        else:
+            return CourseResult(Course.OK, (), None)
+        return CourseResult(Course.MISSING_PUNCH, self._missing(bytearray(cps)), None)
+
+    def _missing(self, cps):
+        """Controls outside the longest common subsequence of course and
+        punches. Unlike greedy matching one misplaced punch does not make
+        all following controls missing.
+        """
+        # Only course controls matter, and matching prefix and suffix are
+        # part of the subsequence
+        cps = [cp for cp in cps if cp in self._control_set]
+        controls = self.controls
+        head = 0
+        while head < len(controls) and head < len(cps) and controls[head] == cps[head]:
+            head += 1
+        tail = 0
+        while (tail < len(controls) - head and tail < len(cps) - head
+               and controls[-1 - tail] == cps[-1 - tail]):
+            tail += 1
+        controls = controls[head:len(controls) - tail]
+        cps = cps[head:len(cps) - tail]
+
+        n = len(cps)
+        # lengths[i][j] - LCS of controls[i:] and cps[j:]
+        lengths = [[0]*(n + 1) for _ in range(len(controls) + 1)]
+        for i in range(len(controls) - 1, -1, -1):
+            row, next_row = lengths[i], lengths[i + 1]
+            cp = controls[i]
+            for j in range(n - 1, -1, -1):
+                if cps[j] == cp:
+                    row[j] = next_row[j + 1] + 1
+                else:
+                    row[j] = max(next_row[j], row[j + 1])
+
+        missing = []
+        i = j = 0
+        while i < len(controls):
+            if j < n and cps[j] == controls[i]:
+                i += 1
+                j += 1
+            elif j < n and lengths[i][j + 1] >= lengths[i + 1][j]:
+                j += 1
+            else:
+                missing.append(controls[i])
+                i += 1
+        return tuple(missing)
+
+    def _check_score(self, cps, time):
+        points = self.points
+        score = sum(points.get(cp, 0) for cp in set(bytearray(cps)))
+        if self.time_limit is not None and time is not None and time > self.time_limit:
+            score -= self.penalty*(-(-(time - self.time_limit) // 60))
+        return CourseResult(Course.OK, (), score)
+
+
+def card_cps(card):
+    """Control punches of card without start and finish.
+    @param card: CardRecord or card data dictionary.
+    @return:     Tuple (control numbers as bytes, running time in seconds
+                 or None).
+    """
+    if isinstance(card, CardRecord):
+        start = finish = None
+        cps = bytearray()
+        for cp, t in card.iter_raw():
+            if cp == Sportiduino.START_STATION:
+                start = t
+            elif cp == Sportiduino.FINISH_STATION:
+                finish = t
+            else:
+                cps.append(cp)
+        time = finish - start if start is not None and finish is not None else None
+        return bytes(cps), time
+
+    time = None
+    if card.get('start') is not None and card.get('finish') is not None:
+        time = int((card['finish'] - card['start']).total_seconds())
+    return bytes(bytearray(cp for cp, _ in card['punches'])), time
+
+
+class CourseIndex(object):
+    """Courses by name with batch checks on a process pool.
+
+    Courses are sent to worker processes once, when the pool starts. Cards
+    are sent as control number bytes and running time only. Usage:
+
+        index = CourseIndex([Course('A', [31, 32, 33]),
+                             Course('Score', points={31: 10, 32: 20}, time_limit=3600)])
+        index.check('A', card_data)
+        results = index.check_many([('A', card) for card in cards])
+    """
+
+    # Smaller batches are checked in this process
+    MIN_PARALLEL = 2000
+
+    def __init__(self, courses=()):
+        self.courses = {}
+        for course in courses:
+            self.add(course)
+
+    def __getitem__(self, name):
+        return self.courses[name]
+
+    def __contains__(self, name):
+        return name in self.courses
+
+    def add(self, course):
+        """Add or replace course."""
+        self.courses[course.name] = course
+
+    def check(self, course_name, card):
+        """Check card against course.
+        @param course_name: Course name.
+        @param card:        CardRecord or card data dictionary.
+        @return:            CourseResult.
+        """
+        cps, time = card_cps(card)
+        return self.courses[course_name].check(cps, time)
+
+    def check_many(self, items, processes=None, chunksize=500):
+        """Check many cards, in parallel processes if the batch is large.
+        @param items:     Iterable of (course name, card) tuples.
+        @param processes: Number of processes (default CPU count), 1 to
+                          check in this process.
+        @param chunksize: Cards sent to a worker at once.
+        @return:          List of CourseResult in items order.
+        """
+        tasks = []
+        for course_name, card in items:
+            cps, time = card_cps(card)
+            tasks.append((course_name, cps, time))
+
+        if processes == 1 or len(tasks) < CourseIndex.MIN_PARALLEL:
+            return [_check_task(self, task) for task in tasks]
+
+        pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(self,))
+        try:
+            return pool.map(_check_worker_task, tasks, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+
+
+# Course index of worker process, set by pool initializer
+_worker_index = None
+
+
+def _init_worker(index):
+    global _worker_index
+    _worker_index = index
+
+
+def _check_task(index, task):
+    course_name, cps, time = task
+    return index.courses[course_name].check(cps, time)
+
+
+def _check_worker_task(task):
+    return _check_task(_worker_index, task)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sportiduino_decode.py - Decoding of master station traffic without connection.
+
+Captured traffic (WireCapture files, raw serial dumps, bytes) is decoded at
+disk speed into response frames and cards:
+
+    from sportiduino_decode import decode, iter_cards
+
+    for timestamp, card in iter_cards('traffic.sdcap'):
+        print(timestamp, card.card_number, card.punches)
+"""
+
+from collections import namedtuple
+
+from sportiduino_compat import byte2int, string_types
+from sportiduino import Sportiduino, CardRecord, FrameDecoder, WireCapture, SportiduinoException
+
+
+# Command or response code -> name
+FRAME_NAMES = dict((getattr(Sportiduino, name), name) for name in dir(Sportiduino)
+                   if name.startswith('RESP_') or name.startswith('CMD_'))
+
+# Read size for raw byte files
+CHUNK_SIZE = 65536
+
+
+class Frame(namedtuple('Frame', 'timestamp code data')):
+    """Response or command frame with fragments joined.
+
+    timestamp is the capture time of the chunk which completed the frame
+    or None for sources without time. code is the response or command code
+    byte, data the payload bytes.
+    """
+
+    __slots__ = ()
+
+    @property
+    def name(self):
+        """Code name, e.g. 'RESP_CARD_DATA'."""
+        return FRAME_NAMES.get(self.code, hex(byte2int(self.code)))
+
+    def parse(self):
+        """Decode payload (see parse_response())."""
+        return parse_response(self.code, self.data)
+
+
+def parse_response(code, data):
+    """Decode response payload by its code.
+    @param code: Response code byte.
+    @param data: Payload bytes.
+    @return:     CardRecord for RESP_CARD_DATA, dictionary page number ->
+                 page bytes for RESP_CARD_RAW, dictionary with keys 'cp'
+                 and 'cards' for RESP_BACKUP, Sportiduino.Version for
+                 RESP_VERS, None for RESP_OK and other codes.
+    @raise SportiduinoException: RESP_ERROR response.
+    """
+    check_response(code, data)
+    if code == Sportiduino.RESP_CARD_DATA:
+        return CardRecord(data)
+    if code == Sportiduino.RESP_CARD_RAW:
+        return parse_card_raw_data(data)
+    if code == Sportiduino.RESP_BACKUP:
+        return parse_backup(data)
+    if code == Sportiduino.RESP_VERS:
+        return parse_version(data)
+    return None
+
+
+def check_response(code, data):
+    """Raise SportiduinoException with error description for RESP_ERROR."""
+    Sportiduino._preprocess_response(code, data, lambda s: None)
+
+
+def parse_card_data(data):
+    """Card data dictionary as returned by Sportiduino.read_card()."""
+    return Sportiduino._parse_card_data(data)
+
+
+def parse_card_raw_data(data):
+    """Card pages as returned by Sportiduino.read_card_raw()."""
+    return Sportiduino._parse_card_raw_data(data)
+
+
+def parse_backup(data):
+    """Backup dictionary as returned by Sportiduino.read_backup()."""
+    return Sportiduino._parse_backup(data)
+
+
+def parse_version(data):
+    return Sportiduino.Version(byte2int(data))
+
+
+def decode(source, direction=WireCapture.RX, metrics=None, errors='skip'):
+    """Decode frames from captured traffic.
+    Garbage before frames is skipped and fragmented responses are joined.
+    After a bad frame decoding continues from the byte next to its start,
+    so a frame hidden by garbage with START_BYTE is not lost.
+    @param source:    WireCapture file name or binary file object, raw
+                      serial dump file name or file object, bytes-like
+                      object, or iterable of byte chunks.
+    @param direction: Records of WireCapture to decode, WireCapture.RX for
+                      responses, WireCapture.TX for commands (the frame
+                      format is the same).
+    @param metrics:   Metrics object to count frames and errors.
+    @param errors:    'skip' to drop frames with bad checksum, 'raise' to
+                      raise SportiduinoException.
+    @return:          Generator of Frame tuples.
+    """
+    decoder = FrameDecoder(metrics, byte_resync=True)
+    for timestamp, chunk in _chunks(source, direction):
+        decoder.feed(chunk)
+        while True:
+            try:
+                frame = decoder.next_frame()
+            except SportiduinoException:
+                if errors == 'raise':
+                    raise
+                continue
+            if frame is None:
+                break
+            yield Frame(timestamp, frame[0], frame[1])
+
+
+def iter_cards(source, **kwargs):
+    """Decode cards from captured traffic.
+    @param source: See decode().
+    @param kwargs: Other decode() arguments. With errors='skip' card data
+                   too short for a card is skipped as well.
+    @return:       Generator of (timestamp, CardRecord) tuples.
+    """
+    for frame in decode(source, **kwargs):
+        if frame.code == Sportiduino.RESP_CARD_DATA:
+            try:
+                record = CardRecord(frame.data)
+            except SportiduinoException:
+                if kwargs.get('errors', 'skip') == 'raise':
+                    raise
+                continue
+            yield frame.timestamp, record
+
+
+def _chunks(source, direction):
+    """Iterate over (timestamp, bytes) chunks of source."""
+    if isinstance(source, (bytes, bytearray, memoryview)) and not isinstance(source, string_types):
+        yield None, source
+        return
+
+    if isinstance(source, string_types):
+        f = open(source, 'rb')
+    elif hasattr(source, 'read'):
+        f = source
+    else:
+        # Iterable of chunks, e.g. from socket
+        for chunk in source:
+            yield None, chunk
+        return
+
+    try:
+        head = f.read(len(WireCapture.MAGIC))
+        if head == WireCapture.MAGIC:
+            for timestamp, record_direction, data in WireCapture.read_records(f):
+                if record_direction == direction:
+                    yield timestamp, data
+            return
+
+        yield None, head
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield None, chunk
+    finally:
+        if f is not source:
+            f.close()
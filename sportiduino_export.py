@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sportiduino_export.py - Streaming export of card readouts.
+
+Cards are written as they are read, only the current row (or Parquet row
+group) is kept in memory:
+
+    with CsvExporter('readout.csv') as exporter:
+        sportiduino.listen(exporter.write)
+"""
+
+import binascii
+import csv
+import json
+import time
+
+from sportiduino_compat import PY3, string_types
+from sportiduino import Sportiduino, CardRecord, local_datetime
+
+
+def card_splits(card):
+    """Split times of card in one pass over its punches.
+    @param card: CardRecord or card data dictionary from
+                 Sportiduino.read_card().
+    @return:     Dictionary with keys 'card_number', 'page6', 'page7',
+                 'start', 'finish' (Unix time or None), 'time' (finish
+                 minus start or None), 'finish_split' (finish minus last
+                 punch or None) and 'punches', list of (cp, Unix time,
+                 split from previous punch or start, time from start)
+                 tuples. Splits are None when previous time is unknown.
+    """
+    if isinstance(card, CardRecord):
+        raw = card.iter_raw()
+    else:
+        raw = _dict_raw(card)
+
+    start = finish = prev = None
+    punches = []
+    for cp, t in raw:
+        if cp == Sportiduino.START_STATION:
+            start = prev = t
+        elif cp == Sportiduino.FINISH_STATION:
+            finish = t
+        else:
+            punches.append((cp, t,
+                            t - prev if prev is not None else None,
+                            t - start if start is not None else None))
+            prev = t
+
+    return {
+        'card_number': card.card_number if isinstance(card, CardRecord) else card['card_number'],
+        'page6': card.page6 if isinstance(card, CardRecord) else card.get('page6'),
+        'page7': card.page7 if isinstance(card, CardRecord) else card.get('page7'),
+        'start': start,
+        'finish': finish,
+        'time': finish - start if finish is not None and start is not None else None,
+        'finish_split': finish - prev if finish is not None and prev is not None else None,
+        'punches': punches,
+    }
+
+
+def _dict_raw(card_data):
+    """(cp, Unix time) pairs of card data dictionary in card order."""
+    if card_data.get('start') is not None:
+        yield Sportiduino.START_STATION, _to_epoch(card_data['start'])
+    for cp, t in card_data['punches']:
+        yield cp, _to_epoch(t)
+    if card_data.get('finish') is not None:
+        yield Sportiduino.FINISH_STATION, _to_epoch(card_data['finish'])
+
+
+def _to_epoch(dt):
+    # Card data datetimes are local time (datetime.fromtimestamp())
+    return int(time.mktime(dt.timetuple()))
+
+
+def _format_time(epoch):
+    if epoch is None:
+        return None
+    return local_datetime(epoch).isoformat()
+
+
+def _format_page(page):
+    if page is None:
+        return None
+    return binascii.hexlify(bytes(page)).decode('ascii')
+
+
+def card_json(card):
+    """Card as JSON serializable dictionary, see JsonLinesExporter.
+    @param card: CardRecord or card data dictionary.
+    """
+    return _json_row(card_splits(card))
+
+
+def _json_row(row):
+    out = dict(row)
+    out['page6'] = _format_page(row['page6'])
+    out['page7'] = _format_page(row['page7'])
+    out['start'] = _format_time(row['start'])
+    out['finish'] = _format_time(row['finish'])
+    out['punches'] = [{'cp': cp, 'time': _format_time(t), 'split': split, 'elapsed': elapsed}
+                      for cp, t, split, elapsed in row['punches']]
+    return out
+
+
+class CardExporter(object):
+    """Base class of streaming exporters.
+
+    Subclasses implement _write_row() for card_splits() dictionaries.
+    Besides write() for card data dictionaries and CardRecord objects the
+    exporter has append() for RESP_CARD_DATA payloads, so it can be passed
+    as journal to Sportiduino.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def write(self, card):
+        """Export card.
+        @param card: CardRecord or card data dictionary.
+        """
+        self._write_row(card_splits(card))
+        self.count += 1
+
+    def write_all(self, cards):
+        for card in cards:
+            self.write(card)
+
+    def append(self, payload):
+        """Export RESP_CARD_DATA payload."""
+        self.write(CardRecord(bytes(payload)))
+
+    def close(self):
+        pass
+
+    def _write_row(self, row):
+        raise NotImplementedError
+
+
+class _FileExporter(CardExporter):
+    """Exporter to text file given by name or file object."""
+
+    def __init__(self, file):
+        CardExporter.__init__(self)
+        self._own_file = isinstance(file, string_types)
+        if not self._own_file:
+            self._file = file
+        elif PY3:
+            self._file = open(file, 'w', newline='')
+        else:
+            self._file = open(file, 'wb')
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self._own_file:
+            self._file.close()
+        else:
+            self._file.flush()
+
+
+class CsvExporter(_FileExporter):
+    """One CSV row per card.
+
+    Columns: card_number, page6, page7 (hex), start, finish (ISO local
+    time), time, finish_split (seconds), punch_count and cp, time and split
+    for each of max_punches punches. Empty cells for missing values.
+    """
+
+    def __init__(self, file, max_punches=50, delimiter=','):
+        """
+        @param file:        File name or text file object.
+        @param max_punches: Number of punch column groups. Longer cards
+                            raise ValueError.
+        @param delimiter:   CSV delimiter.
+        """
+        _FileExporter.__init__(self, file)
+        self.max_punches = max_punches
+        self._writer = csv.writer(self._file, delimiter=delimiter)
+        header = ['card_number', 'page6', 'page7', 'start', 'finish', 'time', 'finish_split',
+                  'punch_count']
+        for i in range(1, max_punches + 1):
+            header += ['cp%d' % i, 'time%d' % i, 'split%d' % i]
+        self._writer.writerow(header)
+
+    def _write_row(self, row):
+        punches = row['punches']
+        if len(punches) > self.max_punches:
+            raise ValueError('Card %d has %d punches, more than max_punches'
+                             % (row['card_number'], len(punches)))
+        out = [row['card_number'], _format_page(row['page6']), _format_page(row['page7']),
+               _format_time(row['start']), _format_time(row['finish']), row['time'],
+               row['finish_split'], len(punches)]
+        for cp, t, split, elapsed in punches:
+            out += [cp, _format_time(t), split]
+        out += [None]*(3*(self.max_punches - len(punches)))
+        self._writer.writerow(['' if value is None else value for value in out])
+
+
+class JsonLinesExporter(_FileExporter):
+    """One JSON object per line and card.
+
+    Keys are those of card_splits() with times as ISO local time, pages as
+    hex and punches as objects with keys cp, time, split and elapsed.
+    """
+
+    def _write_row(self, row):
+        self._file.write(json.dumps(_json_row(row), sort_keys=True) + '\n')
+
+
+class ParquetExporter(CardExporter):
+    """Cards in Parquet file, written in row groups (requires pyarrow).
+
+    Columns are those of card_splits(), times as timestamps in seconds,
+    punches as list of structs with cp, time and split. Only one row group
+    is kept in memory.
+    """
+
+    def __init__(self, path, row_group_size=1024):
+        """
+        @param path:           File name.
+        @param row_group_size: Cards per row group.
+        """
+        import pyarrow
+        import pyarrow.parquet
+
+        CardExporter.__init__(self)
+        self._pa = pyarrow
+        self.row_group_size = row_group_size
+        timestamp = pyarrow.timestamp('s')
+        self.schema = pyarrow.schema([
+            ('card_number', pyarrow.uint16()),
+            ('page6', pyarrow.binary()),
+            ('page7', pyarrow.binary()),
+            ('start', timestamp),
+            ('finish', timestamp),
+            ('time', pyarrow.int32()),
+            ('finish_split', pyarrow.int32()),
+            ('punches', pyarrow.list_(pyarrow.struct([
+                ('cp', pyarrow.uint8()),
+                ('time', timestamp),
+                ('split', pyarrow.int32()),
+            ]))),
+        ])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self._clear()
+
+    def _clear(self):
+        self._columns = dict((name, []) for name in self.schema.names)
+
+    def _write_row(self, row):
+        columns = self._columns
+        for name in ('card_number', 'start', 'finish', 'time', 'finish_split'):
+            columns[name].append(row[name])
+        columns['page6'].append(bytes(row['page6']) if row['page6'] is not None else None)
+        columns['page7'].append(bytes(row['page7']) if row['page7'] is not None else None)
+        columns['punches'].append([{'cp': cp, 'time': t, 'split': split}
+                                   for cp, t, split, elapsed in row['punches']])
+        if len(columns['card_number']) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        """Write buffered cards as a row group."""
+        if not self._columns['card_number']:
+            return
+        table = self._pa.Table.from_pydict(self._columns, schema=self.schema)
+        self._writer.write_table(table)
+        self._clear()
+
+    def close(self):
+        self.flush()
+        self._writer.close()
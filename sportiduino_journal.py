@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sportiduino_journal.py - Append-only journal of card readouts.
+"""
+
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from sportiduino_compat import byte2int
+from sportiduino import Sportiduino, CardRecord, SportiduinoException
+
+
+MAGIC = b'SDJRN\x01'
+
+# Receive time, response code, payload length, CRC32 of payload
+_HEADER = struct.Struct('>dBII')
+
+
+def _iter_records(buf, offset=len(MAGIC)):
+    """Iterate over valid records in journal bytes.
+    Iteration stops at the first truncated or corrupted record.
+    @param buf:    Bytes-like journal contents.
+    @param offset: Offset of the first record.
+    @return:       Generator of (offset, timestamp, code, payload memoryview,
+                   end offset) tuples.
+    """
+    view = memoryview(buf)
+    size = len(view)
+    while offset + _HEADER.size <= size:
+        timestamp, code, length, crc = _HEADER.unpack_from(view, offset)
+        start = offset + _HEADER.size
+        end = start + length
+        if end > size:
+            return
+        payload = view[start:end]
+        if zlib.crc32(payload) & 0xffffffff != crc:
+            return
+        yield offset, timestamp, code, payload, end
+        offset = end
+
+
+class ReadoutJournal(object):
+    """Append-only binary journal of raw card readouts.
+
+    Records keep the response payload with receive time and checksum, so a
+    readout survives crash of the application before it is stored in the
+    results database. Records are written in groups: a group is committed
+    (written and synced) when commit_records records are pending or
+    commit_interval seconds after the first of them. An index by card
+    number gives O(1) lookup and duplicate detection. Pass the journal to
+    Sportiduino to record every card read:
+
+        journal = ReadoutJournal('event.sdjrn')
+        sportiduino = Sportiduino(journal=journal)
+    """
+
+    def __init__(self, path, commit_interval=0.5, commit_records=64, fsync=True, dedup=True):
+        """Open journal, existing records are indexed.
+        A truncated record at the end, e.g. after power loss, is cut off.
+        @param path:            Journal file name.
+        @param commit_interval: Maximum time in seconds record waits for
+                                commit.
+        @param commit_records:  Commit when this many records are pending.
+        @param fsync:           Sync file to disk on commit.
+        @param dedup:           Skip records equal to already stored ones.
+        """
+        self.path = path
+        self.commit_interval = commit_interval
+        self.commit_records = commit_records
+        self.fsync = fsync
+        self.dedup = dedup
+
+        self._lock = threading.Lock()
+        self._committed = threading.Condition(self._lock)
+        # Card number -> offsets of its records
+        self._index = {}
+        # (card number, CRC32) of stored card payloads
+        self._digests = set()
+        self._count = 0
+        self._pending = bytearray()
+        self._pending_count = 0
+        self._pending_since = None
+        self._closed = False
+
+        self._file = open(path, 'a+b')
+        self._file.seek(0, os.SEEK_END)
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+            self._file.flush()
+        self._size = self._load()
+
+        self._flusher = threading.Thread(target=self._run_flusher, name='sportiduino journal')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, card_number):
+        return card_number in self._index
+
+    def append(self, payload, code=Sportiduino.RESP_CARD_DATA, timestamp=None):
+        """Add readout to the journal.
+        @param payload:   Response payload, e.g. RESP_CARD_DATA data.
+        @param code:      Response code.
+        @param timestamp: Receive time (default current time).
+        @return:          False if dedup is set and the same card data is
+                          already stored, otherwise True.
+        """
+        payload = bytes(payload)
+        if timestamp is None:
+            timestamp = time.time()
+        crc = zlib.crc32(payload) & 0xffffffff
+        code = byte2int(code)
+
+        with self._lock:
+            if self._closed:
+                raise SportiduinoException('Journal is closed')
+            card_number = None
+            if code == byte2int(Sportiduino.RESP_CARD_DATA) and len(payload) >= 2:
+                card_number = struct.unpack_from('>H', payload)[0]
+                if self.dedup and (card_number, crc) in self._digests:
+                    return False
+                self._digests.add((card_number, crc))
+                self._index.setdefault(card_number, []).append(self._size + len(self._pending))
+
+            self._pending += _HEADER.pack(timestamp, code, len(payload), crc)
+            self._pending += payload
+            self._count += 1
+            self._pending_count += 1
+            if self._pending_since is None:
+                self._pending_since = time.time()
+                self._committed.notify_all()
+            if self._pending_count >= self.commit_records:
+                self._commit()
+        return True
+
+    def is_duplicate(self, payload):
+        """Check if the same card data is already stored.
+        @param payload: RESP_CARD_DATA payload.
+        """
+        payload = bytes(payload)
+        if len(payload) < 2:
+            return False
+        card_number = struct.unpack_from('>H', payload)[0]
+        return (card_number, zlib.crc32(payload) & 0xffffffff) in self._digests
+
+    def card_numbers(self):
+        """Numbers of all cards in the journal."""
+        return list(self._index)
+
+    def readouts(self, card_number):
+        """All readouts of card.
+        @param card_number: Card number.
+        @return:            List of (timestamp, CardRecord) tuples.
+        """
+        with self._lock:
+            return [self._read_at(offset) for offset in self._index.get(card_number, [])]
+
+    def latest(self, card_number):
+        """Last readout of card.
+        @param card_number: Card number.
+        @return:            Tuple (timestamp, CardRecord) or None.
+        """
+        with self._lock:
+            offsets = self._index.get(card_number)
+            if not offsets:
+                return None
+            return self._read_at(offsets[-1])
+
+    def commit(self):
+        """Write and sync pending records now."""
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        """Commit pending records and close the file."""
+        with self._lock:
+            if self._closed:
+                return
+            self._commit()
+            self._closed = True
+            self._committed.notify_all()
+        self._flusher.join()
+        self._file.close()
+
+    def _load(self):
+        """Index records of existing file.
+        @return: Size of valid part of the file.
+        """
+        self._file.seek(0)
+        data = self._file.read()
+        if data[:len(MAGIC)] != MAGIC:
+            raise SportiduinoException("'%s' is not a readout journal" % self.path)
+        end = len(MAGIC)
+        for offset, timestamp, code, payload, end in _iter_records(data):
+            self._count += 1
+            if code == byte2int(Sportiduino.RESP_CARD_DATA) and len(payload) >= 2:
+                card_number = struct.unpack_from('>H', payload)[0]
+                self._index.setdefault(card_number, []).append(offset)
+                self._digests.add((card_number, zlib.crc32(payload) & 0xffffffff))
+        if end < len(data):
+            # Cut off record broken by crash
+            self._file.truncate(end)
+        self._file.seek(0, os.SEEK_END)
+        return end
+
+    def _read_at(self, offset):
+        if offset >= self._size:
+            # Record is not committed yet
+            start = offset - self._size
+            timestamp, code, length, crc = _HEADER.unpack_from(self._pending, start)
+            start += _HEADER.size
+            payload = bytes(self._pending[start:start + length])
+        else:
+            self._file.seek(offset)
+            timestamp, code, length, crc = _HEADER.unpack(self._file.read(_HEADER.size))
+            payload = self._file.read(length)
+            self._file.seek(0, os.SEEK_END)
+        return timestamp, CardRecord(payload)
+
+    def _commit(self):
+        if not self._pending:
+            return
+        self._file.write(self._pending)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._size += len(self._pending)
+        self._pending = bytearray()
+        self._pending_count = 0
+        self._pending_since = None
+
+    def _run_flusher(self):
+        with self._lock:
+            while not self._closed:
+                if self._pending_since is None:
+                    self._committed.wait()
+                    continue
+                delay = self._pending_since + self.commit_interval - time.time()
+                if delay > 0:
+                    self._committed.wait(delay)
+                    continue
+                self._commit()
+
+
+class JournalReader(object):
+    """Fast sequential reader of readout journal.
+
+    The file is memory mapped and payloads are returned as memoryview
+    slices of the map without copying, e.g. to replay or export a whole
+    event. Records are valid until the reader is closed.
+    """
+
+    def __init__(self, path):
+        """Open journal for reading.
+        @param path: Journal file name.
+        """
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = None
+        if size > 0:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map is None or self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise SportiduinoException("'%s' is not a readout journal" % path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __iter__(self):
+        """Iterate over all records.
+        @return: Generator of (timestamp, response code, payload memoryview).
+        """
+        for offset, timestamp, code, payload, end in _iter_records(self._map):
+            yield timestamp, code, payload
+
+    def cards(self):
+        """Iterate over card readouts.
+        @return: Generator of (timestamp, CardRecord) tuples.
+        """
+        card_code = byte2int(Sportiduino.RESP_CARD_DATA)
+        for timestamp, code, payload in self:
+            if code == card_code:
+                yield timestamp, CardRecord(payload)
+
+    def close(self):
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Records are still referenced, map is closed with them
+                pass
+            self._map = None
+        self._file.close()
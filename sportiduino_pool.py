@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sportiduino_pool.py - Read several Sportiduino master stations concurrently.
+"""
+
+import threading
+import time
+
+from sportiduino_compat import queue
+from sportiduino import Sportiduino, Metrics, SportiduinoException
+
+
+class StationPool(object):
+    """Reads cards from several master stations into one queue.
+
+    Each station is served by its own thread, stations are opened in
+    parallel. Card readouts are put into the queue as (port, card_data)
+    tuples. Usage:
+
+        with StationPool(['/dev/ttyUSB0', '/dev/ttyUSB1']) as pool:
+            for port, card_data in pool:
+                print(port, card_data['card_number'])
+    """
+
+    def __init__(self, ports, continuous=True, debug=False, logger=None, cards=None, supervised=False,
+                 dedup=None):
+        """Initializes pool. Stations are opened by start().
+        @param ports:      Serial devices of master stations.
+        @param continuous: Use continuous read mode, otherwise poll cards.
+        @param cards:      Queue for card readouts (default new queue).
+        @param supervised: Reconnect stations automatically on port failure.
+                           A station which fails to open is opened again
+                           with growing delay, otherwise it is skipped.
+        @param dedup:      ReadoutCache shared by all stations to skip
+                           repeated readouts.
+        """
+        self.ports = list(ports)
+        self.continuous = continuous
+        self.supervised = supervised
+        self.dedup = dedup
+        self.cards = cards if cards is not None else queue.Queue()
+        self._debug = debug
+        self._logger = logger
+        self._stations = {}
+        self._threads = []
+        self._stopped = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+        # Metrics outlive station connections
+        self.metrics = dict((port, Metrics()) for port in self.ports)
+        for port in self.ports:
+            self._stats[port] = {
+                'connected': False,
+                'cards': 0,
+                'errors': 0,
+                'last_error': None,
+                'started': None,
+                'stopped': None,
+            }
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def __iter__(self):
+        """Iterate over (port, card_data) until the pool is stopped."""
+        while not self._stopped.is_set():
+            item = self.get(timeout=0.5)
+            if item is not None:
+                yield item
+
+    def start(self):
+        """Open all stations and start reading."""
+        self._stopped.clear()
+        for port in self.ports:
+            thread = threading.Thread(target=self._run, args=(port,), name='sportiduino %s' % port)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Stop reading and close all stations.
+        @param timeout: Time to wait for each reading thread.
+        """
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def get(self, timeout=None):
+        """Get next card readout.
+        @param timeout: Timeout in seconds (default wait forever).
+        @return:        Tuple (port, card_data) or None if timeout expired.
+        """
+        try:
+            return self.cards.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def station(self, port):
+        """Get connected station.
+        @param port: Serial device of the station.
+        @return:     Sportiduino object or None if it is not connected.
+        """
+        return self._stations.get(port)
+
+    def stats(self):
+        """Per station statistics.
+        @return: Dictionary port -> dictionary with keys 'connected', 'cards',
+                 'errors', 'last_error' and 'cards_per_second'.
+        """
+        now = time.time()
+        ret = {}
+        with self._stats_lock:
+            for port, stats in self._stats.items():
+                stats = dict(stats)
+                started = stats.pop('started')
+                stopped = stats.pop('stopped') or now
+                elapsed = stopped - started if started is not None else 0
+                stats['cards_per_second'] = stats['cards'] / elapsed if elapsed > 0 else 0.0
+                ret[port] = stats
+        return ret
+
+    def to_prometheus(self):
+        """Communication metrics of all stations in Prometheus text format."""
+        return Metrics.prometheus([(self.metrics[port], {'port': port}) for port in self.ports])
+
+    def _count(self, port, card_data=None, error=None):
+        with self._stats_lock:
+            stats = self._stats[port]
+            if card_data is not None:
+                stats['cards'] += 1
+            if error is not None:
+                stats['errors'] += 1
+                stats['last_error'] = str(error)
+
+    def _open(self, port):
+        """Open station, in supervised mode retry until the pool is stopped.
+        @return: Sportiduino object or None.
+        """
+        delay = Sportiduino.RECONNECT_DELAY
+        while not self._stopped.is_set():
+            try:
+                return Sportiduino(port, debug=self._debug, logger=self._logger,
+                                   metrics=self.metrics[port], supervised=self.supervised,
+                                   dedup=self.dedup)
+            except SportiduinoException as msg:
+                self._count(port, error=msg)
+                if not self.supervised:
+                    return None
+            self._stopped.wait(delay)
+            delay = min(delay*2, Sportiduino.RECONNECT_MAX_DELAY)
+        return None
+
+    def _run(self, port):
+        station = self._open(port)
+        if station is None:
+            return
+
+        self._stations[port] = station
+        with self._stats_lock:
+            self._stats[port]['connected'] = True
+            self._stats[port]['started'] = time.time()
+            self._stats[port]['stopped'] = None
+
+        try:
+            if self.continuous:
+                station.enable_continuous_read()
+            while not self._stopped.is_set():
+                try:
+                    if self.continuous:
+                        card_data = station.wait_card(timeout=0.5)
+                    elif station.poll_card():
+                        card_data = station.card_data
+                    else:
+                        continue
+                except SportiduinoException as msg:
+                    self._count(port, error=msg)
+                    time.sleep(Sportiduino.ERROR_DELAY)
+                    continue
+
+                if card_data is not None:
+                    self._count(port, card_data=card_data)
+                    self.cards.put((port, card_data))
+        finally:
+            try:
+                if self.continuous:
+                    station.disable_continuous_read()
+            except (SportiduinoException, EnvironmentError):
+                pass
+            station.disconnect()
+            with self._stats_lock:
+                self._stats[port]['connected'] = False
+                self._stats[port]['stopped'] = time.time()
+            del self._stations[port]
@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sportiduino_server.py - Serve one master station to many network clients.
+
+The server owns the serial port and talks JSON lines over TCP or a Unix
+socket. Every card read by the station is sent to all clients:
+
+    {"type": "card", "time": 1520264923.5, "card": {...}, "data": "0009..."}
+
+"card" is the card as written by JsonLinesExporter, "data" the hex
+RESP_CARD_DATA payload and "time" the Unix time the server got the card.
+Clients send commands, which are run one by one on the station:
+
+    {"id": 1, "command": "init_card", "args": [12]}
+    {"type": "result", "id": 1, "result": null}
+    {"type": "error", "id": 1, "error": "Card write failed"}
+
+A client can stop and resume card events with the "unsubscribe" and
+"subscribe" commands.
+"""
+
+import binascii
+import json
+import os
+import socket
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from sportiduino_compat import queue, string_types
+from sportiduino import Sportiduino, SportiduinoException
+from sportiduino_export import card_json
+from sportiduino_shared import SharedSportiduino
+
+
+DEFAULT_PORT = 7400
+
+# Station commands clients may call
+COMMANDS = (
+    'beep_ok', 'beep_error', 'read_version', 'read_card', 'read_card_raw', 'read_backup',
+    'init_card', 'init_backupreader', 'init_sleepcard', 'init_cp_number_card',
+    'init_time_card', 'init_passwd_card', 'write_pages6_7',
+)
+
+# Index of the first argument given as hex string
+_PAGE_ARGS = {'init_card': 1, 'write_pages6_7': 0}
+
+
+class StationServer(object):
+    """Master station served to clients over TCP or Unix socket.
+
+    Cards are encoded once and put into a bounded queue of every client,
+    a writer thread per client sends them. A client which does not keep up
+    is disconnected, or with overflow='drop' loses its oldest queued
+    cards. Commands of a client are run one after another, the next
+    command line is read after the result is queued, so a client can not
+    flood the station. Usage:
+
+        server = StationServer('/dev/ttyUSB0', ('0.0.0.0', 7400))
+        server.serve_forever()
+
+        # Unix socket, server in background thread
+        server = StationServer(address='/run/sportiduino.sock')
+        server.start()
+        ...
+        server.close()
+    """
+
+    def __init__(self, port=None, address=('127.0.0.1', DEFAULT_PORT), queue_size=256,
+                 overflow='disconnect', continuous=True, **options):
+        """Connect to master station and bind server socket.
+        @param port:       Serial device (default detect, see Sportiduino).
+        @param address:    (host, port) tuple for TCP or path of Unix socket.
+        @param queue_size: Messages queued per client.
+        @param overflow:   'disconnect' or 'drop' (oldest cards) when
+                           a client queue is full.
+        @param continuous: Enable continuous read mode, otherwise cards
+                           come only from read_card commands of clients.
+        @param options:    Other Sportiduino arguments. A journal given
+                           here gets the cards before clients.
+        """
+        if overflow not in ('disconnect', 'drop'):
+            raise ValueError("overflow must be 'disconnect' or 'drop'")
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self._clients = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+        if isinstance(address, string_types):
+            self._server = _UnixServer(address, _Handler)
+        else:
+            self._server = _TCPServer(address, _Handler)
+        self._server.station_server = self
+        self.address = self._server.server_address
+        try:
+            self.station = SharedSportiduino(port, continuous=continuous, **options)
+        except Exception:
+            self._close_socket()
+            raise
+        self.station.subscribe(self._card_received, records=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def serve_forever(self):
+        """Accept clients until close() is called."""
+        self._server.serve_forever()
+
+    def start(self):
+        """Accept clients in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, name='sportiduino server')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """Disconnect clients, stop server and close the station."""
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+        self._close_socket()
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            client.close()
+        self.station.close()
+
+    def clients(self):
+        """Connected clients.
+        @return: List of dictionaries with keys 'address', 'queued',
+                 'sent' and 'dropped'.
+        """
+        with self._lock:
+            return [client.stats() for client in self._clients]
+
+    def broadcast_card(self, record):
+        """Send card to all subscribed clients.
+        @param record: CardRecord object.
+        """
+        payload = record.tobytes()
+        self.broadcast({
+            'type': 'card',
+            'time': time.time(),
+            'card': card_json(record),
+            'data': binascii.hexlify(payload).decode('ascii'),
+        })
+
+    def broadcast(self, message):
+        """Send message dictionary to all subscribed clients."""
+        line = _encode(message)
+        with self._lock:
+            clients = [client for client in self._clients if client.subscribed]
+        for client in clients:
+            client.send_event(line)
+
+    def _card_received(self, record):
+        """Subscriber of cards pushed by the station."""
+        self.broadcast_card(record)
+
+    def _add_client(self, client):
+        with self._lock:
+            self._clients.append(client)
+
+    def _remove_client(self, client):
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+
+    def _close_socket(self):
+        self._server.server_close()
+        if isinstance(self.address, string_types) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+    def _run_command(self, request):
+        """Run client command request.
+        @return: Result or error message dictionary.
+        """
+        request_id = request.get('id')
+        command = request.get('command')
+        try:
+            if command not in COMMANDS:
+                raise SportiduinoException('Unknown command %r' % command)
+            args = _decode_args(command, request.get('args', []))
+            if command == 'read_card':
+                # Card read on request is sent to all clients as well
+                record = self.station.submit(Sportiduino.read_card_record, *args).result()
+                self.broadcast_card(record)
+                result = record.to_dict()
+            else:
+                result = self.station.submit(getattr(Sportiduino, command), *args).result()
+        except Exception as msg:
+            return {'type': 'error', 'id': request_id, 'error': str(msg)}
+        return {'type': 'result', 'id': request_id, 'result': _to_json(result)}
+
+
+class _Client(object):
+    """Connected client with bounded send queue and writer thread."""
+
+    # Interval to check if the client was closed while waiting for queue
+    SEND_WAIT = 0.5
+
+    def __init__(self, server, sock, address):
+        self.server = server
+        self.sock = sock
+        self.address = address
+        self.subscribed = True
+        self.sent = 0
+        self.dropped = 0
+        self._queue = queue.Queue(server.queue_size)
+        self._closed = False
+        self._writer = threading.Thread(target=self._run_writer, name='sportiduino client %s' % (address,))
+        self._writer.daemon = True
+        self._writer.start()
+
+    def stats(self):
+        return {'address': self.address, 'queued': self._queue.qsize(),
+                'sent': self.sent, 'dropped': self.dropped}
+
+    def send_event(self, line):
+        """Queue card without blocking the station thread."""
+        while True:
+            try:
+                self._queue.put_nowait(line)
+                return
+            except queue.Full:
+                if self.server.overflow == 'disconnect':
+                    self.server.station.station._log_info(
+                        "Warning: client %s is too slow, disconnected" % (self.address,))
+                    self.close()
+                    return
+            try:
+                self._queue.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+
+    def send(self, line):
+        """Queue reply, waits while the queue is full."""
+        while not self._closed:
+            try:
+                self._queue.put(line, timeout=_Client.SEND_WAIT)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.server._remove_client(self)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except EnvironmentError:
+            pass
+        # Wake up writer
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def _run_writer(self):
+        while True:
+            line = self._queue.get()
+            if line is None or self._closed:
+                return
+            try:
+                self.sock.sendall(line)
+            except EnvironmentError:
+                self.close()
+                return
+            self.sent += 1
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server.station_server
+        client = _Client(server, self.request, self.client_address)
+        server._add_client(client)
+        try:
+            client.send(_encode({'type': 'hello', 'station': server.station.station.port,
+                                 'commands': list(COMMANDS)}))
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                    command = request['command']
+                except (ValueError, KeyError, TypeError):
+                    client.send(_encode({'type': 'error', 'id': None, 'error': 'Bad request'}))
+                    continue
+                if command in ('subscribe', 'unsubscribe'):
+                    client.subscribed = command == 'subscribe'
+                    client.send(_encode({'type': 'result', 'id': request.get('id'), 'result': None}))
+                    continue
+                client.send(_encode(server._run_command(request)))
+        except EnvironmentError:
+            pass
+        finally:
+            client.close()
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class _UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+else:
+    def _UnixServer(address, handler):
+        raise SportiduinoException('Unix sockets are not supported on this platform')
+
+
+class StationClient(object):
+    """Client of StationServer.
+
+    A reader thread receives messages. Cards are put into the cards queue,
+    command results complete futures. Usage:
+
+        client = StationClient(('127.0.0.1', 7400))
+        for event in client.iter_cards():
+            print(event['card']['card_number'])
+            client.call('beep_ok')
+    """
+
+    def __init__(self, address=('127.0.0.1', DEFAULT_PORT), timeout=5):
+        """
+        @param address: (host, port) tuple or path of Unix socket.
+        @param timeout: Connection timeout in seconds.
+        """
+        if isinstance(address, string_types):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(timeout)
+        self.sock.connect(address)
+        self.sock.settimeout(None)
+        self.cards = queue.Queue()
+        self.hello = None
+        self._connected = threading.Event()
+        self._pending = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._run_reader, name='sportiduino client')
+        self._reader.daemon = True
+        self._reader.start()
+        self._connected.wait(timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def call(self, command, *args):
+        """Run station command on the server.
+        @param command: Name from COMMANDS, 'subscribe' or 'unsubscribe'.
+        @param args:    Command arguments, pages as hex strings.
+        @return:        Future of the result, SportiduinoException on error.
+        """
+        future = Future()
+        with self._lock:
+            self._next_id += 1
+            request_id = self._next_id
+            self._pending[request_id] = future
+            self.sock.sendall(_encode({'id': request_id, 'command': command, 'args': list(args)}))
+        return future
+
+    def iter_cards(self, timeout=None):
+        """Yield card messages.
+        @param timeout: Stop after this many seconds without a card.
+        """
+        while True:
+            try:
+                message = self.cards.get(timeout=timeout)
+            except queue.Empty:
+                return
+            if message is None:
+                return
+            yield message
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except EnvironmentError:
+            pass
+        self.sock.close()
+
+    def _run_reader(self):
+        try:
+            for line in self.sock.makefile('rb'):
+                message = json.loads(line.decode('utf-8'))
+                kind = message.get('type')
+                if kind == 'card':
+                    message['received'] = time.time()
+                    self.cards.put(message)
+                elif kind == 'hello':
+                    self.hello = message
+                    self._connected.set()
+                elif kind in ('result', 'error'):
+                    with self._lock:
+                        future = self._pending.pop(message.get('id'), None)
+                    if future is None:
+                        continue
+                    if kind == 'result':
+                        future.set_result(message['result'])
+                    else:
+                        future.set_exception(SportiduinoException(message['error']))
+        except (EnvironmentError, ValueError):
+            pass
+        finally:
+            self.cards.put(None)
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            for future in pending.values():
+                future.set_exception(SportiduinoException('Connection closed'))
+
+
+def _encode(message):
+    return (json.dumps(message) + '\n').encode('utf-8')
+
+
+def _decode_args(command, args):
+    if command in _PAGE_ARGS:
+        first = _PAGE_ARGS[command]
+        return [binascii.unhexlify(arg) if i >= first and isinstance(arg, string_types) else arg
+                for i, arg in enumerate(args)]
+    if command == 'init_time_card' and args:
+        if args[0] is None:
+            return []
+        return [datetime.strptime(args[0], '%Y-%m-%dT%H:%M:%S')]
+    return args
+
+
+def _to_json(value):
+    """Command result with datetimes as ISO strings and bytes as hex."""
+    if isinstance(value, dict):
+        return dict((str(k), _to_json(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray)) and not isinstance(value, string_types):
+        return binascii.hexlify(bytes(value)).decode('ascii')
+    if isinstance(value, Sportiduino.Version):
+        return str(value)
+    return value
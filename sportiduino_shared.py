@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sportiduino_shared.py - Master station shared by several threads.
+"""
+
+from concurrent.futures import Future
+import threading
+import time
+
+from sportiduino_compat import queue
+from sportiduino import Sportiduino, SportiduinoException
+
+
+class SharedSportiduino(object):
+    """Master station owned by a dedicated I/O thread.
+
+    Commands may be called from any thread. They are queued to the I/O
+    thread, which runs them one by one, and return
+    concurrent.futures.Future objects. In continuous read mode cards pushed
+    by the station are passed to subscribers between commands, cards
+    received while a command waits for its response are passed after it.
+    Usage:
+
+        station = SharedSportiduino('/dev/ttyUSB0', continuous=True)
+        station.subscribe(lambda card_data: print(card_data['card_number']))
+        ...
+        station.beep_ok()                  # e.g. from GUI thread
+        station.init_card(12).result()     # wait for RESP_OK
+        station.close()
+    """
+
+    # Time the I/O thread waits for a pushed card before it checks queued
+    # commands, seconds
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, port=None, continuous=False, **options):
+        """Connect to master station and start I/O thread.
+        @param port:       Serial device (default detect, see Sportiduino).
+        @param continuous: Enable continuous read mode.
+        @param options:    Other Sportiduino arguments.
+        """
+        self.station = Sportiduino(port, **options)
+        self.continuous = False
+        self._work = queue.Queue()
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='sportiduino %s' % self.station.port)
+        self._thread.daemon = True
+        self._thread.start()
+        if continuous:
+            self.enable_continuous_read()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def submit(self, method, *args, **kwargs):
+        """Run Sportiduino method in the I/O thread.
+        @param method: Function called with Sportiduino object and args,
+                       e.g. Sportiduino.read_card.
+        @return:       Future of the method result.
+        """
+        future = Future()
+        with self._lock:
+            if self._stopped.is_set():
+                raise SportiduinoException('Station is closed')
+            self._work.put((future, method, args, kwargs))
+        return future
+
+    def subscribe(self, callback=None, records=False):
+        """Receive cards pushed by the station in continuous read mode.
+        @param callback: Function called with card data dictionary in the
+                         I/O thread, it should return quickly. If None, a
+                         queue is created for the cards.
+        @param records:  Pass CardRecord objects instead of dictionaries.
+        @return:         Callback or queue to pass to unsubscribe().
+        """
+        subscriber = callback if callback is not None else queue.Queue()
+        with self._lock:
+            self._subscribers.append((subscriber, records))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers = [s for s in self._subscribers if s[0] is not subscriber]
+
+    def close(self, timeout=None):
+        """Stop I/O thread and disconnect. Queued commands fail.
+        @param timeout: Time to wait for the I/O thread.
+        """
+        with self._lock:
+            self._stopped.set()
+        self._thread.join(timeout)
+
+    def beep_ok(self):
+        return self.submit(Sportiduino.beep_ok)
+
+    def beep_error(self):
+        return self.submit(Sportiduino.beep_error)
+
+    def read_version(self, timeout=None):
+        return self.submit(Sportiduino.read_version, timeout)
+
+    def read_card(self, timeout=None):
+        return self.submit(Sportiduino.read_card, timeout)
+
+    def read_card_record(self, timeout=None):
+        return self.submit(Sportiduino.read_card_record, timeout)
+
+    def read_card_raw(self):
+        return self.submit(Sportiduino.read_card_raw)
+
+    def read_backup(self):
+        return self.submit(Sportiduino.read_backup)
+
+    def read_backup_raw(self):
+        return self.submit(Sportiduino.read_backup_raw)
+
+    def init_card(self, card_number, page6=None, page7=None):
+        return self.submit(Sportiduino.init_card, card_number, page6, page7)
+
+    def init_backupreader(self):
+        return self.submit(Sportiduino.init_backupreader)
+
+    def init_sleepcard(self):
+        return self.submit(Sportiduino.init_sleepcard)
+
+    def init_cp_number_card(self, cp_number):
+        return self.submit(Sportiduino.init_cp_number_card, cp_number)
+
+    def init_time_card(self, time=None):
+        return self.submit(Sportiduino.init_time_card, time)
+
+    def init_passwd_card(self, old_passwd=0, new_passwd=0, flags=0):
+        return self.submit(Sportiduino.init_passwd_card, old_passwd, new_passwd, flags)
+
+    def write_pages6_7(self, page6, page7):
+        return self.submit(Sportiduino.write_pages6_7, page6, page7)
+
+    def enable_continuous_read(self):
+        return self.submit(self._set_continuous, True)
+
+    def disable_continuous_read(self):
+        return self.submit(self._set_continuous, False)
+
+    def _set_continuous(self, station, enabled):
+        if enabled:
+            station.enable_continuous_read()
+        else:
+            station.disable_continuous_read()
+        self.continuous = enabled
+
+    def _publish(self, record):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        card_dict = None
+        for subscriber, records in subscribers:
+            if records:
+                card_data = record
+            else:
+                # Decode once for all subscribers
+                if card_dict is None:
+                    card_dict = record.to_dict()
+                card_data = card_dict
+            if isinstance(subscriber, queue.Queue):
+                subscriber.put(card_data)
+                continue
+            try:
+                subscriber(card_data)
+            except Exception as msg:
+                self.station._log_info("Warning: card subscriber failed: %s" % msg)
+
+    def _run(self):
+        station = self.station
+        try:
+            while not self._stopped.is_set():
+                if self.continuous:
+                    # Do not hold queued commands while waiting for a card
+                    timeout = 0 if not self._work.empty() else SharedSportiduino.POLL_INTERVAL
+                    try:
+                        record = station.wait_card_record(timeout=timeout)
+                    except SportiduinoException as msg:
+                        # Queued commands still run, they fail with the
+                        # port error rather than wait forever
+                        station._log_debug("Warning: %s" % msg)
+                        time.sleep(Sportiduino.ERROR_DELAY)
+                        record = None
+                    if record is not None:
+                        self._publish(record)
+                        continue
+
+                try:
+                    work = self._work.get(timeout=0 if self.continuous else SharedSportiduino.POLL_INTERVAL)
+                except queue.Empty:
+                    continue
+                self._execute(*work)
+        finally:
+            self._shutdown()
+
+    def _execute(self, future, method, args, kwargs):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = method(self.station, *args, **kwargs)
+        except BaseException as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+
+    def _shutdown(self):
+        while True:
+            try:
+                future, method, args, kwargs = self._work.get_nowait()
+            except queue.Empty:
+                break
+            if future.set_running_or_notify_cancel():
+                future.set_exception(SportiduinoException('Station is closed'))
+        try:
+            if self.continuous:
+                self.station.disable_continuous_read()
+                # Cards pushed before the mode was disabled
+                while True:
+                    record = self.station.wait_card_record(timeout=0)
+                    if record is None:
+                        break
+                    self._publish(record)
+        except (SportiduinoException, EnvironmentError):
+            pass
+        self.station.disconnect()
@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+sportiduino_store.py - Compact in-memory store of event readouts.
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+import threading
+
+from sportiduino import Sportiduino, CardRecord
+from sportiduino_export import _dict_raw
+
+
+# Version of correction which never matches
+_STALE = object()
+
+
+class _SortedColumn(object):
+    """Card numbers of one check point sorted by a time key.
+
+    Keys and cards are parallel arrays, so an entry takes 6 bytes.
+    """
+
+    __slots__ = ('keys', 'cards')
+
+    def __init__(self, typecode):
+        self.keys = array(typecode)
+        self.cards = array('H')
+
+    def __len__(self):
+        return len(self.keys)
+
+    def insert(self, key, card_number):
+        # Punches come roughly in time order, so this is mostly an append
+        i = bisect_right(self.keys, key)
+        self.keys.insert(i, key)
+        self.cards.insert(i, card_number)
+
+    def remove(self, key, card_number):
+        i = bisect_left(self.keys, key)
+        end = bisect_right(self.keys, key, i)
+        for j in range(i, end):
+            if self.cards[j] == card_number:
+                del self.keys[j]
+                del self.cards[j]
+                return
+
+    def range(self, lo, hi):
+        """Index range of keys in [lo, hi], None for open end."""
+        start = bisect_left(self.keys, lo) if lo is not None else 0
+        end = bisect_right(self.keys, hi) if hi is not None else len(self.keys)
+        return start, end
+
+
+class EventStore(object):
+    """Punches of all readouts of an event in columnar arrays.
+
+    Punches are kept in three arrays (card number, check point, Unix time),
+    with the check point indexes about 30 bytes per punch. Rows of a card
+    are contiguous, so a card index only keeps their position. Every check
+    point has its punches sorted by time and, for started cards, by running
+    time, so queries are bisections. A new readout of a card replaces its
+    punches.
+
+    With a ClockCorrection (see sportiduino_clock) queries use corrected
+    times, raw times are kept. When the correction changes, all punches are
+    corrected again in one vectorized pass (requires NumPy) on the next
+    update or query.
+
+    The store is thread safe, it can be filled by a readout thread while
+    another thread serves results. Usage:
+
+        store = EventStore()
+        sportiduino = Sportiduino(journal=store)     # or store.add_card(data)
+        ...
+        store.last_at(31, 10)       # last 10 punches at CP 31
+        store.running_order(100)    # order at control 100 by running time
+        store.unfinished()          # cards started but not finished
+    """
+
+    # Rebuild arrays when this share of rows belongs to replaced readouts
+    COMPACT_RATIO = 0.5
+
+    def __init__(self, correction=None):
+        """
+        @param correction: ClockCorrection for punch times.
+        """
+        self._cards = array('H')
+        self._cps = array('B')
+        self._epochs = array('I')
+        # Corrected times, the same as _epochs without correction
+        self._times = self._epochs
+        # card number -> (first row, row count, start, finish, raw start, raw finish),
+        # times are None if not punched
+        self._index = {}
+        self._by_time = {}
+        self._by_elapsed = {}
+        # Check point -> cards from backups, these have no time
+        self._visits = {}
+        self._unfinished = set()
+        self._dead = 0
+        self._lock = threading.Lock()
+        self.correction = None
+        self._version = None
+        if correction is not None:
+            self.set_correction(correction)
+
+    def __len__(self):
+        """Number of stored punches."""
+        return len(self._epochs) - self._dead
+
+    def __contains__(self, card_number):
+        return card_number in self._index
+
+    def add_card(self, card):
+        """Add or replace readout of card.
+        @param card: CardRecord or card data dictionary from
+                     Sportiduino.read_card().
+        """
+        if isinstance(card, CardRecord):
+            card_number = card.card_number
+            raw = card.iter_raw()
+        else:
+            card_number = card['card_number']
+            raw = _dict_raw(card)
+        punches = []
+        start = finish = None
+        for cp, epoch in raw:
+            if cp == Sportiduino.START_STATION:
+                start = epoch
+            elif cp == Sportiduino.FINISH_STATION:
+                finish = epoch
+            else:
+                punches.append((cp, epoch))
+
+        with self._lock:
+            self._check_correction()
+            if card_number in self._index:
+                self._remove(card_number)
+            first = len(self._epochs)
+            start_time = self._correct(Sportiduino.START_STATION, start)
+            for cp, epoch in punches:
+                time = self._correct(cp, epoch)
+                self._cards.append(card_number)
+                self._cps.append(cp)
+                self._epochs.append(epoch)
+                if self._times is not self._epochs:
+                    self._times.append(time)
+                self._column(self._by_time, cp, 'I').insert(time, card_number)
+                if start is not None:
+                    self._column(self._by_elapsed, cp, 'i').insert(time - start_time, card_number)
+            self._index[card_number] = (first, len(punches), start_time,
+                                        self._correct(Sportiduino.FINISH_STATION, finish),
+                                        start, finish)
+            if finish is None and (start is not None or punches):
+                self._unfinished.add(card_number)
+            else:
+                self._unfinished.discard(card_number)
+            if self._dead > len(self._epochs)*EventStore.COMPACT_RATIO:
+                self._compact()
+
+    def append(self, payload):
+        """Add RESP_CARD_DATA payload, so the store can be passed as
+        journal to Sportiduino.
+        """
+        self.add_card(CardRecord(bytes(payload)))
+
+    def add_backup(self, backup):
+        """Add check point visits from backup.
+        @param backup: Dictionary from Sportiduino.read_backup().
+        """
+        with self._lock:
+            cards = self._visits.setdefault(backup['cp'], set())
+            for card_number in backup['cards']:
+                cards.add(card_number)
+                if card_number not in self._index:
+                    self._unfinished.add(card_number)
+
+    def set_correction(self, correction):
+        """Set clock correction and correct all stored punches.
+        @param correction: ClockCorrection or None for raw times.
+        """
+        with self._lock:
+            self.correction = correction
+            self._version = _STALE
+            self._check_correction()
+
+    def card_punches(self, card_number, raw=False):
+        """Punches of card without start and finish.
+        @param card_number: Card number.
+        @param raw:         Return station times without correction.
+        @return:            List of (cp, Unix time) tuples in card order,
+                            empty if card was not read.
+        """
+        with self._lock:
+            self._check_correction()
+            if card_number not in self._index:
+                return []
+            first, count = self._index[card_number][:2]
+            times = self._epochs if raw else self._times
+            return list(zip(self._cps[first:first + count], times[first:first + count]))
+
+    def card_times(self, card_number, raw=False):
+        """Start and finish of card.
+        @param raw: Return station times without correction.
+        @return:    Tuple (start, finish) in Unix time, None if not punched.
+        """
+        with self._lock:
+            self._check_correction()
+            entry = self._index[card_number]
+            return entry[4:6] if raw else entry[2:4]
+
+    def punches_at(self, cp, since=None, until=None):
+        """Punches at check point in a time range.
+        @param cp:    Check point number.
+        @param since: Unix time of range start (default open).
+        @param until: Unix time of range end, inclusive (default open).
+        @return:      List of (card number, Unix time) tuples by time.
+        """
+        with self._lock:
+            self._check_correction()
+            column = self._by_time.get(cp)
+            if column is None:
+                return []
+            start, end = column.range(since, until)
+            return list(zip(column.cards[start:end], column.keys[start:end]))
+
+    def last_at(self, cp, n=10):
+        """Last punches at check point.
+        @param cp: Check point number.
+        @param n:  Number of punches.
+        @return:   List of (card number, Unix time) tuples, newest first.
+        """
+        with self._lock:
+            self._check_correction()
+            column = self._by_time.get(cp)
+            if column is None or n <= 0:
+                return []
+            start = max(len(column) - n, 0)
+            return list(zip(column.cards[start:][::-1], column.keys[start:][::-1]))
+
+    def running_order(self, cp, n=None):
+        """Cards at control by running time from start.
+        @param cp: Check point number.
+        @param n:  Number of leading cards (default all).
+        @return:   List of (card number, seconds from start) tuples.
+        """
+        with self._lock:
+            self._check_correction()
+            column = self._by_elapsed.get(cp)
+            if column is None:
+                return []
+            end = len(column) if n is None else min(n, len(column))
+            return list(zip(column.cards[:end], column.keys[:end]))
+
+    def position(self, cp, card_number):
+        """Place of card in running order at control.
+        @return: 1-based place or None if card has no timed punch at cp.
+        """
+        with self._lock:
+            self._check_correction()
+            column = self._by_elapsed.get(cp)
+            entry = self._index.get(card_number)
+            if column is None or entry is None or entry[2] is None:
+                return None
+            first, count, start = entry[:3]
+            for i in range(first, first + count):
+                if self._cps[i] == cp:
+                    elapsed = self._times[i] - start
+                    # Ties share the place
+                    return bisect_left(column.keys, elapsed) + 1
+            return None
+
+    def cards_at(self, cp):
+        """Cards which visited check point, from readouts and backups.
+        @return: Sorted list of card numbers.
+        """
+        with self._lock:
+            cards = set(self._visits.get(cp, ()))
+            column = self._by_time.get(cp)
+            if column is not None:
+                cards.update(column.cards)
+            return sorted(cards)
+
+    def unfinished(self):
+        """Cards with start or control punches, or seen in backups, which
+        have no finish punch.
+        @return: Sorted list of card numbers.
+        """
+        with self._lock:
+            return sorted(self._unfinished)
+
+    def _column(self, columns, cp, typecode):
+        column = columns.get(cp)
+        if column is None:
+            column = columns[cp] = _SortedColumn(typecode)
+        return column
+
+    def _correct(self, cp, epoch):
+        if self.correction is None or epoch is None:
+            return epoch
+        return self.correction.correct(cp, epoch)
+
+    def _check_correction(self):
+        """Correct all punches again if correction has changed."""
+        version = self.correction.version if self.correction is not None else None
+        if version == self._version:
+            return
+        self._version = version
+        self._compact()
+        if self.correction is None:
+            self._times = self._epochs
+        else:
+            self._times = array('I', self.correction.correct_many(self._cps, self._epochs).tolist())
+        for card_number, entry in self._index.items():
+            start, finish = entry[4:6]
+            self._index[card_number] = entry[:2] + (
+                self._correct(Sportiduino.START_STATION, start),
+                self._correct(Sportiduino.FINISH_STATION, finish), start, finish)
+        self._rebuild_columns()
+
+    def _rebuild_columns(self):
+        """Sort check point columns by time and running time at once."""
+        import numpy as np
+
+        if not self._times:
+            self._by_time, self._by_elapsed = {}, {}
+            return
+
+        cps = np.frombuffer(self._cps, dtype=np.uint8)
+        cards = np.frombuffer(self._cards, dtype=np.uint16)
+        times = np.frombuffer(self._times, dtype=np.uint32).astype(np.int64)
+        # Rows are in card index order after compaction
+        entries = list(self._index.values())
+        counts = [entry[1] for entry in entries]
+        starts = np.repeat([entry[2] if entry[2] is not None else -1 for entry in entries], counts)
+        started = np.repeat([entry[2] is not None for entry in entries], counts).astype(bool)
+
+        self._by_time = self._sorted_columns(cps, cards, times, 'I')
+        self._by_elapsed = self._sorted_columns(cps[started], cards[started],
+                                                (times - starts)[started], 'i')
+
+    @staticmethod
+    def _sorted_columns(cps, cards, keys, typecode):
+        import numpy as np
+
+        order = np.lexsort((keys, cps))
+        cps, cards, keys = cps[order], cards[order], keys[order]
+        columns = {}
+        bounds = np.flatnonzero(np.diff(cps)) + 1
+        for begin, end in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(cps)]))):
+            if begin == end:
+                continue
+            column = columns[int(cps[begin])] = _SortedColumn(typecode)
+            column.keys = array(typecode, keys[begin:end].tolist())
+            column.cards = array('H', cards[begin:end].tolist())
+        return columns
+
+    def _remove(self, card_number):
+        first, count, start = self._index.pop(card_number)[:3]
+        for i in range(first, first + count):
+            cp, time = self._cps[i], self._times[i]
+            self._by_time[cp].remove(time, card_number)
+            if start is not None:
+                self._by_elapsed[cp].remove(time - start, card_number)
+        self._dead += count
+
+    def _compact(self):
+        if not self._dead:
+            return
+        corrected = self._times is not self._epochs
+        cards, cps, epochs = array('H'), array('B'), array('I')
+        times = array('I') if corrected else epochs
+        for card_number, entry in self._index.items():
+            first, count = entry[:2]
+            self._index[card_number] = (len(epochs), count) + entry[2:]
+            cards.extend(self._cards[first:first + count])
+            cps.extend(self._cps[first:first + count])
+            epochs.extend(self._epochs[first:first + count])
+            if corrected:
+                times.extend(self._times[first:first + count])
+        self._cards, self._cps, self._epochs, self._times = cards, cps, epochs, times
+        self._dead = 0
+
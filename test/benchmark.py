@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""
+Protocol benchmark on FakeMasterStation.
+
+Measures operations per second, p50/p99 latency, CPU time and memory
+allocations per operation of the Sportiduino client. The emulator runs in
+a separate process, so CPU time is counted for the client only. Results can
+be saved and compared with a previous run:
+
+    python benchmark.py --json before.json
+    python benchmark.py --compare before.json
+
+Per-card readout time at several line speeds, the emulator delays
+responses by the speed the client has set:
+
+    python benchmark.py --ops read_card --line-speeds 9600 57600 115200
+"""
+
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+import tracemalloc
+
+sys.path.append('..')
+
+from fakemasterstation import FakeMasterStation
+from sportiduino import Sportiduino
+
+
+def _poll_card(sportiduino):
+    if not sportiduino.poll_card():
+        raise RuntimeError('Card is not read')
+
+
+def _init_card(sportiduino):
+    # Wait for RESP_OK, so answers do not pile up in the input buffer
+    with sportiduino.batch() as batch:
+        result = batch.init_card(1)
+    result.result()
+
+
+OPERATIONS = {
+    'poll_card': _poll_card,
+    'read_card': lambda sportiduino: sportiduino.read_card(),
+    'read_backup': lambda sportiduino: sportiduino.read_backup(),
+    'init_card': _init_card,
+}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values)*p/100.0))]
+
+
+def start_station(args, baudrate):
+    """Run emulator in a child process.
+    @return: Tuple (port, process).
+    """
+    fms = FakeMasterStation(seed=args.seed, max_punches=args.punches, card_every=1,
+                            baudrate=baudrate, latency=args.latency, verbose=False)
+    process = multiprocessing.Process(target=fms.run)
+    process.daemon = True
+    process.start()
+    return fms.port, process
+
+
+def run_operation(sportiduino, operation, count):
+    latencies = []
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    for _ in range(count):
+        t = time.perf_counter()
+        operation(sportiduino)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+
+    # Separate pass, tracing slows down the calls
+    tracemalloc.start()
+    for _ in range(min(count, 100)):
+        operation(sportiduino)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'ops_per_second': count/elapsed,
+        'p50_ms': percentile(latencies, 50)*1000,
+        'p99_ms': percentile(latencies, 99)*1000,
+        'cpu_us_per_op': cpu/count*1e6,
+        'alloc_peak_kib': peak/1024.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sportiduino protocol benchmark')
+    parser.add_argument('-n', '--count', type=int, default=200, help='operations per test')
+    parser.add_argument('--ops', nargs='+', choices=sorted(OPERATIONS), default=sorted(OPERATIONS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--punches', type=int, default=50, help='maximum punches on card')
+    parser.add_argument('--baudrate', type=int, default=0, help='emulated line speed, 0 - no delay')
+    parser.add_argument('--latency', type=float, default=0.0, help='station response delay, s')
+    parser.add_argument('--line-speeds', type=int, nargs='+',
+                        help='run operations at each line speed, emulator follows the client speed')
+    parser.add_argument('--json', help='save results to file')
+    parser.add_argument('--compare', help='compare with results saved by --json')
+    args = parser.parse_args()
+
+    results = {}
+    if args.line_speeds:
+        for line_speed in args.line_speeds:
+            port, process = start_station(args, baudrate=-1)
+            sportiduino = Sportiduino(port, baudrate=line_speed)
+            for name in args.ops:
+                results['%s@%d' % (name, line_speed)] = run_operation(sportiduino, OPERATIONS[name],
+                                                                      args.count)
+            sportiduino.disconnect()
+            process.terminate()
+    else:
+        port, process = start_station(args, baudrate=args.baudrate)
+        sportiduino = Sportiduino(port)
+        for name in args.ops:
+            results[name] = run_operation(sportiduino, OPERATIONS[name], args.count)
+        sportiduino.disconnect()
+        process.terminate()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    columns = ['ops_per_second', 'p50_ms', 'p99_ms', 'cpu_us_per_op', 'alloc_peak_kib']
+    print('%-20s' % 'operation' + ''.join('%16s' % c for c in columns))
+    for name, result in sorted(results.items()):
+        line = '%-20s' % name
+        for column in columns:
+            cell = '%.2f' % result[column]
+            if baseline is not None and name in baseline and baseline[name][column]:
+                cell += ' %+.0f%%' % ((result[column]/baseline[name][column] - 1)*100)
+            line += '%16s' % cell
+        print(line)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
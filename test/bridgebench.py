@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+Fan-out latency of StationServer on FakeMasterStation.
+
+The emulator pushes cards in continuous read mode, the server broadcasts
+them to clients on localhost. Reported per number of clients:
+
+    fanout     - from server getting the card to client receiving it
+    end_to_end - from emulator writing the card to client receiving it
+
+    python bridgebench.py --clients 1 10 50 --cards 200
+    python bridgebench.py --unix /tmp/sportiduino.sock
+"""
+
+import argparse
+import sys
+import threading
+import time
+
+sys.path.append('..')
+
+from fakemasterstation import FakeMasterStation
+from sportiduino_server import StationServer, StationClient
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values)*p/100.0))]
+
+
+def run(args, clients_count):
+    fms = FakeMasterStation(seed=args.seed, max_punches=args.punches, verbose=False)
+    fms.start()
+    address = args.unix if args.unix else ('127.0.0.1', 0)
+    server = StationServer(fms.port, address=address, queue_size=args.queue_size)
+    server.start()
+    while not server.station.continuous:
+        time.sleep(0.01)
+
+    clients = [StationClient(server.address) for _ in range(clients_count)]
+    received = [[] for _ in clients]
+
+    def receive(client, times):
+        for message in client.iter_cards(timeout=2):
+            times.append((message['time'], message['received']))
+            if len(times) == args.cards:
+                return
+
+    threads = [threading.Thread(target=receive, args=(client, times))
+               for client, times in zip(clients, received)]
+    for thread in threads:
+        thread.start()
+
+    pushed = []
+    for _ in range(args.cards):
+        pushed.append(time.time())
+        fms.push_card()
+        time.sleep(args.interval)
+
+    for thread in threads:
+        thread.join()
+    for client in clients:
+        client.close()
+    server.close()
+    fms.stop()
+
+    fanout = [recv - sent for times in received for sent, recv in times]
+    end_to_end = [recv - pushed[i] for times in received for i, (sent, recv) in enumerate(times)]
+    lost = clients_count*args.cards - len(fanout)
+    return fanout, end_to_end, lost
+
+
+def main():
+    parser = argparse.ArgumentParser(description='StationServer fan-out latency')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--cards', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=0.01, help='pause between cards, s')
+    parser.add_argument('--punches', type=int, default=10, help='maximum punches on card')
+    parser.add_argument('--queue-size', type=int, default=256)
+    parser.add_argument('--unix', help='Unix socket path instead of TCP')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print('%8s %12s %12s %12s %12s %6s' % ('clients', 'fanout p50', 'fanout p99',
+                                          'e2e p50', 'e2e p99', 'lost'))
+    for clients_count in args.clients:
+        fanout, end_to_end, lost = run(args, clients_count)
+        print('%8d %10.2fms %10.2fms %10.2fms %10.2fms %6d' % (
+            clients_count, percentile(fanout, 50)*1000, percentile(fanout, 99)*1000,
+            percentile(end_to_end, 50)*1000, percentile(end_to_end, 99)*1000, lost))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+@pytest.fixture
+def fms_options():
+    """FakeMasterStation arguments, override in a module to change them."""
+    return {}
+
+
+@pytest.fixture
+def station(fms_options):
+    """FakeMasterStation serving commands in a background thread (POSIX)."""
+    pytest.importorskip('serial')
+    fakemasterstation = pytest.importorskip('fakemasterstation')
+
+    fms = fakemasterstation.FakeMasterStation(verbose=False, **fms_options)
+    fms.start()
+    yield fms
+    fms.stop()
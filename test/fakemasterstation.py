@@ -1,72 +1,237 @@
 #!/usr/bin/env python
 
 import os, pty
-
-from six import int2byte, byte2int, iterbytes, PY3
+import random
+import struct
+import termios
+import threading
 from time import sleep
 
-if PY3:
-    def byte2int(x):
-        try:
-            return x[0]
-        except TypeError:
-            return x
+
+START_BYTE = b'\xfe'
+OFFSET = 0x1E
+MAX_DATA_LEN = 28
+
+START_STATION = 240
+FINISH_STATION = 245
+
+# termios speed constant -> line speed
+SPEEDS = dict((getattr(termios, 'B%d' % rate), rate)
+              for rate in (9600, 19200, 38400, 57600, 115200, 230400)
+              if hasattr(termios, 'B%d' % rate))
+
+
+def checksum(s):
+    return bytes([sum(s) & 0xff])
+
+
+def make_frames(code, data):
+    """Split response into frames the way master station does.
+    All fragments except the last have length byte OFFSET + fragment number
+    and MAX_DATA_LEN bytes of data.
+    """
+    frames = []
+    fragment_num = 0
+    while len(data) > MAX_DATA_LEN:
+        body = code + bytes([OFFSET + fragment_num]) + data[:MAX_DATA_LEN]
+        frames.append(START_BYTE + body + checksum(body))
+        data = data[MAX_DATA_LEN:]
+        fragment_num += 1
+    body = code + bytes([len(data)]) + data
+    frames.append(START_BYTE + body + checksum(body))
+    return frames
 
 
 class FakeMasterStation(object):
-    
-    def __init__(self):
+    """Master station emulator on a pseudo terminal.
+
+    Card contents are generated from seed. Responses can be delayed as on
+    a real serial line, and noise and bad checksums can be injected.
+    """
+
+    def __init__(self, seed=0, max_punches=3, card_every=4, baudrate=0, latency=0.0,
+                 noise=0.0, bad_checksum=0.0, version=210, backup_cards=100, rates=None,
+                 verbose=True):
+        """
+        @param seed:         Seed for generated cards and injected errors.
+        @param max_punches:  Maximum number of check point punches on card.
+        @param card_every:   Card is on the station for every n-th read
+                             command, other reads are not answered.
+        @param baudrate:     Emulated line speed, 0 - no delay, -1 - speed
+                             the client opened the port with.
+        @param latency:      Delay before each response in seconds.
+        @param noise:        Probability of garbage bytes before response.
+        @param bad_checksum: Probability of corrupted frame checksum.
+        @param version:      Firmware version byte.
+        @param backup_cards: Number of cards in backupreader dump.
+        @param rates:        Line speeds the firmware works at (default
+                             any). At other speed the client receives
+                             garbage as from a real UART.
+        """
         master, slave = pty.openpty()
         s_name = os.ttyname(slave)
-        print("FakeMasterStation port: %s" % s_name)
+        self.verbose = verbose
+        self.log("FakeMasterStation port: %s" % s_name)
         self.master = master
         self.slave = slave
         self.port = s_name
         self.count = 0
+        self.buffer = b''
+
+        self.random = random.Random(seed)
+        self.max_punches = max_punches
+        self.card_every = card_every
+        self.baudrate = baudrate
+        self.latency = latency
+        self.noise = noise
+        self.bad_checksum = bad_checksum
+        self.version = version
+        self.backup_cards = backup_cards
+        self.rates = rates
+        self.continuous = False
+        self.cards_sent = []
+        self._stopped = threading.Event()
+
+    def log(self, msg):
+        if self.verbose:
+            print(msg)
+
+    def start(self):
+        """Serve commands in a background thread."""
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.read()
+            except OSError:
+                return
+
+    def stop(self):
+        self._stopped.set()
 
     def read(self):
-        cmd = os.read(self.master,32)
-        print("=> %s" % ' '.join(hex(byte2int(c)) for c in cmd))
-        if cmd == b'\xfe\x46\x00\x46':
-            os.write(self.master, b'\xfe\x66\x01\xd2\x39') # version 2.10
-        elif cmd == b'\xfe\x59\x00\x59':
-            #os.write(self.master, b'\xfe\x79\x00\x79') # send Ok
-            pass
-        elif cmd == b'\xfe\x58\x00\x58':
-            #os.write(self.master, b'\xfe\x79\x00\x79') # send Ok
-            #os.write(self.master, b'\xfe\x78\x01\x01\x7a') # send COM err
+        self.buffer += os.read(self.master, 64)
+        # Handle every complete command, several may come in one write
+        while True:
+            start = self.buffer.find(START_BYTE)
+            if start < 0:
+                self.buffer = b''
+                return
+            self.buffer = self.buffer[start:]
+            if len(self.buffer) < 3 or len(self.buffer) < self.buffer[2] + 4:
+                return
+            size = self.buffer[2] + 4
+            cmd, self.buffer = self.buffer[:size], self.buffer[size:]
+            if checksum(cmd[1:-1]) != cmd[-1:]:
+                self.respond(b'\x78', b'\x01') # send COM err
+                continue
+            self.handle(cmd)
+
+    def handle(self, cmd):
+        self.log("=> %s" % ' '.join(hex(c) for c in cmd))
+        code = cmd[1:2]
+        params = cmd[3:-1]
+        if code == b'\x46':
+            self.respond(b'\x66', bytes([self.version]))
+        elif code in (b'\x58', b'\x59'):
+            # Beeps are not answered
             pass
-        elif cmd[:3] == b'\xfe\x41\x06':
-            os.write(self.master, b'\xfe\x79\x00\x79') # send Ok
-        elif cmd[:3] == b'\xfe\x42\x01':
-            os.write(self.master, b'\xfe\x79\x00\x79') # send Ok
-        elif cmd[:3] == b'\xfe\x44\x0e':
-            os.write(self.master, b'\xfe\x79\x00\x79') # send Ok
-        elif cmd == b'\xfe\x4b\x00\x4b':
+        elif code == b'\x49':
+            self.continuous = params == b'\x01'
+        elif code in (b'\x41', b'\x42', b'\x43', b'\x44', b'\x45', b'\x47', b'\x4e'):
+            self.respond(b'\x79', b'') # send Ok
+        elif code == b'\x4b':
             self.count += 1
-            if self.count%4 == 0:
-                os.write(self.master, b'\xfe\x63\x1e'
-                                    + b'\x00\x09'
-                                    + b'\x00\x00\x00\x00\x00\x00\x00\x00'
-                                    + b'\xf0'
-                                    + b'\x5a\x9d\x3c\xab'
-                                    + b'\x1f'
-                                    + b'\x5a\x9d\x3d\x0f'
-                                    + b'\x20'
-                                    + b'\x5a\x9d\x3d\x55'
-                                    + b'\x21'
-                                    + b'\x5a\x9d'
-                                    + b'\x7b')
-                os.write(self.master, b'\xfe\x63\x07'
-                                    + b'\x3d\xc3'
-                                    + b'\xf5'
-                                    + b'\x5a\x9d\x3e\x5b'
-                                    + b'\xef')
+            if self.count % self.card_every == 0:
+                self.push_card()
+        elif code == b'\x4c':
+            self.respond(b'\x65', self.make_raw())
+        elif code == b'\x48':
+            self.respond(b'\x61', self.make_backup())
+        else:
+            self.respond(b'\x78', b'\x01') # send COM err
+
+    def push_card(self, card_data=None):
+        """Send card data as after card read or in continuous mode.
+        @param card_data: Response payload (default generated card).
+        """
+        if card_data is None:
+            card_data = self.make_card()
+        self.cards_sent.append(card_data)
+        self.respond(b'\x63', card_data)
+
+    def respond(self, code, data):
+        frames = make_frames(code, data)
+        out = b''
+        if self.noise and self.random.random() < self.noise:
+            out += bytes(bytearray(self.random.randrange(256) for _ in range(self.random.randint(1, 8))))
+        for frame in frames:
+            if self.bad_checksum and self.random.random() < self.bad_checksum:
+                frame = frame[:-1] + bytes([(frame[-1] + 1) & 0xff])
+            out += frame
+        line_speed = self.line_speed()
+        if self.rates is not None and line_speed not in self.rates:
+            out = bytes(bytearray(self.random.randrange(256) for _ in range(len(out))))
+        if self.latency:
+            sleep(self.latency)
+        baudrate = line_speed if self.baudrate < 0 else self.baudrate
+        if baudrate:
+            # 10 bits per byte with start and stop bits
+            sleep(len(out)*10.0/baudrate)
+        os.write(self.master, out)
+
+    def line_speed(self):
+        """Speed the client has set on the port."""
+        return SPEEDS.get(termios.tcgetattr(self.slave)[5])
+
+    def make_card(self):
+        """Generate card payload with random punches."""
+        rnd = self.random
+        t = 1520254123 + rnd.randrange(86400)
+        data = struct.pack('>H', rnd.randint(1, 65535)) + b'\x00'*8
+        data += struct.pack('>BI', START_STATION, t)
+        for _ in range(rnd.randint(0, self.max_punches)):
+            t += rnd.randint(1, 600)
+            data += struct.pack('>BI', rnd.randint(31, 239), t)
+        t += rnd.randint(1, 600)
+        data += struct.pack('>BI', FINISH_STATION, t)
+        return data
+
+    def make_raw(self):
+        """Generate raw pages of card with page number and 4 bytes per page."""
+        data = b''
+        for page in range(4, 9):
+            data += bytes([page]) + struct.pack('>I', self.random.getrandbits(32))
+        return data
+
+    def make_backup(self):
+        """Generate backupreader dump of check point and card numbers."""
+        data = struct.pack('>H', self.random.randint(31, 239))
+        for _ in range(self.backup_cards):
+            data += struct.pack('>H', self.random.randint(1, 65535))
+        return data
 
 
 if __name__ == "__main__":
-    fms = FakeMasterStation()
+    import argparse
+    parser = argparse.ArgumentParser(description='Sportiduino master station emulator')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--punches', type=int, default=3, help='maximum punches on card')
+    parser.add_argument('--card-every', type=int, default=4, help='card is read on every n-th read command')
+    parser.add_argument('--baudrate', type=int, default=0,
+                        help='emulated line speed, 0 - no delay, -1 - speed set by client')
+    parser.add_argument('--rates', type=int, nargs='+', help='line speeds the firmware works at')
+    parser.add_argument('--latency', type=float, default=0.0, help='response delay, s')
+    parser.add_argument('--noise', type=float, default=0.0, help='probability of garbage before response')
+    parser.add_argument('--bad-checksum', type=float, default=0.0, help='probability of bad checksum')
+    args = parser.parse_args()
+    fms = FakeMasterStation(seed=args.seed, max_punches=args.punches, card_every=args.card_every,
+                            baudrate=args.baudrate, latency=args.latency, noise=args.noise,
+                            bad_checksum=args.bad_checksum, rates=args.rates)
     print('Reading...')
     while True:
         fms.read()
-
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks of module import and per-frame protocol functions.
+
+Import time is measured in fresh interpreters, best of several runs.
+Frame functions run without serial port:
+
+    python microbench.py
+    python microbench.py --json before.json
+    python microbench.py --compare before.json
+"""
+
+import argparse
+import json
+import os
+import struct
+import subprocess
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fakemasterstation import FakeMasterStation, make_frames
+from sportiduino import Sportiduino, FrameDecoder, CardRecord
+
+
+IMPORT_CODE = '''
+import sys, time
+t = time.perf_counter()
+import sportiduino
+print(time.perf_counter() - t, 'serial' in sys.modules)
+'''
+
+
+def import_time(runs):
+    """Best import time of sportiduino in new interpreters.
+    @return: Tuple (seconds, True if pyserial was imported).
+    """
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    best = None
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', IMPORT_CODE], cwd=root)
+        seconds, serial_imported = out.split()
+        seconds = float(seconds)
+        if best is None or seconds < best:
+            best = seconds
+    return best, serial_imported == b'True'
+
+
+def frame_benchmarks(punches):
+    fms = FakeMasterStation(verbose=False)
+    card = struct.pack('>H8x', 12)
+    for i in range(punches):
+        card += struct.pack('>BI', 31 + i, 1520254123 + i*60)
+    card_stream = b''.join(make_frames(b'\x63', card))
+    backup = fms.make_backup()
+    decoder = FrameDecoder()
+
+    def decode_card():
+        decoder.feed(card_stream)
+        decoder.next_frame()
+
+    return {
+        'make_command': lambda: Sportiduino._make_command(Sportiduino.CMD_INIT_CARD,
+                                                          Sportiduino._init_card_params(12)),
+        'checksum': lambda: Sportiduino._checsum(card),
+        'decode_card_frames': decode_card,
+        'parse_card_data': lambda: Sportiduino._parse_card_data(card),
+        'card_record_punches': lambda: CardRecord(card).punches_epoch,
+        'parse_backup': lambda: Sportiduino._parse_backup(backup),
+        'to_int': lambda: Sportiduino._to_int(card[:2]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sportiduino micro-benchmarks')
+    parser.add_argument('-n', '--number', type=int, default=20000, help='calls per function')
+    parser.add_argument('--import-runs', type=int, default=10)
+    parser.add_argument('--punches', type=int, default=50, help='punches on card')
+    parser.add_argument('--json', help='save results to file')
+    parser.add_argument('--compare', help='compare with results saved by --json')
+    args = parser.parse_args()
+
+    results = {}
+    seconds, serial_imported = import_time(args.import_runs)
+    results['import_sportiduino'] = seconds*1e6
+    print('pyserial imported by sportiduino: %s' % serial_imported)
+
+    for name, func in frame_benchmarks(args.punches).items():
+        results[name] = min(timeit.repeat(func, number=args.number, repeat=3))/args.number*1e6
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print('%-22s%16s' % ('benchmark', 'us_per_call'))
+    for name, value in sorted(results.items()):
+        cell = '%.2f' % value
+        if baseline is not None and baseline.get(name):
+            cell += ' %+.0f%%' % ((value/baseline[name] - 1)*100)
+        print('%-22s%16s' % (name, cell))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
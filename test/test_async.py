@@ -0,0 +1,108 @@
+"""
+asyncio client on FakeMasterStation.
+"""
+
+import asyncio
+
+import pytest
+
+pytest.importorskip('serial')
+
+from sportiduino import SportiduinoTimeout
+from sportiduino_async import AsyncSportiduino
+from testdata import card_numbers, push_when_continuous
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_commands(station):
+    station.card_every = 1
+
+    async def main():
+        async with AsyncSportiduino(station.port, timeout=1) as sportiduino:
+            version = await sportiduino.read_version()
+            card = await sportiduino.read_card()
+            record = await sportiduino.read_card_record()
+            backup = await sportiduino.read_backup()
+            await sportiduino.beep_ok()
+            return version, card, record, backup
+
+    version, card, record, backup = run(main())
+    assert version.value == station.version
+    assert [card['card_number'], record.card_number] == card_numbers(station.cards_sent)
+    assert len(backup['cards']) == station.backup_cards
+
+
+def test_read_card_timeout(station):
+    async def main():
+        async with AsyncSportiduino(station.port) as sportiduino:
+            # Emulator answers every 4th read card command
+            with pytest.raises(SportiduinoTimeout):
+                await sportiduino.read_card(timeout=0.1)
+            assert not await sportiduino.poll_card()
+
+    run(main())
+
+
+def test_iter_cards(station):
+    pusher = push_when_continuous(station, 5, interval=0.02)
+
+    async def main():
+        cards = []
+        async with AsyncSportiduino(station.port, timeout=1) as sportiduino:
+            it = sportiduino.iter_cards(timeout=1)
+            try:
+                async for card in it:
+                    # Commands between cards do not take pushed cards
+                    await sportiduino.beep_ok()
+                    assert (await sportiduino.read_version()).value == station.version
+                    cards.append(card['card_number'])
+                    if len(cards) == 5:
+                        break
+            finally:
+                # Closing the generator disables continuous read
+                await it.aclose()
+            # Wait for the emulator to handle the command
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + 1
+            while station.continuous and loop.time() < deadline:
+                await asyncio.sleep(0.01)
+        return cards
+
+    try:
+        assert run(main()) == card_numbers(station.cards_sent)
+    finally:
+        pusher.join()
+    assert not station.continuous
+
+
+def test_stations_in_one_loop(station):
+    import fakemasterstation
+
+    other = fakemasterstation.FakeMasterStation(verbose=False, version=220)
+    other.start()
+
+    async def read(port):
+        async with AsyncSportiduino(port, timeout=1) as sportiduino:
+            return (await sportiduino.read_version()).value
+
+    async def main():
+        return await asyncio.gather(read(station.port), read(other.port))
+
+    try:
+        results = run(main())
+    finally:
+        other.stop()
+    assert results == [station.version, 220]
+
+
+def test_connect_timeout():
+    import fakemasterstation
+
+    # Emulator is not started, the port is silent
+    silent = fakemasterstation.FakeMasterStation(verbose=False)
+    sportiduino = AsyncSportiduino(silent.port, connect_timeout=0.3)
+    with pytest.raises(SportiduinoTimeout):
+        run(sportiduino.connect())
@@ -0,0 +1,85 @@
+"""
+Pipelined command batches on FakeMasterStation.
+"""
+
+from sportiduino import Sportiduino, SportiduinoException, SportiduinoTimeout
+
+import pytest
+
+
+@pytest.fixture
+def fms_options():
+    # Read card commands are answered only with a card on the station
+    return {'card_every': 3}
+
+
+def test_results(station):
+    sportiduino = Sportiduino(station.port)
+    with sportiduino.batch(timeout=1) as batch:
+        version = batch.read_version()
+        beep = batch.beep_ok()
+        init = batch.init_card(12)
+        backup = batch.read_backup()
+        assert not version.done()
+        with pytest.raises(SportiduinoException):
+            version.result()
+    assert version.result().value == station.version
+    assert beep.done() and beep.result() is None
+    assert init.result() is None
+    assert len(backup.result()['cards']) == station.backup_cards
+    sportiduino.disconnect()
+
+
+def test_unanswered_command(station):
+    sportiduino = Sportiduino(station.port)
+    with sportiduino.batch(timeout=0.2) as batch:
+        # The first read finds no card, the version response comes before
+        # any card data
+        first = batch.read_card()
+        version = batch.read_version()
+        # Card is on the station for the third read, its data belongs to
+        # the oldest read waiting
+        second = batch.read_card()
+        third = batch.read_card()
+    with pytest.raises(SportiduinoException, match='No response'):
+        first.result()
+    assert version.result().value == station.version
+    assert second.result()['card_number'] == \
+        Sportiduino._parse_card_data(station.cards_sent[0])['card_number']
+    with pytest.raises(SportiduinoTimeout):
+        third.result()
+    sportiduino.disconnect()
+
+
+def test_error_response(station):
+    sportiduino = Sportiduino(station.port)
+    with sportiduino.batch(timeout=1) as batch:
+        unknown = batch.command(b'\x7f', response=Sportiduino.RESP_OK)
+        version = batch.read_version()
+    with pytest.raises(SportiduinoException):
+        unknown.result()
+    assert version.result().value == station.version
+    assert sportiduino.metrics.counters['error_responses'] == 1
+    sportiduino.disconnect()
+
+
+def test_silent_station(station):
+    sportiduino = Sportiduino(station.port)
+    with sportiduino.batch(timeout=0.1) as batch:
+        reads = [batch.read_card() for _ in range(2)]
+    for result in reads:
+        with pytest.raises(SportiduinoTimeout):
+            result.result()
+    sportiduino.disconnect()
+
+
+def test_more_than_receive_buffer(station):
+    sportiduino = Sportiduino(station.port)
+    batch = sportiduino.batch(timeout=1)
+    results = [batch.init_card(n) for n in range(1, 21)]
+    # Commands are sent in several writes as responses come
+    assert sum(len(cmd) for cmd, _, _ in batch._commands) > Sportiduino.RX_BUFFER_LEN
+    batch.send()
+    assert len(batch) == 0
+    assert [result.result() for result in results] == [None]*20
+    sportiduino.disconnect()
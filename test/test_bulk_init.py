@@ -0,0 +1,114 @@
+"""
+Bulk card initialization on FakeMasterStation with scripted responses.
+"""
+
+import struct
+
+from sportiduino import Sportiduino
+from testdata import card_payload
+
+import pytest
+
+
+OK = (Sportiduino.RESP_OK, b'')
+NO_CARD = (Sportiduino.RESP_ERROR, Sportiduino.ERR_READ_CARD)
+WRITE_ERROR = (Sportiduino.RESP_ERROR, Sportiduino.ERR_WRITE_CARD)
+SILENT = (None, None)
+
+
+@pytest.fixture
+def fms_options():
+    # Read card commands find no card unless scripted
+    return {'card_every': 1000}
+
+
+def script(station, responses, verify=False):
+    """Answer init card commands with responses in turn, then with OK.
+    With verify the written card is on the station for one read.
+    """
+    handle = station.handle
+    written = []
+
+    def scripted(cmd):
+        code = cmd[1:2]
+        if code == Sportiduino.CMD_INIT_CARD:
+            response = responses.pop(0) if responses else OK
+            if response == OK:
+                written.append(struct.unpack('>H', cmd[3:5])[0])
+            if response[0] is not None:
+                station.respond(*response)
+        elif code == Sportiduino.CMD_READ_CARD and verify and written:
+            station.push_card(card_payload(written.pop(), []))
+        else:
+            handle(cmd)
+    station.handle = scripted
+
+
+def test_all_written(station):
+    script(station, [])
+    sportiduino = Sportiduino(station.port)
+    progress = list(sportiduino.bulk_init_cards([1, 2, 3], timeout=0.5))
+    assert [p['card_number'] for p in progress] == [1, 2, 3]
+    assert all(p['ok'] and p['attempts'] == 1 and p['error'] is None for p in progress)
+    assert (progress[-1]['done'], progress[-1]['failed']) == (3, 0)
+    assert progress[-1]['cards_per_minute'] > 0
+    sportiduino.disconnect()
+
+
+def test_waits_for_card(station):
+    # Card is presented after two probes, these are not attempts
+    script(station, [NO_CARD, NO_CARD])
+    sportiduino = Sportiduino(station.port)
+    progress = list(sportiduino.bulk_init_cards([5], retries=0, timeout=0.5))
+    assert progress[0]['ok'] and progress[0]['attempts'] == 1
+    sportiduino.disconnect()
+
+
+def test_write_error_retried(station):
+    script(station, [WRITE_ERROR, WRITE_ERROR, WRITE_ERROR, WRITE_ERROR, WRITE_ERROR])
+    sportiduino = Sportiduino(station.port)
+    progress = list(sportiduino.bulk_init_cards([1, 2], retries=2, timeout=0.5))
+    # Three attempts of the first card fail, the second card is written
+    # after two more errors
+    assert not progress[0]['ok']
+    assert progress[0]['attempts'] == 3
+    assert progress[0]['error'] == 'Card write error'
+    assert progress[1]['ok'] and progress[1]['attempts'] == 3
+    assert (progress[1]['done'], progress[1]['failed']) == (1, 1)
+    sportiduino.disconnect()
+
+
+def test_silent_station(station):
+    script(station, [SILENT]*10)
+    sportiduino = Sportiduino(station.port)
+    progress = list(sportiduino.bulk_init_cards([1], retries=1, timeout=0.05))
+    assert progress[0]['error'] == 'No response'
+    assert progress[0]['attempts'] == 2
+    assert sportiduino.metrics.counters['timeouts'] == 2
+    sportiduino.disconnect()
+
+
+def test_card_timeout(station):
+    script(station, [NO_CARD]*100)
+    sportiduino = Sportiduino(station.port)
+    progress = list(sportiduino.bulk_init_cards([1], card_timeout=0.5, timeout=0.5))
+    assert progress[0]['error'] == 'No card'
+    assert progress[0]['attempts'] == 0
+    sportiduino.disconnect()
+
+
+def test_verify(station):
+    script(station, [], verify=True)
+    sportiduino = Sportiduino(station.port)
+    progress = list(sportiduino.bulk_init_cards([7, 8], verify=True, timeout=0.5))
+    assert [p['ok'] for p in progress] == [True, True]
+    sportiduino.disconnect()
+
+
+def test_verify_wrong_card(station):
+    script(station, [])
+    station.card_every = 1
+    sportiduino = Sportiduino(station.port)
+    progress = list(sportiduino.bulk_init_cards([7], retries=0, verify=True, timeout=0.5))
+    assert progress[0]['error'].startswith('Verify failed: card number')
+    sportiduino.disconnect()
@@ -0,0 +1,69 @@
+"""
+Lazily decoded card data.
+"""
+
+from datetime import datetime
+
+import pytest
+
+from sportiduino import Sportiduino, CardRecord, SportiduinoException
+from sportiduino_decode import iter_cards
+from testdata import START, card_payload
+
+
+def test_fields():
+    payload = card_payload(1234, [31, 32])
+    record = CardRecord(payload)
+    assert record.card_number == 1234
+    assert record.page6 == record.page7 == b'\x00'*4
+    assert len(record) == 4
+    assert record.start_epoch == START
+    assert record.finish_epoch == START + 180
+    assert record.punches_epoch == [(31, START + 60), (32, START + 120)]
+    assert record.tobytes() == payload
+
+
+def test_to_dict():
+    data = CardRecord(card_payload(9, [31])).to_dict()
+    assert data == {
+        'card_number': 9,
+        'page6': b'\x00'*4,
+        'page7': b'\x00'*4,
+        'start': datetime.fromtimestamp(START),
+        'finish': datetime.fromtimestamp(START + 120),
+        'punches': [(31, datetime.fromtimestamp(START + 60))],
+    }
+
+
+def test_no_start_and_finish():
+    record = CardRecord(card_payload(9, [], finish=False)[:10])
+    assert record.start_epoch is None and record.finish_epoch is None
+    assert record.to_dict()['punches'] == []
+
+
+@pytest.mark.parametrize('size', [0, 1, 9])
+def test_short_payload(size):
+    with pytest.raises(SportiduinoException):
+        CardRecord(card_payload(9, [31])[:size])
+    with pytest.raises(SportiduinoException):
+        Sportiduino._parse_card_data(b'\x00'*size)
+
+
+def test_decode_skips_short_payload():
+    frames = Sportiduino._make_command(Sportiduino.RESP_CARD_DATA, b'\x01')
+    frames += Sportiduino._make_command(Sportiduino.RESP_CARD_DATA, card_payload(9, [31]))
+    assert [card.card_number for _, card in iter_cards(frames)] == [9]
+    with pytest.raises(SportiduinoException):
+        list(iter_cards(frames, errors='raise'))
+
+
+def test_short_payload_from_station(station):
+    sportiduino = Sportiduino(station.port)
+    sportiduino.enable_continuous_read()
+    station.push_card(b'\x01')
+    station.push_card(card_payload(9, [31]))
+    # Short card data is skipped like a corrupted frame
+    with pytest.raises(SportiduinoException):
+        sportiduino.wait_card(timeout=1)
+    assert sportiduino.wait_card(timeout=1)['card_number'] == 9
+    sportiduino.disconnect()
@@ -0,0 +1,107 @@
+"""
+Clock drift correction and local time conversion.
+"""
+
+import os
+import time
+from datetime import datetime
+
+import pytest
+
+from sportiduino import Sportiduino, LocalTimeCache
+from sportiduino_clock import ClockCorrection, ClockModel, NO_CORRECTION
+from sportiduino_store import EventStore
+from testdata import START, card_payload
+
+
+def test_model_fit():
+    assert ClockModel.fit([]) == NO_CORRECTION
+    # Station gains 10 s in 100000 s
+    model = ClockModel.fit([(1000, 1000), (101000, 100990)])
+    assert model.correct(101000) == 100990
+    assert model.correct(51000) == 50995
+
+
+def test_time_set_drops_sync_points():
+    correction = ClockCorrection()
+    correction.add_sync(31, 1000, 900)
+    assert correction.correct(31, 2000) == 1900
+    correction.time_set(31, 5000)
+    assert correction.correct(31, 6000) == 6000
+    # Check points without sync events are not corrected
+    assert correction.correct(32, 6000) == 6000
+
+
+def test_correct_card():
+    correction = ClockCorrection({31: ClockModel(10, 0.0, 0)})
+    data = correction.correct_card(card_payload(1, [31, 32]))
+    assert data['punches'][0] == (31, datetime.fromtimestamp(START + 50))
+    assert data['punches'][1] == (32, datetime.fromtimestamp(START + 120))
+    assert data['raw_punches'][:2] == [(Sportiduino.START_STATION, START), (31, START + 60)]
+
+
+def test_correct_many():
+    np = pytest.importorskip('numpy')
+    correction = ClockCorrection({31: ClockModel(10, 0.0, 0)})
+    corrected = correction.correct_many([31, 32], [START, START])
+    assert np.array_equal(corrected, [START - 10, START])
+
+
+def test_event_store_correction():
+    pytest.importorskip('numpy')
+    correction = ClockCorrection()
+    store = EventStore(correction=correction)
+    store.append(card_payload(1, [31, 32]))
+    store.append(card_payload(2, [31, 32], start=START + 10))
+
+    correction.set_model(31, ClockModel(100, 0.0, 0))
+    assert store.last_at(31) == [(2, START - 30), (1, START - 40)]
+    assert store.running_order(31) == [(1, -40), (2, -40)]
+    assert store.card_punches(1, raw=True) == [(31, START + 60), (32, START + 120)]
+
+    correction.set_model(Sportiduino.FINISH_STATION, ClockModel(30, 0.0, 0))
+    assert store.card_times(2) == (START + 10, START + 160)
+    assert store.card_times(2, raw=True) == (START + 10, START + 190)
+
+    store.set_correction(None)
+    assert store.last_at(31, 1) == [(2, START + 70)]
+
+
+@pytest.fixture
+def time_zone(request):
+    if not hasattr(time, 'tzset'):
+        pytest.skip('time.tzset() is not available')
+    old_tz = os.environ.get('TZ')
+    os.environ['TZ'] = request.param
+    time.tzset()
+    yield request.param
+    if old_tz is None:
+        del os.environ['TZ']
+    else:
+        os.environ['TZ'] = old_tz
+    time.tzset()
+
+
+def check_local_times(convert, epochs):
+    for epoch in epochs:
+        expected = datetime.fromtimestamp(epoch)
+        result = convert(epoch)
+        # Equality of naive datetimes ignores fold
+        assert (result, result.fold) == (expected, expected.fold)
+        assert result.timestamp() == epoch
+
+
+@pytest.mark.parametrize('time_zone', ['UTC', 'Europe/Berlin', 'America/New_York',
+                                       'Australia/Lord_Howe'], indirect=True)
+def test_local_time_cache(time_zone):
+    convert = LocalTimeCache()
+    # A year around daylight saving transitions
+    check_local_times(convert, range(1680000000 - 86400*180, 1680000000 + 86400*180, 997))
+    assert convert(1680000000.5) == datetime.fromtimestamp(1680000000.5)
+
+
+@pytest.mark.parametrize('time_zone', ['Europe/Berlin'], indirect=True)
+def test_local_time_cache_repeated_hour(time_zone):
+    # 2023-10-29 02:00-02:59 twice, every second of both passes
+    transition = 1698541200
+    check_local_times(LocalTimeCache(), range(transition - 3600, transition + 3600))
@@ -0,0 +1,85 @@
+"""
+Continuous read mode on FakeMasterStation.
+"""
+
+import threading
+import time
+
+import pytest
+
+from sportiduino import Sportiduino, SportiduinoPortError
+from testdata import card_numbers, push_when_continuous
+
+
+def test_iter_cards_keeps_cards_pushed_during_commands(station):
+    sportiduino = Sportiduino(station.port)
+    pusher = push_when_continuous(station, 5)
+    cards = []
+    for card_data in sportiduino.iter_cards(timeout=1):
+        cards.append(card_data['card_number'])
+        sportiduino.beep_ok()
+        sportiduino.read_version()
+    pusher.join()
+    # Continuous read is disabled when the generator ends
+    deadline = time.time() + 1
+    while station.continuous and time.time() < deadline:
+        time.sleep(0.01)
+    sportiduino.disconnect()
+    assert cards == card_numbers(station.cards_sent)
+    assert not station.continuous
+
+
+def test_wait_card(station):
+    sportiduino = Sportiduino(station.port)
+    sportiduino.enable_continuous_read()
+    assert sportiduino.wait_card(timeout=0.05) is None
+    station.push_card()
+    card_data = sportiduino.wait_card(timeout=1)
+    assert card_data['card_number'] == card_numbers(station.cards_sent)[0]
+    assert sportiduino.card_data is card_data
+    sportiduino.disconnect()
+
+
+def test_listen(station):
+    sportiduino = Sportiduino(station.port)
+    pusher = push_when_continuous(station, 3)
+    cards = []
+    sportiduino.listen(lambda card_data: cards.append(card_data['card_number']), timeout=0.5)
+    pusher.join()
+    sportiduino.disconnect()
+    assert cards == card_numbers(station.cards_sent)
+
+
+def test_iter_cards_raises_on_port_failure(station):
+    sportiduino = Sportiduino(station.port)
+    pusher = push_when_continuous(station, 1)
+    cards = sportiduino.iter_cards(timeout=1)
+    next(cards)
+    pusher.join()
+    sportiduino._serial.close()
+    started = time.time()
+    with pytest.raises(SportiduinoPortError):
+        next(cards)
+    assert time.time() - started < 0.5
+
+
+def test_iter_cards_timeout_with_bad_frames(station):
+    sportiduino = Sportiduino(station.port)
+    sportiduino.enable_continuous_read()
+    # Only corrupted frames keep coming
+    station.bad_checksum = 1.0
+    stopped = threading.Event()
+
+    def push():
+        while not stopped.wait(0.05):
+            station.push_card()
+    pusher = threading.Thread(target=push)
+    pusher.start()
+    started = time.time()
+    try:
+        assert list(sportiduino.iter_cards(timeout=0.5)) == []
+        assert time.time() - started < 1.5
+    finally:
+        stopped.set()
+        pusher.join()
+    sportiduino.disconnect()
@@ -0,0 +1,68 @@
+"""
+Course checks.
+"""
+
+import random
+
+import pytest
+
+from sportiduino import CardRecord
+from sportiduino_course import Course, CourseIndex, card_cps
+from testdata import card_payload
+
+
+def test_line():
+    course = Course('A', [31, 32, 33, 34])
+    assert course.check([31, 50, 32, 33, 34]) == (Course.OK, (), None)
+    # One misplaced punch makes one control missing only
+    assert course.check([31, 33, 32, 34]).missing in ((32,), (33,))
+    assert course.check([34, 31, 32, 33]).missing == (34,)
+    assert course.check([]).missing == (31, 32, 33, 34)
+
+
+def test_missing_keeps_longest_subsequence():
+    course = Course('A', [31, 32, 33, 34, 35, 36])
+    assert course._missing(bytearray([31, 36, 32, 33, 34, 35])) == (36,)
+    assert course._missing(bytearray([35, 36, 31, 32, 33, 34])) == (35, 36)
+    assert course._missing(bytearray([31, 32, 33, 34, 35, 36])) == ()
+
+
+def test_repeated_controls():
+    course = Course('A', [31, 32, 31, 33])
+    assert course.check([31, 32, 31, 33]).status == Course.OK
+    assert course.check([31, 32, 33]).missing == (31,)
+
+
+def test_score():
+    course = Course('S', points={31: 10, 32: 20, 33: 30}, time_limit=3600, penalty=2)
+    # Repeated and unknown controls do not count, 61 s over limit is two minutes
+    assert course.check([31, 31, 32, 99], time=3661).score == 26
+    assert course.check([33], time=3600).score == 30
+
+
+def test_course_needs_controls_or_points():
+    with pytest.raises(ValueError):
+        Course('A')
+
+
+def test_card_cps():
+    payload = card_payload(1, [31, 32])
+    record = CardRecord(payload)
+    assert card_cps(record) == (b'\x1f\x20', 180)
+    assert card_cps(record.to_dict()) == (b'\x1f\x20', 180)
+
+
+def test_check_many():
+    rnd = random.Random(0)
+    index = CourseIndex([Course('A', range(31, 41)),
+                         Course('S', points={31: 1, 32: 2}, time_limit=300, penalty=1)])
+    items = []
+    for n in range(1, CourseIndex.MIN_PARALLEL + 1):
+        cps = list(range(31, 41))
+        if rnd.random() < 0.1:
+            cps.pop(rnd.randrange(len(cps)))
+        items.append(('A' if n % 2 else 'S', CardRecord(card_payload(n, cps))))
+    expected = [index.check(name, card) for name, card in items]
+    assert index.check_many(items, processes=1) == expected
+    assert index.check_many(items, processes=2) == expected
+    assert any(result.status == Course.MISSING_PUNCH for result in expected)
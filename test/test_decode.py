@@ -0,0 +1,82 @@
+"""
+Decoding of captured traffic without connection.
+"""
+
+import io
+
+from sportiduino import Sportiduino, WireCapture, SportiduinoException
+from sportiduino_decode import decode, iter_cards
+from testdata import START, CAPTURED_CARD, CAPTURED_VERSION
+
+import pytest
+
+
+READ_VERSION = Sportiduino._make_command(Sportiduino.CMD_READ_VERS)
+READ_CARD = Sportiduino._make_command(Sportiduino.CMD_READ_CARD)
+
+
+@pytest.fixture
+def capture_path(tmp_path):
+    """Capture of version and card readout, the card split across records
+    with garbage before it.
+    """
+    path = str(tmp_path / 'traffic.sdcap')
+    with WireCapture(path) as capture:
+        capture.write(WireCapture.TX, READ_VERSION, timestamp=START)
+        capture.write(WireCapture.RX, CAPTURED_VERSION, timestamp=START + 1)
+        capture.write(WireCapture.TX, READ_CARD, timestamp=START + 2)
+        card = b''.join(CAPTURED_CARD)
+        capture.write(WireCapture.RX, b'\x00\xfe\x01' + card[:20], timestamp=START + 3)
+        capture.write(WireCapture.RX, card[20:], timestamp=START + 4)
+    return path
+
+
+def test_capture_file(capture_path):
+    frames = list(decode(capture_path))
+    assert [(f.timestamp, f.name) for f in frames] == \
+        [(START + 1, 'RESP_VERS'), (START + 4, 'RESP_CARD_DATA')]
+    assert frames[0].parse().value == 0xd2
+    record = frames[1].parse()
+    assert record.card_number == 9
+    assert [cp for cp, _ in record.punches] == list(range(31, 38))
+
+
+def test_capture_commands(capture_path):
+    frames = list(decode(capture_path, direction=WireCapture.TX))
+    assert [(f.timestamp, f.name) for f in frames] == \
+        [(START, 'CMD_READ_VERS'), (START + 2, 'CMD_READ_CARD')]
+
+
+def test_capture_cards(capture_path):
+    cards = list(iter_cards(capture_path))
+    assert [(t, r.card_number) for t, r in cards] == [(START + 4, 9)]
+
+
+def test_capture_of_connection(station, tmp_path):
+    path = str(tmp_path / 'station.sdcap')
+    station.card_every = 1
+    with WireCapture(path) as capture:
+        sportiduino = Sportiduino(station.port, capture=capture)
+        card = sportiduino.read_card()
+        sportiduino.disconnect()
+    frames = list(decode(path))
+    assert frames[-1].name == 'RESP_CARD_DATA'
+    assert frames[-1].parse().card_number == card['card_number']
+    assert all(f.name == 'RESP_VERS' for f in frames[:-1])
+    assert [f.name for f in decode(path, direction=WireCapture.TX)][-1] == 'CMD_READ_CARD'
+
+
+def test_raw_sources():
+    stream = b'\xff\x00' + b''.join(CAPTURED_CARD) + CAPTURED_VERSION
+    expected = ['RESP_CARD_DATA', 'RESP_VERS']
+    assert [f.name for f in decode(stream)] == expected
+    assert [f.name for f in decode(io.BytesIO(stream))] == expected
+    assert [f.name for f in decode(stream[i:i + 3] for i in range(0, len(stream), 3))] == expected
+    assert all(f.timestamp is None for f in decode(stream))
+
+
+def test_bad_checksum():
+    broken = CAPTURED_VERSION[:-1] + b'\x00'
+    assert [f.name for f in decode(broken + CAPTURED_VERSION)] == ['RESP_VERS']
+    with pytest.raises(SportiduinoException):
+        list(decode(broken + CAPTURED_VERSION, errors='raise'))
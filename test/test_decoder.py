@@ -0,0 +1,87 @@
+"""
+FrameDecoder and buffered response reading.
+"""
+
+import pytest
+
+from sportiduino import Sportiduino, FrameDecoder, SportiduinoException
+from testdata import CAPTURED_CARD, CAPTURED_VERSION, card_payload
+
+
+VERSION = (b'\x66', b'\xd2')
+CARD = (b'\x63', card_payload(9, [31, 32, 33, 34, 35, 36, 37]))
+
+
+def decode_all(decoder, chunks):
+    frames = []
+    for chunk in chunks:
+        decoder.feed(chunk)
+        while True:
+            try:
+                frame = decoder.next_frame()
+            except SportiduinoException:
+                frames.append('error')
+                continue
+            if frame is None:
+                break
+            frames.append(frame)
+    return frames
+
+
+def test_captured_response():
+    assert decode_all(FrameDecoder(), [CAPTURED_VERSION]) == [VERSION]
+
+
+def test_fragments():
+    stream = b''.join(CAPTURED_CARD) + CAPTURED_VERSION
+    assert decode_all(FrameDecoder(), [stream]) == [CARD, VERSION]
+    assert decode_all(FrameDecoder(), CAPTURED_CARD) == [CARD]
+
+
+def test_byte_by_byte():
+    # As from a slow line, frames and fragments split at every byte
+    stream = b''.join(CAPTURED_CARD) + CAPTURED_VERSION
+    chunks = [stream[i:i + 1] for i in range(len(stream))]
+    assert decode_all(FrameDecoder(), chunks) == [CARD, VERSION]
+
+
+def test_garbage_and_bad_checksum():
+    bad = CAPTURED_VERSION[:-1] + b'\x00'
+    stream = b'\x00\x13' + CAPTURED_VERSION + bad + b'\x42' + CAPTURED_VERSION
+    assert decode_all(FrameDecoder(), [stream]) == [VERSION, 'error', VERSION]
+
+
+def test_bad_fragment_drops_card():
+    first, last = CAPTURED_CARD
+    stream = first + last[:-1] + b'\x00' + CAPTURED_VERSION
+    assert decode_all(FrameDecoder(), [stream]) == ['error', VERSION]
+
+
+def test_reset():
+    decoder = FrameDecoder()
+    decode_all(decoder, [CAPTURED_CARD[0], CAPTURED_VERSION[:3]])
+    decoder.reset()
+    assert decode_all(decoder, [CAPTURED_VERSION]) == [VERSION]
+
+
+def test_byte_resync():
+    # Garbage with START_BYTE swallows the beginning of the next frame
+    stream = b'\xfe\x10\x02' + CAPTURED_VERSION
+    assert VERSION not in decode_all(FrameDecoder(), [stream])
+    assert decode_all(FrameDecoder(byte_resync=True), [stream]) == ['error', VERSION]
+
+
+@pytest.fixture
+def fms_options():
+    return {'card_every': 1, 'max_punches': 30, 'noise': 0.5}
+
+
+def test_read_response(station):
+    sportiduino = Sportiduino(station.port)
+    timeout = sportiduino._serial.timeout
+    for _ in range(10):
+        record = sportiduino.read_card_record(timeout=0.5)
+        assert record.tobytes() == station.cards_sent[-1]
+    # Timeout of a command is not left on the port
+    assert sportiduino._serial.timeout == timeout
+    sportiduino.disconnect()
@@ -0,0 +1,93 @@
+"""
+Streaming export of card readouts.
+"""
+
+import csv
+import io
+import json
+
+from sportiduino import CardRecord, local_datetime
+from sportiduino_export import card_splits, CsvExporter, JsonLinesExporter
+from testdata import START, card_payload
+
+import pytest
+
+
+def iso(epoch):
+    return local_datetime(epoch).isoformat()
+
+
+def test_card_splits():
+    record = CardRecord(card_payload(5, [31, 32]))
+    splits = card_splits(record)
+    assert splits['card_number'] == 5
+    assert (splits['start'], splits['finish'], splits['time'], splits['finish_split']) == \
+        (START, START + 180, 180, 60)
+    assert splits['punches'] == [(31, START + 60, 60, 60), (32, START + 120, 60, 120)]
+    assert card_splits(record.to_dict()) == splits
+
+
+def test_card_splits_without_start():
+    payload = card_payload(5, [31, 32])
+    # Drop the start punch
+    splits = card_splits(CardRecord(payload[:10] + payload[15:]))
+    assert (splits['start'], splits['time']) == (None, None)
+    assert splits['punches'] == [(31, START + 60, None, None), (32, START + 120, 60, None)]
+    assert splits['finish_split'] == 60
+
+
+def test_csv_rows():
+    out = io.StringIO()
+    with CsvExporter(out, max_punches=3) as exporter:
+        exporter.write(CardRecord(card_payload(5, [31, 32])))
+        exporter.append(card_payload(6, [], finish=False))
+    assert exporter.count == 2
+    rows = list(csv.reader(io.StringIO(out.getvalue())))
+    assert rows[0][:11] == ['card_number', 'page6', 'page7', 'start', 'finish', 'time',
+                            'finish_split', 'punch_count', 'cp1', 'time1', 'split1']
+    assert len(rows[0]) == 8 + 3*3
+    assert rows[1] == ['5', '00000000', '00000000', iso(START), iso(START + 180), '180', '60', '2',
+                       '31', iso(START + 60), '60', '32', iso(START + 120), '60', '', '', '']
+    assert rows[2] == ['6', '00000000', '00000000', iso(START), '', '', '', '0'] + ['']*9
+
+
+def test_csv_too_many_punches():
+    exporter = CsvExporter(io.StringIO(), max_punches=1, delimiter=';')
+    with pytest.raises(ValueError):
+        exporter.write(CardRecord(card_payload(5, [31, 32])))
+
+
+def test_json_lines():
+    out = io.StringIO()
+    with JsonLinesExporter(out) as exporter:
+        exporter.write_all([CardRecord(card_payload(5, [31])), CardRecord(card_payload(6, [32])).to_dict()])
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 2
+    row = json.loads(lines[0])
+    assert row == {
+        'card_number': 5, 'page6': '00000000', 'page7': '00000000',
+        'start': iso(START), 'finish': iso(START + 120), 'time': 120, 'finish_split': 60,
+        'punches': [{'cp': 31, 'time': iso(START + 60), 'split': 60, 'elapsed': 60}],
+    }
+    assert json.loads(lines[1])['punches'][0]['cp'] == 32
+
+
+def test_file_name(tmp_path):
+    path = str(tmp_path / 'readout.jsonl')
+    with JsonLinesExporter(path) as exporter:
+        exporter.append(card_payload(5, [31]))
+    with open(path) as f:
+        assert json.loads(f.readline())['card_number'] == 5
+
+
+def test_parquet(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    from sportiduino_export import ParquetExporter
+
+    path = str(tmp_path / 'readout.parquet')
+    with ParquetExporter(path, row_group_size=2) as exporter:
+        for n in range(1, 6):
+            exporter.append(card_payload(n, [31, 32]))
+    table = pq.read_table(path)
+    assert table.column('card_number').to_pylist() == [1, 2, 3, 4, 5]
+    assert pq.ParquetFile(path).num_row_groups == 3
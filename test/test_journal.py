@@ -0,0 +1,126 @@
+"""
+Readout journal and its reader.
+"""
+
+import os
+import time
+
+from sportiduino import Sportiduino, SportiduinoException
+from sportiduino_journal import ReadoutJournal, JournalReader, MAGIC
+from testdata import START, card_payload
+
+import pytest
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'event.sdjrn')
+
+
+def test_append_and_lookup(path):
+    with ReadoutJournal(path, fsync=False) as journal:
+        assert journal.append(card_payload(1, [31]), timestamp=START)
+        assert journal.append(card_payload(2, [31, 32]), timestamp=START + 1)
+        # The same readout again is skipped, a new one is kept
+        assert not journal.append(card_payload(1, [31]))
+        assert journal.is_duplicate(card_payload(1, [31]))
+        assert journal.append(card_payload(1, [31, 32]), timestamp=START + 2)
+        journal.append(b'\x00\x1f', code=Sportiduino.RESP_BACKUP)
+
+        assert len(journal) == 4
+        assert 1 in journal and 3 not in journal
+        assert sorted(journal.card_numbers()) == [1, 2]
+        # Pending records are readable before commit
+        assert [(t, [cp for cp, _ in r.punches]) for t, r in journal.readouts(1)] == \
+            [(START, [31]), (START + 2, [31, 32])]
+        journal.commit()
+        timestamp, record = journal.latest(2)
+        assert (timestamp, record.card_number) == (START + 1, 2)
+        assert journal.latest(3) is None
+
+    with ReadoutJournal(path, fsync=False) as journal:
+        assert len(journal) == 4
+        assert [t for t, r in journal.readouts(1)] == [START, START + 2]
+        assert not journal.append(card_payload(2, [31, 32]))
+
+
+def test_truncated_tail_cut_off(path):
+    with ReadoutJournal(path, fsync=False) as journal:
+        for n in range(1, 4):
+            journal.append(card_payload(n, [31]), timestamp=START)
+    size = os.path.getsize(path)
+    record_size = (size - len(MAGIC))//3
+    # Power loss in the middle of the last record
+    with open(path, 'r+b') as f:
+        f.truncate(size - 5)
+
+    with ReadoutJournal(path, fsync=False) as journal:
+        assert len(journal) == 2
+        assert 3 not in journal
+        assert os.path.getsize(path) == len(MAGIC) + 2*record_size
+        journal.append(card_payload(3, [32]), timestamp=START)
+
+    with JournalReader(path) as reader:
+        assert [(r.card_number, r.punches[0][0]) for t, r in reader.cards()] == \
+            [(1, 31), (2, 31), (3, 32)]
+
+
+def test_corrupted_record_stops_reading(path):
+    with ReadoutJournal(path, fsync=False) as journal:
+        for n in range(1, 4):
+            journal.append(card_payload(n, [31]), timestamp=START)
+    size = os.path.getsize(path)
+    record_size = (size - len(MAGIC))//3
+    with open(path, 'r+b') as f:
+        f.seek(len(MAGIC) + record_size + record_size - 1)
+        f.write(b'\xff')
+
+    with JournalReader(path) as reader:
+        assert len(list(reader)) == 1
+    with ReadoutJournal(path, fsync=False) as journal:
+        assert journal.card_numbers() == [1]
+
+
+def test_group_commit(path):
+    journal = ReadoutJournal(path, commit_interval=0.2, commit_records=3, fsync=False)
+    try:
+        empty = os.path.getsize(path)
+        journal.append(card_payload(1, [31]))
+        journal.append(card_payload(2, [31]))
+        assert os.path.getsize(path) == empty
+        # Group is full
+        journal.append(card_payload(3, [31]))
+        full = os.path.getsize(path)
+        assert full > empty
+
+        # Group is committed by time
+        journal.append(card_payload(4, [31]))
+        assert os.path.getsize(path) == full
+        deadline = time.time() + 2
+        while os.path.getsize(path) == full and time.time() < deadline:
+            time.sleep(0.05)
+        assert os.path.getsize(path) > full
+    finally:
+        journal.close()
+    with pytest.raises(SportiduinoException):
+        journal.append(card_payload(5, [31]))
+
+
+def test_reader_records(path):
+    with ReadoutJournal(path, fsync=False) as journal:
+        journal.append(card_payload(1, [31]), timestamp=START)
+        journal.append(b'\x00\x1f\x00\x07', code=Sportiduino.RESP_BACKUP, timestamp=START + 1)
+    with JournalReader(path) as reader:
+        records = [(t, code, bytes(payload)) for t, code, payload in reader]
+        assert records == [(START, 0x63, card_payload(1, [31])),
+                           (START + 1, 0x61, b'\x00\x1f\x00\x07')]
+        assert [r.card_number for t, r in reader.cards()] == [1]
+
+
+def test_not_a_journal(path):
+    with open(path, 'wb') as f:
+        f.write(b'card,time\n')
+    with pytest.raises(SportiduinoException):
+        ReadoutJournal(path)
+    with pytest.raises(SportiduinoException):
+        JournalReader(path)
@@ -0,0 +1,33 @@
+"""
+Line speed detection on FakeMasterStation.
+"""
+
+import time
+
+import pytest
+
+from sportiduino import Sportiduino, SportiduinoTimeout
+
+
+@pytest.fixture
+def fms_options(request):
+    # Emulated firmware answers only at its speed
+    return {'baudrate': -1, 'rates': [request.param]}
+
+
+@pytest.mark.parametrize('fms_options', [9600, 57600, 115200], indirect=True)
+def test_auto_baudrate(station, fms_options):
+    sportiduino = Sportiduino(station.port, baudrate='auto', connect_timeout=3)
+    assert sportiduino.baudrate == fms_options['rates'][0]
+    assert sportiduino.read_version() is not None
+    sportiduino.disconnect()
+
+
+def test_connect_timeout_is_total():
+    fakemasterstation = pytest.importorskip('fakemasterstation')
+    # Nobody answers on the port
+    silent = fakemasterstation.FakeMasterStation(verbose=False)
+    started = time.time()
+    with pytest.raises(SportiduinoTimeout):
+        Sportiduino(silent.port, baudrate='auto', connect_timeout=0.5)
+    assert time.time() - started < 1.0
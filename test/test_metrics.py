@@ -0,0 +1,43 @@
+"""
+Communication metrics on FakeMasterStation.
+"""
+
+from sportiduino import Sportiduino, Metrics, SportiduinoTimeout
+
+import pytest
+
+
+def test_counters(station):
+    sportiduino = Sportiduino(station.port)
+    counters = sportiduino.metrics.counters
+    frames_sent = counters['frames_sent']
+    sportiduino.read_backup()
+    assert counters['frames_sent'] == frames_sent + 1
+    assert counters['fragments_received'] > 0
+    assert counters['bytes_received'] >= counters['frames_received']*4
+    sportiduino.disconnect()
+
+
+def test_timeouts_count_unanswered_commands(station):
+    sportiduino = Sportiduino(station.port)
+    timeouts = sportiduino.metrics.counters['timeouts']
+    # Emulator answers every 4th read card command
+    for _ in range(3):
+        with pytest.raises(SportiduinoTimeout):
+            sportiduino.read_card(timeout=0.05)
+    assert sportiduino.metrics.counters['timeouts'] == timeouts + 3
+
+    # Waiting for a pushed card is not a timeout
+    sportiduino.enable_continuous_read()
+    for _ in range(3):
+        assert sportiduino.wait_card_record(timeout=0.05) is None
+    assert sportiduino.metrics.counters['timeouts'] == timeouts + 3
+    sportiduino.disconnect()
+
+
+def test_prometheus():
+    metrics = Metrics()
+    metrics.inc('timeouts', 2)
+    metrics.observe(Sportiduino.CMD_READ_CARD, 0.02)
+    text = metrics.to_prometheus({'port': 'COM3'})
+    assert 'timeouts_total{port="COM3"} 2' in text
@@ -0,0 +1,96 @@
+"""
+StationPool on FakeMasterStation emulators.
+"""
+
+import os
+import threading
+import time
+
+import pytest
+
+from sportiduino import ReadoutCache
+from sportiduino_pool import StationPool
+from testdata import card_numbers, push_when_continuous
+
+
+@pytest.fixture
+def other():
+    """Second emulated station."""
+    fakemasterstation = pytest.importorskip('fakemasterstation')
+    fms = fakemasterstation.FakeMasterStation(seed=1, verbose=False)
+    fms.start()
+    yield fms
+    fms.stop()
+
+
+def get_cards(pool, count, timeout=5):
+    items = []
+    deadline = time.time() + timeout
+    while len(items) < count and time.time() < deadline:
+        item = pool.get(timeout=0.1)
+        if item is not None:
+            items.append(item)
+    return items
+
+
+def test_continuous(station, other):
+    pushers = [push_when_continuous(fms, 3, interval=0.02) for fms in (station, other)]
+    with StationPool([station.port, other.port]) as pool:
+        items = get_cards(pool, 6)
+        for thread in pushers:
+            thread.join()
+        stats = pool.stats()
+        assert pool.station(station.port) is not None
+        assert 'port="%s"' % other.port in pool.to_prometheus()
+    for fms in (station, other):
+        assert [card['card_number'] for port, card in items if port == fms.port] == \
+            card_numbers(fms.cards_sent)
+        assert stats[fms.port]['connected'] and stats[fms.port]['cards'] == 3
+    # Stations are closed and continuous read is disabled on stop
+    assert pool.station(station.port) is None
+    assert not pool.stats()[station.port]['connected']
+    assert not station.continuous and not other.continuous
+
+
+def test_poll(station):
+    station.card_every = 1
+    with StationPool([station.port], continuous=False) as pool:
+        items = get_cards(pool, 2)
+    assert [card['card_number'] for port, card in items] == card_numbers(station.cards_sent)[:2]
+
+
+def test_shared_dedup(station, other):
+    payload = station.make_card()
+    cache = ReadoutCache()
+    with StationPool([station.port, other.port], dedup=cache) as pool:
+        # The same card is read on both stations
+        for fms in (station, other):
+            push_when_continuous(fms, 0).join()
+            fms.push_card(payload)
+        assert len(get_cards(pool, 1)) == 1
+        assert pool.get(timeout=0.5) is None
+
+
+def test_missing_port_skipped(station, tmp_path):
+    missing = str(tmp_path / 'ttyMissing')
+    with StationPool([missing, station.port]) as pool:
+        push_when_continuous(station, 1).join()
+        assert len(get_cards(pool, 1)) == 1
+        stats = pool.stats()
+    assert stats[missing]['errors'] == 1
+    assert not stats[missing]['connected']
+    assert stats[missing]['cards_per_second'] == 0.0
+
+
+def test_supervised_retries_open(station, tmp_path):
+    port = str(tmp_path / 'ttySportiduino')
+    # Station is plugged in after the pool is started
+    timer = threading.Timer(0.3, os.symlink, (station.port, port))
+    timer.start()
+    with StationPool([port], supervised=True) as pool:
+        push_when_continuous(station, 1).join()
+        items = get_cards(pool, 1)
+        stats = pool.stats()
+    timer.join()
+    assert [port for port, card in items] == [port]
+    assert stats[port]['errors'] >= 1
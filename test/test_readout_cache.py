@@ -0,0 +1,57 @@
+"""
+Suppression of repeated readouts.
+"""
+
+from sportiduino import Sportiduino, ReadoutCache
+from testdata import card_payload
+
+
+def test_readout_cache():
+    present = []
+    cache = ReadoutCache(ttl=60, max_size=2, on_present=present.append)
+    card = card_payload(1, [31])
+
+    assert cache.check(card, now=0)
+    assert not cache.check(card, now=30)
+    assert present == [1]
+    # ttl is counted from the last readout
+    assert not cache.check(card, now=80)
+    assert cache.check(card, now=150)
+    # Changed content is a new readout
+    assert cache.check(card_payload(1, [31, 32]), now=151)
+
+    cache.check(card_payload(2, [31]), now=152)
+    cache.check(card_payload(3, [31]), now=153)
+    assert 1 not in cache and len(cache) == 2
+
+    cache.forget(3)
+    assert cache.check(card_payload(3, [31]), now=154)
+
+
+def test_no_ttl():
+    cache = ReadoutCache(ttl=None)
+    card = card_payload(1, [31])
+    assert cache.check(card, now=0)
+    assert not cache.check(card, now=10**6)
+
+
+def test_station_skips_repeated_readouts(station):
+    present = []
+    journal = []
+    sportiduino = Sportiduino(station.port, dedup=ReadoutCache(on_present=present.append),
+                              journal=journal)
+    sportiduino.enable_continuous_read()
+    card = card_payload(7, [31])
+    for payload in (card, card, card_payload(7, [31, 32]), card_payload(8, [31])):
+        station.push_card(payload)
+    cards = []
+    while True:
+        card_data = sportiduino.wait_card(timeout=0.3)
+        if card_data is None:
+            break
+        cards.append((card_data['card_number'], len(card_data['punches'])))
+    sportiduino.disconnect()
+    assert cards == [(7, 1), (7, 2), (8, 1)]
+    assert present == [7]
+    # Repeated readouts are not journaled
+    assert len(journal) == 3
@@ -0,0 +1,92 @@
+"""
+Automatic reconnection of supervised Sportiduino on FakeMasterStation.
+
+Port failure is simulated by closing the serial port under the client,
+closing the pseudo terminal does not fail reads blocked in the emulator.
+"""
+
+import os
+import threading
+import time
+
+from sportiduino import Sportiduino, SportiduinoPortError
+from testdata import card_numbers
+
+import pytest
+
+
+@pytest.fixture
+def no_scan(monkeypatch):
+    """Do not probe serial ports of the host when the port is gone."""
+    monkeypatch.setattr(Sportiduino, '_scan_ports', staticmethod(lambda: []))
+
+
+def test_command_recovers(station):
+    sportiduino = Sportiduino(station.port, supervised=True)
+    sportiduino._serial.close()
+    assert sportiduino.read_version().value == station.version
+    assert sportiduino.metrics.counters['reconnects'] == 1
+    assert sportiduino.last_recovery_time is not None
+    sportiduino.disconnect()
+
+
+def test_unsupervised_raises(station):
+    sportiduino = Sportiduino(station.port)
+    sportiduino._serial.close()
+    with pytest.raises(SportiduinoPortError):
+        sportiduino.read_version()
+
+
+def test_continuous_mode_restored(station):
+    sportiduino = Sportiduino(station.port, supervised=True)
+    sportiduino.enable_continuous_read()
+    # Two cards arrive in one read, the second one is still in the decoder
+    # when the port fails
+    station.push_card()
+    station.push_card()
+    time.sleep(0.1)
+    first = sportiduino.wait_card_record(timeout=1)
+    sportiduino._serial.close()
+    second = sportiduino.wait_card_record(timeout=1)
+    assert [first.card_number, second.card_number] == card_numbers(station.cards_sent)
+    assert station.continuous
+
+    station.push_card()
+    assert sportiduino.wait_card_record(timeout=1).card_number == card_numbers(station.cards_sent)[2]
+    sportiduino.disconnect()
+
+
+def test_reconnects_to_new_device(station, tmp_path, no_scan):
+    import fakemasterstation
+
+    port = str(tmp_path / 'ttySportiduino')
+    os.symlink(station.port, port)
+    sportiduino = Sportiduino(port, supervised=True)
+    # Device is enumerated again under the same name after a while
+    os.remove(port)
+    sportiduino._serial.close()
+    other = fakemasterstation.FakeMasterStation(verbose=False, version=220)
+    other.start()
+    timer = threading.Timer(0.3, os.symlink, (other.port, port))
+    timer.start()
+    try:
+        assert sportiduino.read_version().value == 220
+        assert sportiduino.last_recovery_time >= 0.3
+    finally:
+        timer.join()
+        sportiduino.disconnect()
+        other.stop()
+
+
+def test_recovery_timeout(station, tmp_path, no_scan):
+    port = str(tmp_path / 'ttySportiduino')
+    os.symlink(station.port, port)
+    sportiduino = Sportiduino(port, supervised=True)
+    sportiduino.recovery_timeout = 1
+    os.remove(port)
+    sportiduino._serial.close()
+    started = time.time()
+    with pytest.raises(SportiduinoPortError, match='not recovered'):
+        sportiduino.read_version()
+    assert time.time() - started <= 1
+    assert sportiduino.metrics.counters['reconnects'] == 0
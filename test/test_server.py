@@ -0,0 +1,116 @@
+"""
+StationServer and StationClient on FakeMasterStation.
+"""
+
+import json
+import socket
+import time
+
+import pytest
+
+from sportiduino import SportiduinoException
+from sportiduino_server import StationServer, StationClient, COMMANDS, _decode_args
+from testdata import card_numbers, push_when_continuous
+
+
+@pytest.fixture
+def address(tmp_path):
+    return str(tmp_path / 'sportiduino.sock')
+
+
+def card_events(client, count, timeout=2):
+    return [event for _, event in zip(range(count), client.iter_cards(timeout=timeout))]
+
+
+def test_broadcast(station, address):
+    journal = []
+    with StationServer(station.port, address, journal=journal) as server:
+        server.start()
+        with StationClient(address) as first, StationClient(address) as second:
+            assert first.hello['station'] == station.port
+            assert first.hello['commands'] == list(COMMANDS)
+            push_when_continuous(station, 2).join()
+            events = [card_events(client, 2) for client in (first, second)]
+    numbers = card_numbers(station.cards_sent)
+    for client_events in events:
+        assert [event['card']['card_number'] for event in client_events] == numbers
+        assert [bytes.fromhex(event['data']) for event in client_events] == station.cards_sent
+    # Journal gets the cards as well
+    assert journal == station.cards_sent
+
+
+def test_unsubscribe(station, address):
+    with StationServer(station.port, address) as server:
+        server.start()
+        with StationClient(address) as client:
+            assert client.call('unsubscribe').result(1) is None
+            push_when_continuous(station, 1).join()
+            assert card_events(client, 1, timeout=0.5) == []
+            assert client.call('subscribe').result(1) is None
+            station.push_card()
+            assert len(card_events(client, 1)) == 1
+
+
+def test_commands(station):
+    with StationServer(station.port, ('127.0.0.1', 0)) as server:
+        server.start()
+        with StationClient(server.address) as client:
+            assert client.call('read_version').result(2) == 'v2.10.x'
+            assert client.call('beep_ok').result(2) is None
+            assert client.call('init_card', 12, '01020304', '05060708').result(2) is None
+            assert client.call('init_time_card', '2018-03-05T12:00:00').result(2) is None
+            backup = client.call('read_backup').result(2)
+            assert len(backup['cards']) == station.backup_cards
+            with pytest.raises(SportiduinoException, match='Unknown command'):
+                client.call('disconnect').result(2)
+            assert len(server.clients()) == 1
+
+
+def test_bad_request(station, address):
+    with StationServer(station.port, address) as server:
+        server.start()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(2)
+        sock.connect(address)
+        lines = sock.makefile('rb')
+        assert json.loads(lines.readline().decode('utf-8'))['type'] == 'hello'
+        sock.sendall(b'not json\n{"id": 5}\n')
+        for _ in range(2):
+            assert json.loads(lines.readline().decode('utf-8')) == \
+                {'type': 'error', 'id': None, 'error': 'Bad request'}
+        sock.close()
+
+
+def test_read_card_is_broadcast(station, address):
+    station.card_every = 1
+    with StationServer(station.port, address, continuous=False) as server:
+        server.start()
+        with StationClient(address) as first, StationClient(address) as second:
+            card = first.call('read_card').result(2)
+            events = card_events(second, 1)
+    number = card_numbers(station.cards_sent)[0]
+    assert card['card_number'] == number
+    assert [event['card']['card_number'] for event in events] == [number]
+
+
+def test_client_disconnect(station, address):
+    with StationServer(station.port, address) as server:
+        server.start()
+        client = StationClient(address)
+        assert len(server.clients()) == 1
+        client.close()
+        deadline = time.time() + 2
+        while server.clients() and time.time() < deadline:
+            time.sleep(0.01)
+        assert server.clients() == []
+        with pytest.raises(EnvironmentError):
+            client.call('beep_ok')
+
+
+def test_decode_args():
+    # Card number is not a page, it stays as given
+    assert _decode_args('init_card', ['12', '01020304']) == ['12', b'\x01\x02\x03\x04']
+    assert _decode_args('init_card', [12]) == [12]
+    assert _decode_args('write_pages6_7', ['0102', '0304']) == [b'\x01\x02', b'\x03\x04']
+    assert _decode_args('init_time_card', [None]) == []
+    assert _decode_args('read_card', [0.5]) == [0.5]
@@ -0,0 +1,57 @@
+"""
+SharedSportiduino on FakeMasterStation.
+"""
+
+import pytest
+
+from sportiduino import SportiduinoException, SportiduinoPortError
+from sportiduino_shared import SharedSportiduino
+from testdata import push_when_continuous
+
+
+def test_publishes_every_card(station):
+    shared = SharedSportiduino(station.port, continuous=True)
+    cards = []
+    records = []
+    shared.subscribe(lambda card_data: cards.append(card_data['card_number']))
+    shared.subscribe(records.append, records=True)
+    pusher = push_when_continuous(station, 20)
+    for _ in range(20):
+        shared.beep_ok()
+        shared.read_version().result()
+    pusher.join()
+    shared.close()
+    assert len(cards) == 20
+    assert [record.tobytes() for record in records] == station.cards_sent
+
+
+def test_queue_subscriber(station):
+    shared = SharedSportiduino(station.port, continuous=True)
+    cards = shared.subscribe()
+    pusher = push_when_continuous(station, 1)
+    assert cards.get(timeout=2)['card_number'] > 0
+    pusher.join()
+    shared.unsubscribe(cards)
+    shared.close()
+
+
+def test_commands(station):
+    with SharedSportiduino(station.port) as shared:
+        assert str(shared.read_version().result()) == 'v2.10.x'
+        assert shared.init_card(12).result() is None
+
+
+def test_commands_fail_after_port_failure(station):
+    shared = SharedSportiduino(station.port, continuous=True)
+    # Close the port in the I/O thread, so card waits fail from now on
+    shared.submit(lambda sportiduino: sportiduino._serial.close()).result()
+    with pytest.raises(SportiduinoPortError):
+        shared.read_version().result(timeout=2)
+    shared.close()
+
+
+def test_closed(station):
+    shared = SharedSportiduino(station.port)
+    shared.close()
+    with pytest.raises(SportiduinoException):
+        shared.beep_ok()
@@ -0,0 +1,88 @@
+"""
+Event store queries.
+"""
+
+from sportiduino import CardRecord
+from sportiduino_store import EventStore
+from testdata import START, card_payload
+
+
+def test_event_store():
+    store = EventStore()
+    store.append(card_payload(1, [31, 32, 33]))
+    store.append(card_payload(2, [31, 32], start=START - 30, finish=False))
+
+    assert store.last_at(31) == [(1, START + 60), (2, START + 30)]
+    assert store.running_order(31) == [(1, 60), (2, 60)]
+    assert store.unfinished() == [2]
+    assert len(store) == 5
+
+    # New readout replaces the old one
+    store.append(card_payload(2, [31, 32, 33], start=START - 30))
+    assert store.unfinished() == []
+    assert store.card_punches(2) == [(31, START + 30), (32, START + 90), (33, START + 150)]
+    assert len(store) == 6
+
+
+def test_add_card_dict():
+    store = EventStore()
+    store.add_card(CardRecord(card_payload(1, [31, 32])).to_dict())
+    store.add_card(CardRecord(card_payload(2, [31])))
+    assert 1 in store and 2 in store and 3 not in store
+    assert store.card_punches(1) == [(31, START + 60), (32, START + 120)]
+    assert store.card_times(1) == (START, START + 180)
+    assert store.punches_at(31) == [(1, START + 60), (2, START + 60)]
+
+
+def test_punches_at_range():
+    store = EventStore()
+    for n in range(1, 6):
+        store.append(card_payload(n, [31], start=START + n*10))
+    assert store.punches_at(31, since=START + 80, until=START + 100) == \
+        [(2, START + 80), (3, START + 90), (4, START + 100)]
+    assert store.punches_at(31, since=START + 200) == []
+    assert store.punches_at(99) == []
+    assert store.last_at(31, 2) == [(5, START + 110), (4, START + 100)]
+
+
+def test_position():
+    store = EventStore()
+    store.append(card_payload(1, [31, 32]))
+    store.append(card_payload(2, [32, 31]))
+    store.append(card_payload(3, [31, 32], start=START - 10))
+    # Running times at 31: cards 1 and 3 60 s, card 2 120 s
+    assert store.position(31, 1) == 1
+    assert store.position(31, 3) == 1
+    assert store.position(31, 2) == 3
+    assert store.position(33, 1) is None
+    assert store.position(31, 4) is None
+    # No start punch, no running time
+    store.append(card_payload(4, [31])[:10] + card_payload(4, [31])[15:])
+    assert store.card_times(4) == (None, START + 120)
+    assert store.position(31, 4) is None
+    assert store.running_order(31, 2) == [(1, 60), (3, 60)]
+
+
+def test_add_backup():
+    store = EventStore()
+    store.append(card_payload(1, [31, 32]))
+    store.add_backup({'cp': 31, 'cards': [1, 7, 8]})
+    store.add_backup({'cp': 33, 'cards': [8]})
+    assert store.cards_at(31) == [1, 7, 8]
+    assert store.cards_at(32) == [1]
+    assert store.cards_at(33) == [8]
+    # Backup cards were not read out
+    assert store.unfinished() == [7, 8]
+    # Backups have no times
+    assert store.punches_at(31) == [(1, START + 60)]
+
+
+def test_replaced_readouts_compacted():
+    store = EventStore()
+    store.append(card_payload(1, [31, 32]))
+    for n in range(10):
+        store.append(card_payload(2, [31, 32, 33], start=START + n))
+    assert len(store) == 5
+    assert store._dead <= len(store._epochs)*EventStore.COMPACT_RATIO
+    assert store.card_punches(1) == [(31, START + 60), (32, START + 120)]
+    assert store.last_at(33) == [(2, START + 9 + 180)]
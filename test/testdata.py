@@ -0,0 +1,55 @@
+"""
+Card payloads and captured frames shared by the tests.
+"""
+
+import struct
+import threading
+import time
+
+from sportiduino import Sportiduino
+
+
+START = 1520254123
+
+# Version response v2.10.x as received from master station
+CAPTURED_VERSION = b'\xfe\x66\x01\xd2\x39'
+
+# Readout of card 9 with 7 punches, sent by master station in two fragments
+CAPTURED_CARD = [
+    bytes(bytearray.fromhex('fe631e00090000000000000000f05a9d3cab1f5a9d3ce7205a9d3d23215a9d20')),
+    bytes(bytearray.fromhex('fe631b3d5f225a9d3d9b235a9d3dd7245a9d3e13255a9d3e4ff55a9d3e8b03')),
+]
+
+
+def card_payload(card_number, cps, start=START, finish=True):
+    """RESP_CARD_DATA payload with punches a minute apart."""
+    data = struct.pack('>H8x', card_number)
+    data += struct.pack('>BI', Sportiduino.START_STATION, start)
+    t = start
+    for cp in cps:
+        t += 60
+        data += struct.pack('>BI', cp, t)
+    if finish:
+        data += struct.pack('>BI', Sportiduino.FINISH_STATION, t + 60)
+    return data
+
+
+def card_numbers(payloads):
+    return [struct.unpack_from('>H', data)[0] for data in payloads]
+
+
+def push_when_continuous(fms, count, interval=0):
+    """Push cards from FakeMasterStation in a thread once continuous
+    read mode is enabled.
+    @return: Started thread.
+    """
+    def push():
+        deadline = time.time() + 5
+        while not fms.continuous and time.time() < deadline:
+            time.sleep(0.01)
+        for _ in range(count):
+            fms.push_card()
+            time.sleep(interval)
+    thread = threading.Thread(target=push)
+    thread.start()
+    return thread